@@ -0,0 +1,2 @@
+# api/ 配下のハンドラー間で共有するモジュール群
+# （先頭が "_" のためVercelの関数としてはデプロイされない）
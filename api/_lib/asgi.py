@@ -0,0 +1,286 @@
+"""チャットAPIのASGI版エントリーポイント
+
+chat.py / characters.py と同じ処理（ChatService・レジストリ）を asyncio 上で動かす。
+モデル呼び出しは UpstreamLimiter の枠内でスレッドプールに逃がすので、
+1プロセスで多数の会話を同時に抱えられる。枠が埋まったら少し待ってから503を返す。
+
+    uvicorn --app-dir api _lib.asgi:app
+    python scripts/serve_asgi.py        # 依存なしのローカルランナー
+"""
+import asyncio
+import math
+
+from . import batch, metrics
+from .chat_service import create_chat_service
+from .concurrency import Saturated, create_upstream_limiter
+from .ratelimit import client_key, create_rate_limiter
+from .jsoncodec import dumps
+from .registry import CHARACTER_LIST_ETAG, CHARACTER_LIST_JSON, CHARACTERS, etag_matches
+from .streaming import SSE_HEADERS, sse_event, wants_stream
+from .validation import MAX_BODY_BYTES, RequestError, parse_chat_request, parse_json_body
+
+_CORS_HEADERS = [(b'access-control-allow-origin', b'*')]
+_JSON_HEADERS = [(b'content-type', b'application/json; charset=utf-8')] + _CORS_HEADERS
+
+
+def _encode(obj):
+    return dumps(obj)
+
+
+async def _send_bytes(send, status, body=b'', headers=()):
+    headers = list(headers)
+    if status not in (204, 304):
+        headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_json(send, status, obj, headers=()):
+    await _send_bytes(send, status, _encode(obj), _JSON_HEADERS + list(headers))
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get('more_body'):
+            return body
+
+
+class _HeaderView:
+    """ASGIのヘッダー（小文字のbytes）を名前で引けるようにする"""
+
+    __slots__ = ('headers',)
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def get(self, name, default=None):
+        value = self.headers.get(name.lower().encode('latin-1'))
+        return default if value is None else value.decode('latin-1')
+
+
+def _route(path):
+    # Vercelと同じ /api/... でも、Flask版と同じ /... でも受け付ける
+    if path.startswith('/api/'):
+        path = path[4:]
+    return [segment for segment in path.split('/') if segment]
+
+
+def create_app(service=None, limiter=None, rate_limiter=None):
+    """ASGIアプリを作る（rate_limiter を省略すると環境変数の設定で作る）"""
+    service = service or create_chat_service('gemini-2.0-flash-lite')
+    limiter = limiter or create_upstream_limiter()
+    if rate_limiter is None:
+        rate_limiter = create_rate_limiter()
+    status_json = _encode({
+        "message": "チャットAPIが動作しています。POSTでメッセージを送信してください。",
+        "demo_mode": service.demo_mode,
+        "api_key_configured": not service.demo_mode,
+    })
+
+    async def characters(send, headers, character_id=None):
+        if character_id is None:
+            body, etag = CHARACTER_LIST_JSON, CHARACTER_LIST_ETAG
+        elif character_id in CHARACTERS:
+            body, etag = CHARACTERS[character_id].json_bytes, CHARACTERS[character_id].etag
+        else:
+            await _send_json(send, 404, {"error": "指定されたキャラクターが見つかりません。"})
+            return
+        cache_headers = [(b'etag', etag.encode('latin-1')), (b'cache-control', b'max-age=3600')]
+        if etag_matches(headers.get(b'if-none-match', b'').decode('latin-1'), etag):
+            await _send_bytes(send, 304, headers=_CORS_HEADERS + cache_headers)
+        else:
+            await _send_bytes(send, 200, body, _JSON_HEADERS + cache_headers)
+
+    async def chat(receive, send, headers, client):
+        timer = metrics.RequestTimer('chat')
+        body = await _read_body(receive)
+        if body is None:
+            metrics.ERRORS.inc(error_class='bad_request')
+            await _send_json(send, 413, {"error": "リクエストが大きすぎます。"})
+            timer.finish(413)
+            return
+        with timer.span('parse'):
+            try:
+                data = parse_json_body(body)
+                # 未知のIDは霊夢として応答する
+                character, user_message, session_id = parse_chat_request(data)
+                error = None
+            except RequestError as e:
+                error = e
+        if error is not None:
+            metrics.ERRORS.inc(error_class='bad_request')
+            await _send_json(send, error.status, {"error": str(error)})
+            timer.finish(error.status)
+            return
+        if rate_limiter is not None:
+            wait = rate_limiter.acquire(client, character.id)
+            if wait:
+                metrics.ERRORS.inc(error_class='rate_limited')
+                await _send_json(
+                    send, 429,
+                    {"error": "リクエストが多すぎます。しばらくしてから再度お試しください。"},
+                    [(b'retry-after', str(math.ceil(wait)).encode('latin-1'))],
+                )
+                timer.finish(429, character=character.id)
+                return
+        envelope = {"character": dict(character.summary)}
+        if session_id:
+            envelope["session_id"] = session_id
+
+        stream = wants_stream(data, headers.get(b'accept', b'').decode('latin-1'))
+        try:
+            if stream:
+                async with limiter.slot(client):
+                    await send({
+                        'type': 'http.response.start',
+                        'status': 200,
+                        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in SSE_HEADERS] + _CORS_HEADERS,
+                    })
+                    parts = []
+                    chunks = service.stream_or_apology(character, user_message, session_id, timer)
+                    async for text in limiter.iterate(chunks):
+                        parts.append(text)
+                        await send({'type': 'http.response.body', 'body': sse_event('delta', {"text": text}), 'more_body': True})
+                    reply = "".join(parts)
+                    done = {"reply": reply, **envelope}
+                    await send({'type': 'http.response.body', 'body': sse_event('done', done)})
+            else:
+                reply = await limiter.call(service.reply_or_apology, character, user_message, session_id, timer,
+                                           client=client)
+                await _send_json(send, 200, {"reply": reply, **envelope})
+        except Saturated as e:
+            metrics.ERRORS.inc(error_class='saturated')
+            await _send_json(
+                send, 503,
+                {"error": "混み合っています。しばらくしてから再度お試しください。"},
+                [(b'retry-after', str(e.retry_after).encode('latin-1'))],
+            )
+            timer.finish(503, 'stream' if stream else 'json', character=character.id)
+            return
+        if rate_limiter is not None:
+            rate_limiter.record_exchange(client, character.id, user_message, reply)
+        timer.finish(200, 'stream' if stream else 'json', character=character.id)
+
+    async def answer(item, bound, client):
+        async with bound:
+            try:
+                return await limiter.call(batch.answer_item, service, item, client=client)
+            except Saturated:
+                metrics.ERRORS.inc(error_class='saturated')
+                return batch.item_result(item, error="混み合っています。しばらくしてから再度お試しください。", status=503)
+
+    async def chat_batch(receive, send, headers, client):
+        timer = metrics.RequestTimer('chat_batch')
+        body = await _read_body(receive)
+        if body is None:
+            metrics.ERRORS.inc(error_class='bad_request')
+            await _send_json(send, 413, {"error": "リクエストが大きすぎます。"})
+            timer.finish(413)
+            return
+        with timer.span('parse'):
+            try:
+                data = parse_json_body(body)
+                items = batch.parse_batch(data)
+                error = None
+            except (RequestError, batch.BatchError) as e:
+                error = str(e)
+        if error:
+            metrics.ERRORS.inc(error_class='bad_request')
+            await _send_json(send, 400, {"error": error})
+            timer.finish(400)
+            return
+
+        admit = batch.rate_limit_admitter(rate_limiter, client)
+        bound = asyncio.Semaphore(batch.BATCH_CONCURRENCY)
+        rejected, tasks = [], []
+        for item in items:
+            result = admit(item) if admit else None
+            if result is not None:
+                rejected.append(result)
+            else:
+                tasks.append(asyncio.ensure_future(answer(item, bound, client)))
+
+        if batch.wants_ndjson(data, headers.get(b'accept', b'').decode('latin-1')):
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', batch.NDJSON_CONTENT_TYPE.encode('latin-1')),
+                            (b'cache-control', b'no-cache')] + _CORS_HEADERS,
+            })
+            for result in rejected:
+                await send({'type': 'http.response.body', 'body': batch.ndjson_line(result), 'more_body': True})
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                batch.record_usage(rate_limiter, client, items, result)
+                await send({'type': 'http.response.body', 'body': batch.ndjson_line(result), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            timer.finish(200, 'ndjson', items=len(items))
+            return
+
+        results = rejected + list(await asyncio.gather(*tasks))
+        for result in results:
+            batch.record_usage(rate_limiter, client, items, result)
+        await _send_json(send, 200, {"results": batch.ordered(results)})
+        timer.finish(200, 'json', items=len(items))
+
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # 常駐サーバーなので、最初のリクエストより前にモデルを準備しておく
+                await asyncio.get_running_loop().run_in_executor(limiter.executor, service.warm_up)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                limiter.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        method = scope['method']
+        headers = dict(scope.get('headers', ()))
+        segments = _route(scope['path'])
+        client = client_key(_HeaderView(headers), (scope.get('client') or (None,))[0])
+
+        if method == 'OPTIONS':
+            await _send_bytes(send, 200, headers=_CORS_HEADERS + [
+                (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+                (b'access-control-allow-headers', b'Content-Type, Accept, If-None-Match, Authorization, X-API-Key'),
+            ])
+        elif segments == ['chat'] and method == 'POST':
+            await chat(receive, send, headers, client)
+        elif segments == ['chat', 'batch'] and method == 'POST':
+            await chat_batch(receive, send, headers, client)
+        elif segments[-1:] == ['metrics'] and method == 'GET':
+            await _send_bytes(send, 200, metrics.render().encode('utf-8'),
+                              [(b'content-type', metrics.CONTENT_TYPE.encode('latin-1'))])
+        elif segments == ['chat', 'warmup'] and method == 'GET':
+            await asyncio.get_running_loop().run_in_executor(limiter.executor, service.warm_up)
+            await _send_json(send, 200, {"warmed": True, "backend": service.backend.name})
+        elif segments == ['chat', 'usage'] and method == 'GET':
+            usage = rate_limiter.usage(client) if rate_limiter is not None else {}
+            await _send_json(send, 200, usage)
+        elif segments == ['chat'] and method == 'GET':
+            await _send_bytes(send, 200, status_json, _JSON_HEADERS)
+        elif segments[:1] == ['characters'] and len(segments) <= 2 and method == 'GET':
+            await characters(send, headers, segments[1] if len(segments) == 2 else None)
+        else:
+            await _send_json(send, 404, {"error": "Not Found"})
+
+    app.service = service
+    app.limiter = limiter
+    app.rate_limiter = rate_limiter
+    return app
+
+
+app = create_app()
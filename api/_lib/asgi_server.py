@@ -0,0 +1,99 @@
+"""ASGIアプリをローカルで動かすための最小限のHTTP/1.1サーバー（標準ライブラリのみ）
+
+Content-Length 付きのリクエストと keep-alive に対応し、長さの分からない応答
+（SSEなど）は chunked 転送で返す。本番では uvicorn などのASGIサーバーを使う。
+"""
+import asyncio
+from http import HTTPStatus
+
+# リクエストヘッダー全体の上限
+MAX_HEADER_LINES = 100
+
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, target, version = request_line.decode('latin-1').split()
+    headers = []
+    for _ in range(MAX_HEADER_LINES):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers.append((name.strip().lower().encode('latin-1'), value.strip().encode('latin-1')))
+    length = int(dict(headers).get(b'content-length', b'0'))
+    body = await reader.readexactly(length) if length else b''
+    return method, target, version, headers, body
+
+
+async def _handle_connection(app, reader, writer):
+    peer = writer.get_extra_info('peername')
+    sock = writer.get_extra_info('sockname')
+    try:
+        while True:
+            request = await _read_request(reader)
+            if request is None:
+                break
+            method, target, version, headers, body = request
+            header_map = dict(headers)
+            keep_alive = version == 'HTTP/1.1' and header_map.get(b'connection', b'').lower() != b'close'
+            path, _, query = target.partition('?')
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0'},
+                'http_version': version.split('/')[-1],
+                'method': method,
+                'scheme': 'http',
+                'path': path,
+                'raw_path': path.encode('latin-1'),
+                'query_string': query.encode('latin-1'),
+                'headers': headers,
+                'client': peer,
+                'server': sock,
+            }
+            state = {'chunked': False}
+
+            async def receive(body=body):
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+                    response_headers = list(message.get('headers', ()))
+                    names = {name.lower() for name, _ in response_headers}
+                    state['chunked'] = b'content-length' not in names and status not in (204, 304)
+                    if state['chunked']:
+                        response_headers.append((b'transfer-encoding', b'chunked'))
+                    if not keep_alive:
+                        response_headers.append((b'connection', b'close'))
+                    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n".encode('latin-1')]
+                    lines += [name + b': ' + value + b'\r\n' for name, value in response_headers]
+                    writer.write(b''.join(lines) + b'\r\n')
+                elif message['type'] == 'http.response.body':
+                    data = message.get('body', b'')
+                    if state['chunked']:
+                        if data:
+                            writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+                        if not message.get('more_body'):
+                            writer.write(b'0\r\n\r\n')
+                    elif data:
+                        writer.write(data)
+                    await writer.drain()
+
+            await app(scope, receive, send)
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(app, host='127.0.0.1', port=8000, ready=None):
+    """app を host:port で待ち受ける。ready は起動後にポート番号を受け取るコールバック"""
+    server = await asyncio.start_server(lambda r, w: _handle_connection(app, r, w), host, port)
+    if ready is not None:
+        ready(server.sockets[0].getsockname()[1])
+    async with server:
+        await server.serve_forever()
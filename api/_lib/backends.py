@@ -0,0 +1,263 @@
+"""モデルバックエンドの抽象化
+
+ChatService はここで定義したインターフェース（generate / stream / count_tokens）だけを使う。
+system_instruction が True のバックエンドには、キャラクターのプロンプトを除いた
+会話部分だけが渡される（キャラクターのプロンプトはバックエンド側で指示として付ける）。
+CHAT_MODEL_BACKEND で切り替える：
+
+- gemini: Google Gemini（GEMINI_API_KEY が必要）
+- fake:   オフライン用の決定的なフェイク（遅延・トークン速度・エラー率を設定可能）
+- demo:   キャラクターごとの固定応答（従来のデモモード）
+
+未指定なら APIキーがあれば gemini、なければ demo。
+
+google.generativeai の読み込みとモデルの構築は最初の呼び出し（または warm_up）まで遅らせる。
+サーバーレスのコールドスタートや GET のヘルスチェックで SDK の読み込みを待たせないため。
+"""
+import os
+import random
+import threading
+import time
+
+from .registry import CHARACTERS
+from .sessions import estimate_tokens
+
+
+class ModelBackend:
+    """バックエンドの共通インターフェース"""
+
+    name = 'base'
+    # 応答キャッシュに載せてよいか（固定応答のデモでは不要）
+    cacheable = True
+    # キャラクターのプロンプトを system_instruction として自前で持つか
+    system_instruction = False
+
+    def generate(self, character, prompt):
+        """応答全体を返す。ブロックされて応答がない場合は None"""
+        raise NotImplementedError
+
+    def stream(self, character, prompt):
+        """部分テキストを順に返すイテレーター"""
+        raise NotImplementedError
+
+    def count_tokens(self, character, prompt):
+        return estimate_tokens(prompt)
+
+    def warm_up(self):
+        """初回リクエストの前に済ませておける準備（SDKの読み込みなど）"""
+
+
+class GeminiBackend(ModelBackend):
+    """キャラクターごとに system_instruction 付きのモデルを起動時に作っておく
+
+    キャラクターのプロンプトを会話の本文に連結せず、指示（system_instruction）として分けて渡す。
+    system_instruction も generateContent のたびに送られ、入力トークンとして課金されるので、
+    トークン数や遅延は本文に連結した場合と変わらない（役割を分けて渡せるだけ）。
+    （明示的なコンテキストキャッシュは最小トークン数の条件があり、このプロンプトの長さでは使えない）
+    """
+
+    name = 'gemini'
+    system_instruction = True
+
+    def __init__(self, model_name, api_key):
+        self.model_name = model_name
+        self.api_key = api_key
+        self.models = None
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        self._models()
+
+    def _models(self):
+        # 初回だけSDKを読み込み、全キャラクター分のモデルを作る
+        if self.models is None:
+            with self._lock:
+                if self.models is None:
+                    import google.generativeai as genai
+                    genai.configure(api_key=self.api_key)
+                    self.models = {
+                        char_id: genai.GenerativeModel(self.model_name, system_instruction=character.prompt)
+                        for char_id, character in CHARACTERS.items()
+                    }
+        return self.models
+
+    def _model(self, character):
+        return self._models()[character.id]
+
+    def generate(self, character, prompt):
+        response = self._model(character).generate_content(prompt)
+        # 応答がブロックされた場合や内容が空の場合は None
+        if response.candidates and response.candidates[0].content.parts:
+            return response.candidates[0].content.parts[0].text
+        print(f"Geminiからの応答がありませんでした。フィードバック:{response.prompt_feedback}")
+        return None
+
+    def stream(self, character, prompt):
+        for chunk in self._model(character).generate_content(prompt, stream=True):
+            try:
+                text = chunk.text
+            except ValueError:
+                # ブロックされたチャンクはテキストを持たない
+                continue
+            if text:
+                yield text
+
+    def count_tokens(self, character, prompt):
+        return self._model(character).count_tokens(prompt).total_tokens
+
+
+class DemoBackend(ModelBackend):
+    """キャラクターごとの固定応答を即座に返す"""
+
+    name = 'demo'
+    cacheable = False
+
+    def __init__(self, random_choice=False):
+        self.random_choice = random_choice
+
+    def generate(self, character, prompt):
+        if self.random_choice:
+            return random.choice(character.demo_replies)
+        return character.demo_replies[0]
+
+    def stream(self, character, prompt):
+        yield self.generate(character, prompt)
+
+
+class FakeQuotaError(Exception):
+    """フェイクバックエンドが模擬する利用制限エラー"""
+
+
+class FakeNetworkError(Exception):
+    """フェイクバックエンドが模擬する通信エラー"""
+
+
+def parse_distribution(spec):
+    """遅延分布の指定（秒）をサンプラー関数に変換する
+
+    constant:0.5 / uniform:0.2,0.8 / normal:0.5,0.1 / lognormal:-0.7,0.5 / exponential:0.5
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(v) for v in params.split(',') if v]
+    if kind == 'constant':
+        return lambda rng: values[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(values[0], values[1])
+    if kind == 'exponential':
+        return lambda rng: rng.expovariate(1.0 / values[0])
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+class FakeBackend(ModelBackend):
+    """ネットワークを使わない決定的なフェイク
+
+    呼び出しごとの乱数は seed と呼び出し順から作るので、同じ seed・同じ順序なら
+    遅延・応答の長さ・エラーの発生が毎回同じになる。負荷試験やオフラインの動作確認用。
+    """
+
+    name = 'fake'
+
+    def __init__(self, seed=0, latency='constant:0.05', token_rate=200.0, reply_tokens=(20, 60),
+                 chunk_tokens=8, error_rate=0.0, quota_rate=0.0):
+        self.seed = seed
+        self.first_token_latency = parse_distribution(latency)
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.chunk_tokens = chunk_tokens
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def _next_rng(self):
+        with self._lock:
+            index = self.calls
+            self.calls += 1
+        return random.Random(self.seed * 1_000_003 + index)
+
+    def _plan(self, prompt):
+        # 1回の呼び出しの結果（最初のトークンまでの遅延・応答テキスト）を決める
+        rng = self._next_rng()
+        latency = self.first_token_latency(rng)
+        roll = rng.random()
+        if roll < self.quota_rate:
+            with self._lock:
+                self.errors += 1
+            return latency, FakeQuotaError("429 Resource has been exhausted (e.g. check quota).")
+        if roll < self.quota_rate + self.error_rate:
+            with self._lock:
+                self.errors += 1
+            return latency, FakeNetworkError("503 network connection reset by upstream")
+        return latency, self._reply_for(prompt, rng.randint(*self.reply_tokens))
+
+    @staticmethod
+    def _reply_for(prompt, length):
+        # プロンプト中の最後のユーザー発言をオウム返しし、指定の長さまで埋める
+        said = ''
+        for line in prompt.splitlines():
+            if line.startswith('ユーザー'):
+                said = line.split('：', 1)[-1].split(': ', 1)[-1]
+        text = f"（フェイク応答）「{said[:40]}」……なるほどね。"
+        filler = 'ゆっくりしていきなさい。'
+        while len(text) < length:
+            text += filler
+        return text[:max(length, 1)]
+
+    def _token_delay(self, tokens):
+        return tokens / self.token_rate if self.token_rate > 0 else 0.0
+
+    def generate(self, character, prompt):
+        latency, result = self._plan(prompt)
+        time.sleep(latency)
+        if isinstance(result, Exception):
+            raise result
+        time.sleep(self._token_delay(estimate_tokens(result)))
+        return result
+
+    def stream(self, character, prompt):
+        latency, result = self._plan(prompt)
+        time.sleep(latency)
+        if isinstance(result, Exception):
+            raise result
+        # 日本語はほぼ1文字1トークンなので chunk_tokens 文字ずつ返す
+        for i in range(0, len(result), self.chunk_tokens):
+            chunk = result[i:i + self.chunk_tokens]
+            if i:
+                time.sleep(self._token_delay(len(chunk)))
+            yield chunk
+
+    def expected_latency(self, samples=1000):
+        """最初のトークンまでの遅延の平均（推定値）。ベンチマーク結果との比較用"""
+        rng = random.Random(self.seed)
+        return sum(self.first_token_latency(rng) for _ in range(samples)) / samples
+
+
+def _fake_backend_from_env():
+    low, _, high = os.getenv("FAKE_MODEL_REPLY_TOKENS", "20,60").partition(',')
+    return FakeBackend(
+        seed=int(os.getenv("FAKE_MODEL_SEED", "0")),
+        latency=os.getenv("FAKE_MODEL_LATENCY", "constant:0.05"),
+        token_rate=float(os.getenv("FAKE_MODEL_TOKEN_RATE", "200")),
+        reply_tokens=(int(low), int(high or low)),
+        chunk_tokens=int(os.getenv("FAKE_MODEL_CHUNK_TOKENS", "8")),
+        error_rate=float(os.getenv("FAKE_MODEL_ERROR_RATE", "0")),
+        quota_rate=float(os.getenv("FAKE_MODEL_QUOTA_RATE", "0")),
+    )
+
+
+def create_backend(model_name, demo_random=False):
+    """環境変数の設定からバックエンドを作る"""
+    api_key = os.getenv("GEMINI_API_KEY")
+    kind = os.getenv("CHAT_MODEL_BACKEND") or ('gemini' if api_key else 'demo')
+    if kind == 'gemini':
+        return GeminiBackend(model_name, api_key)
+    if kind == 'fake':
+        return _fake_backend_from_env()
+    if kind == 'demo':
+        return DemoBackend(random_choice=demo_random)
+    raise ValueError(f"unknown CHAT_MODEL_BACKEND: {kind}")
@@ -0,0 +1,145 @@
+"""複数の（キャラクター, メッセージ）をまとめて応答する /chat/batch 用の処理
+
+リクエストの形式（どちらか）:
+
+    {"requests": [{"character_id": "reimu", "message": "..."}, ...]}
+    {"message": "...", "character_ids": ["reimu", "marisa", "sakuya"]}   # 同じ発言に全員が反応
+
+上流の呼び出しは同時実行数の上限（CHAT_BATCH_CONCURRENCY）付きで並行に行う。
+通常は入力と同じ順の {"results": [...]} を返し、stream=true（または Accept: application/x-ndjson）
+なら終わったものから1行ずつ NDJSON で返す。各行の index で元の順番が分かる。
+"""
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .chat_service import error_reply
+from .jsoncodec import dumps
+from .metrics import ERRORS
+from .registry import get_character
+from .sessions import normalize_session_id
+from .validation import MAX_MESSAGE_CHARS
+
+MAX_BATCH_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "16"))
+BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "8"))
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson; charset=utf-8'
+
+BatchItem = namedtuple('BatchItem', 'index character message session_id')
+
+# スレッドは使うときに作られるので、モジュール読み込み時に作っておいてよい
+_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
+
+
+class BatchError(ValueError):
+    """バッチのリクエストが不正（400で返す）"""
+
+
+def parse_batch(data):
+    """リクエストボディを BatchItem のリストにする。不正なら BatchError"""
+    if not isinstance(data, dict):
+        raise BatchError("リクエストの形式が正しくありません。")
+    if 'requests' in data:
+        entries = data['requests']
+    else:
+        ids = data.get('character_ids')
+        if not isinstance(ids, list):
+            raise BatchError("requests または character_ids を指定してください。")
+        entries = [{"character_id": cid, "message": data.get('message'), "session_id": data.get('session_id')}
+                   for cid in ids]
+    if not isinstance(entries, list) or not entries:
+        raise BatchError("requests は1件以上のリストで指定してください。")
+    if len(entries) > MAX_BATCH_ITEMS:
+        raise BatchError(f"一度に送れるのは{MAX_BATCH_ITEMS}件までです。")
+
+    items = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise BatchError(f"{index}件目の形式が正しくありません。")
+        message = entry.get('message')
+        if not isinstance(message, str) or not message:
+            raise BatchError(f"{index}件目のメッセージが提供されていません。")
+        if len(message) > MAX_MESSAGE_CHARS:
+            raise BatchError(f"{index}件目のメッセージが長すぎます（{MAX_MESSAGE_CHARS}文字まで）。")
+        character_id = entry.get('character_id')
+        if not isinstance(character_id, str):
+            raise BatchError(f"{index}件目のキャラクターが見つかりません。")
+        character = get_character(character_id, fallback=False)
+        if character is None:
+            raise BatchError(f"{index}件目のキャラクターが見つかりません。")
+        session_id = entry.get('session_id')
+        if session_id is not None and normalize_session_id(session_id) is None:
+            raise BatchError(f"{index}件目の session_id が不正です。")
+        items.append(BatchItem(index, character, message, session_id))
+    return items
+
+
+def wants_ndjson(data, accept=None):
+    if data.get('stream'):
+        return True
+    return bool(accept) and 'application/x-ndjson' in accept
+
+
+def item_result(item, reply=None, error=None, status=200):
+    """1件分の結果（応答の形式は /chat と同じで、index と失敗時の error が付く）"""
+    result = {"index": item.index, "character": dict(item.character.summary)}
+    if error is None:
+        result["reply"] = reply
+    else:
+        result["error"] = error
+        result["status"] = status
+    if item.session_id:
+        result["session_id"] = item.session_id
+    return result
+
+
+def answer_item(service, item):
+    """1件分の応答を作る（例外は結果の error に変換する）"""
+    try:
+        return item_result(item, service.reply(item.character, item.message, item.session_id))
+    except Exception as e:
+        return item_result(item, error=error_reply(e), status=500)
+
+
+def run_batch(service, items, admit=None):
+    """各件を並行に処理し、終わった順に結果を返すジェネレーター
+
+    admit(item) がエラーの結果を返した件は上流を呼ばない（レート制限など）。
+    """
+    futures = []
+    for item in items:
+        rejected = admit(item) if admit else None
+        if rejected is not None:
+            yield rejected
+            continue
+        futures.append(_executor.submit(answer_item, service, item))
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def rate_limit_admitter(rate_limiter, client):
+    """1件ごとにレート制限の予算を取る admit 関数（制限なしなら None）"""
+    if rate_limiter is None:
+        return None
+
+    def admit(item):
+        if rate_limiter.acquire(client, item.character.id):
+            ERRORS.inc(error_class='rate_limited')
+            return item_result(item, error="リクエストが多すぎます。しばらくしてから再度お試しください。", status=429)
+        return None
+    return admit
+
+
+def record_usage(rate_limiter, client, items, result):
+    """応答できた件の推定トークン数を利用量に加える"""
+    if rate_limiter is not None and "reply" in result:
+        item = items[result["index"]]
+        rate_limiter.record_exchange(client, item.character.id, item.message, result["reply"])
+
+
+def ordered(results):
+    return sorted(results, key=lambda result: result["index"])
+
+
+def ndjson_line(result):
+    return dumps(result) + b'\n'
@@ -0,0 +1,310 @@
+"""チャット応答の生成処理
+
+chat.py（BaseHTTPRequestHandler）・index.py（Flask）・ASGI版のどれからも同じ処理を使えるよう、
+HTTPの扱いから切り離した応答生成（履歴・キャッシュ・モデル呼び出し）をまとめる。
+モデルの呼び出し先（Gemini・フェイク・デモ）は backends.py で差し替え、
+期限・再試行・サーキットブレーカーは resilience.py で包む。
+ブレーカーが開いている間はキャッシュ済みの応答か、キャラクターの簡易応答を返す。
+会話ログ（convlog.py）が有効なら、やり取りを1件ずつ非同期に記録する。
+設定資料の索引（lore.py）があれば、発言に関係する断片だけをプロンプトに載せる。
+モデルの出力は postprocess.py で禁止語・長さ・口調をチェックしてから返す。
+同じプロンプトが同時に届いたら、singleflight.py で上流の呼び出しを1回にまとめる。
+"""
+import os
+import time
+
+from .backends import create_backend
+from .convlog import create_conversation_log
+from .lore import create_lore_index
+from .metrics import CACHE_LOOKUPS, ERRORS, FALLBACKS, NULL_TIMER, PROMPT_TOKENS, UPSTREAM_IN_FLIGHT
+from .postprocess import create_postprocessor
+from .prompts import build_turn_prompt, with_character_prompt
+from .resilience import CircuitOpenError, create_resilient_backend
+from .response_cache import create_response_cache
+from .sessions import create_session_store, estimate_tokens
+from .singleflight import create_single_flight
+
+
+def classify_error(e):
+    """モデル呼び出しの例外を quota / auth / network / other に分類する"""
+    message = str(e).lower()
+    if isinstance(e, TimeoutError):
+        return 'network'
+    if "quota" in message or "limit" in message:
+        return 'quota'
+    elif "api_key" in message or "authentication" in message:
+        return 'auth'
+    elif "network" in message or "connection" in message:
+        return 'network'
+    return 'other'
+
+
+def record_error(e):
+    """エラーをログとメトリクスに記録し、分類を返す"""
+    error_class = classify_error(e)
+    ERRORS.inc(error_class=error_class)
+    print(f"AI応答エラー: {e}")
+    print(f"エラーの種類: {type(e).__name__}")
+    print(f"詳細: {str(e)}")
+    return error_class
+
+
+def error_reply(e):
+    """モデル呼び出しの例外をユーザー向けのメッセージに変換する"""
+    # より詳細なエラーメッセージを返す
+    error_class = record_error(e)
+    if error_class == 'quota':
+        return "申し訳ありません、APIの利用制限に達したようです。しばらく時間をおいてから再度お試しください。"
+    elif error_class == 'auth':
+        return "APIキーの設定に問題があるようです。管理者にお問い合わせください。"
+    elif error_class == 'network':
+        return "ネットワークの問題で応答できませんでした。もう一度お試しください。"
+    else:
+        return f"すみません、今少し調子が悪いようです...また後で話しかけてくださいね。\n\n（エラー詳細: {type(e).__name__}）"
+
+
+def _blocked_reply(character):
+    return f"うーん、何て言えばいいか分からないわ。({character.name})"
+
+
+class ChatService:
+    def __init__(self, backend, sessions, response_cache=None, conversation_log=None, lore=None,
+                 postprocess=None, single_flight=None):
+        self.backend = backend
+        self.sessions = sessions
+        self.response_cache = response_cache
+        self.conversation_log = conversation_log
+        self.lore = lore
+        self.postprocess = postprocess
+        self.single_flight = single_flight
+
+    @property
+    def demo_mode(self):
+        return self.backend.name == 'demo'
+
+    def warm_up(self):
+        """モデルのSDK読み込み・クライアント構築を先に済ませる"""
+        start = time.perf_counter()
+        self.backend.warm_up()
+        print(f"ウォームアップ完了: {self.backend.name} ({(time.perf_counter() - start) * 1000:.1f}ms)")
+
+    def _cache_key(self, character, user_message, history):
+        # 会話の途中（履歴あり）の応答は文脈に依存するのでキャッシュしない
+        if self.response_cache is None or history or not self.backend.cacheable:
+            return None
+        return self.response_cache.make_key(character, user_message)
+
+    def _cache_get(self, cache_key):
+        if not cache_key:
+            return None
+        reply = self.response_cache.get(cache_key)
+        CACHE_LOOKUPS.inc(result='miss' if reply is None else 'hit')
+        return reply
+
+    def _prompt(self, character, user_message, history, timer):
+        """バックエンドに渡すプロンプトを作り、固定部分と可変部分のトークン数を記録する"""
+        lore = self.lore.retrieve(character.id, user_message) if self.lore is not None else ()
+        turn = build_turn_prompt(character, user_message, history, lore)
+        dynamic_tokens = estimate_tokens(turn)
+        PROMPT_TOKENS.inc(character.prompt_tokens, character=character.id, part='static')
+        PROMPT_TOKENS.inc(dynamic_tokens, character=character.id, part='dynamic')
+        timer.annotate(static_tokens=character.prompt_tokens, dynamic_tokens=dynamic_tokens, lore_chunks=len(lore))
+        if self.backend.system_instruction:
+            return turn
+        return with_character_prompt(character, turn)
+
+    def _coalesce_key(self, character, prompt):
+        if self.single_flight is None or not self.backend.cacheable:
+            return None
+        return self.single_flight.make_key(character, prompt)
+
+    def _generate(self, character, prompt):
+        """(応答, 自分で上流を呼んだか)。相乗りした応答は呼んだ側がキャッシュに入れる"""
+        key = self._coalesce_key(character, prompt)
+        if key is None:
+            return self.backend.generate(character, prompt), True
+        return self.single_flight.generate(key, self.backend.generate, character, prompt)
+
+    def _upstream_stream(self, character, prompt):
+        """(チャンク列, 自分で上流を呼んだか)"""
+        key = self._coalesce_key(character, prompt)
+        if key is None:
+            return self.backend.stream(character, prompt), True
+        return self.single_flight.stream(key, self.backend.stream, character, prompt)
+
+    def _postprocess(self, character, reply, timer):
+        """同期のチェックを済ませた応答を返し、重いチェックはワーカーに回す"""
+        if self.postprocess is None:
+            return reply
+        reply, flags = self.postprocess.apply(character, reply)
+        if flags:
+            timer.annotate(flags=','.join(flags))
+        self.postprocess.submit(character, reply)
+        return reply
+
+    def _fallback(self, character, cache_key):
+        """ブレーカーが開いているときの代わりの応答（履歴・キャッシュには残さない）"""
+        if cache_key:
+            reply = self.response_cache.peek(cache_key)
+            if reply is not None:
+                FALLBACKS.inc(source='cache')
+                return reply
+        FALLBACKS.inc(source='demo')
+        return character.fallback_reply
+
+    def _log(self, started, mode, character, user_message, session_id, reply=None, error=None):
+        record = {
+            "ts": started,
+            "character": character.id,
+            "session_id": session_id,
+            "mode": mode,
+            "message": user_message,
+            "reply": reply,
+            "latency_ms": round((time.time() - started) * 1000, 3),
+        }
+        if error:
+            record["error"] = error
+        self.conversation_log.append(record)
+
+    def reply(self, character, user_message, session_id=None, timer=NULL_TIMER):
+        """応答全体を生成して返す（モデルの例外はそのまま送出する）"""
+        if self.conversation_log is None:
+            return self._reply(character, user_message, session_id, timer)
+        started = time.time()
+        try:
+            reply = self._reply(character, user_message, session_id, timer)
+        except Exception as e:
+            self._log(started, 'json', character, user_message, session_id, error=classify_error(e))
+            raise
+        self._log(started, 'json', character, user_message, session_id, reply)
+        return reply
+
+    def stream(self, character, user_message, session_id=None, timer=NULL_TIMER):
+        """モデルが出力した部分テキストを順に返すジェネレーター（モデルの例外はそのまま送出する）"""
+        if self.conversation_log is None:
+            yield from self._stream(character, user_message, session_id, timer)
+            return
+        started = time.time()
+        parts = []
+        try:
+            for text in self._stream(character, user_message, session_id, timer):
+                parts.append(text)
+                yield text
+        except Exception as e:
+            self._log(started, 'stream', character, user_message, session_id, error=classify_error(e))
+            raise
+        self._log(started, 'stream', character, user_message, session_id, "".join(parts))
+
+    def _reply(self, character, user_message, session_id, timer):
+        with timer.span('prompt'):
+            history = self.sessions.history(session_id, character.id)
+            cache_key = self._cache_key(character, user_message, history)
+            reply = self._cache_get(cache_key)
+            if reply is None:
+                prompt = self._prompt(character, user_message, history, timer)
+        if reply is None:
+            try:
+                with timer.span('upstream'), UPSTREAM_IN_FLIGHT.track():
+                    reply, leader = self._generate(character, prompt)
+            except CircuitOpenError:
+                return self._fallback(character, cache_key)
+            if reply is None:
+                return _blocked_reply(character)
+            with timer.span('postprocess'):
+                reply = self._postprocess(character, reply, timer)
+            if cache_key and leader:
+                self.response_cache.put(cache_key, reply)
+        self.sessions.append(session_id, character.id, user_message, reply)
+        return reply
+
+    def _stream(self, character, user_message, session_id, timer):
+        with timer.span('prompt'):
+            history = self.sessions.history(session_id, character.id)
+            cache_key = self._cache_key(character, user_message, history)
+            cached = self._cache_get(cache_key)
+            if cached is None:
+                prompt = self._prompt(character, user_message, history, timer)
+        if cached is not None:
+            yield cached
+            self.sessions.append(session_id, character.id, user_message, cached)
+            return
+        parts = []
+        checker = self.postprocess.stream_filter(character) if self.postprocess is not None else None
+        with UPSTREAM_IN_FLIGHT.track():
+            chunks, leader = self._upstream_stream(character, prompt)
+            chunks = iter(chunks)
+            while True:
+                # yield 中（クライアントへの書き込み）を除いた上流の時間だけを数える
+                start = time.perf_counter_ns()
+                try:
+                    text = next(chunks, None)
+                except CircuitOpenError:
+                    yield self._fallback(character, cache_key)
+                    return
+                timer.add('upstream', time.perf_counter_ns() - start)
+                if text is None:
+                    break
+                if checker is not None:
+                    start = time.perf_counter_ns()
+                    text = checker.feed(text)
+                    timer.add('postprocess', time.perf_counter_ns() - start)
+                if text:
+                    timer.mark('first_token')
+                    parts.append(text)
+                    yield text
+                if checker is not None and checker.done:
+                    # 長さの上限に達したので、残りは上流から受け取らない
+                    close = getattr(chunks, 'close', None)
+                    if close is not None:
+                        close()
+                    break
+        if checker is not None:
+            tail = checker.finish()
+            if tail:
+                parts.append(tail)
+                yield tail
+            if checker.flags:
+                timer.annotate(flags=','.join(checker.flags))
+        if not parts:
+            yield _blocked_reply(character)
+            return
+        reply = "".join(parts)
+        if checker is not None:
+            self.postprocess.submit(character, reply)
+        if cache_key and leader:
+            self.response_cache.put(cache_key, reply)
+        self.sessions.append(session_id, character.id, user_message, reply)
+
+    def reply_or_apology(self, character, user_message, session_id=None, timer=NULL_TIMER):
+        """エラー時もユーザー向けのメッセージを返す版（chat.py の挙動）"""
+        try:
+            return self.reply(character, user_message, session_id, timer)
+        except Exception as e:
+            # エラー時の応答は履歴に残さない
+            return error_reply(e)
+
+    def stream_or_apology(self, character, user_message, session_id=None, timer=NULL_TIMER):
+        try:
+            yield from self.stream(character, user_message, session_id, timer)
+        except Exception as e:
+            yield error_reply(e)
+
+
+def create_chat_service(model_name, demo_random=False):
+    """環境変数の設定からバックエンドとサービスを組み立てる
+
+    モデルのクライアントは最初の応答まで作らない。CHAT_EAGER_INIT=1 なら起動時に作る
+    （常駐サーバー向け。サーバーレスでは初回POSTやウォームアップのリクエストに任せる）。
+    """
+    service = ChatService(
+        create_resilient_backend(create_backend(model_name, demo_random=demo_random)),
+        sessions=create_session_store(),
+        response_cache=create_response_cache(),
+        conversation_log=create_conversation_log(),
+        lore=create_lore_index(),
+        postprocess=create_postprocessor(),
+        single_flight=create_single_flight(),
+    )
+    if os.getenv("CHAT_EAGER_INIT") == "1":
+        service.warm_up()
+    return service
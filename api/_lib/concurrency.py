@@ -0,0 +1,136 @@
+"""上流（モデル）呼び出しの同時実行数を制限する"""
+import asyncio
+import heapq
+import itertools
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Saturated(Exception):
+    """上流の枠が埋まっていて待ち時間内に空かなかった"""
+
+    def __init__(self, retry_after):
+        super().__init__("upstream is saturated")
+        self.retry_after = retry_after
+
+
+class UpstreamLimiter:
+    """同時実行数の上限付きで同期関数をスレッドプール上で実行する
+
+    枠が空くまで最大 queue_timeout 秒待ち、それでも空かなければ Saturated を送出する。
+    待ち行列はクライアントごとの公平キュー（開始時刻フェアキューイング）で、
+    たくさん投げているクライアントの要求は、少ないクライアントの要求の後ろに並ぶ。
+    """
+
+    def __init__(self, max_concurrent=64, queue_timeout=2.0, retry_after=1, max_clients=50000):
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.max_clients = max_clients
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='upstream')
+        self.in_flight = 0
+        self.waiting = 0
+        self._waiters = []               # (仮想開始時刻, 到着順, future) のヒープ
+        self._finish = OrderedDict()     # クライアント -> 直前の要求の仮想終了時刻
+        self._vtime = 0.0
+        self._order = itertools.count()
+
+    def _tag(self, client):
+        # 仮想時刻の進み具合に対して、そのクライアントが先行している分だけ後ろに回す
+        if client is None:
+            return self._vtime
+        start = max(self._vtime, self._finish.pop(client, 0.0))
+        self._finish[client] = start + 1
+        while len(self._finish) > self.max_clients:
+            self._finish.popitem(last=False)
+        return start
+
+    def _grant(self, tag):
+        self.in_flight += 1
+        self._vtime = max(self._vtime, tag)
+
+    async def acquire(self, client=None):
+        tag = self._tag(client)
+        if self.in_flight < self.max_concurrent and not self._waiters:
+            self._grant(tag)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (tag, next(self._order), future))
+        self.waiting += 1
+        try:
+            await asyncio.wait((future,), timeout=self.queue_timeout)
+        except BaseException:
+            # 待っている間に取り消された（切断など）。枠をもらっていたら返す
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+        finally:
+            self.waiting -= 1
+        if not future.done():
+            future.cancel()
+            raise Saturated(self.retry_after)
+
+    def release(self):
+        self.in_flight -= 1
+        while self._waiters:
+            tag, _, future = heapq.heappop(self._waiters)
+            if not future.cancelled():
+                self._grant(tag)
+                future.set_result(None)
+                return
+
+    def slot(self, client=None):
+        """async with limiter.slot(client): の形で枠を確保する"""
+        return _Slot(self, client)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    async def call(self, func, *args, client=None):
+        """枠を確保したうえで func(*args) をスレッドプールで実行する"""
+        async with self.slot(client):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def iterate(self, iterator):
+        """同期イテレーターを1要素ずつスレッドプールで進める（枠の確保は呼び出し側で行う）"""
+        loop = asyncio.get_running_loop()
+        done = object()
+        while True:
+            item = await loop.run_in_executor(self.executor, next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class _Slot:
+    __slots__ = ('limiter', 'client')
+
+    def __init__(self, limiter, client):
+        self.limiter = limiter
+        self.client = client
+
+    async def __aenter__(self):
+        await self.limiter.acquire(self.client)
+        return self.limiter
+
+    async def __aexit__(self, *exc_info):
+        self.limiter.release()
+
+
+def create_upstream_limiter():
+    """環境変数の設定から上流の同時実行制限を作る"""
+    return UpstreamLimiter(
+        max_concurrent=int(os.getenv("CHAT_MAX_UPSTREAM", "64")),
+        queue_timeout=float(os.getenv("CHAT_QUEUE_TIMEOUT", "2.0")),
+        retry_after=int(os.getenv("CHAT_RETRY_AFTER", "1")),
+    )
@@ -0,0 +1,230 @@
+"""会話ログ（追記専用・セグメント分割）
+
+CHAT_LOG_DIR を設定したときだけ、やり取り（発言・応答・キャラクター・セッション・時刻）を
+ローカルディスクに記録する。リクエスト側はキューに積むだけで、エンコード・書き込み・fsync は
+バックグラウンドのスレッドがまとめて行う。キューがあふれたら書かずに捨てる（待たせない）。
+
+ファイル構成（セグメントごと）:
+
+- segment-00000001.log  レコードの列。1件 = 長さ(4バイト) + CRC32(4バイト) + JSON(UTF-8)
+- segment-00000001.idx  固定長の索引。1件 = オフセット・時刻・キャラクターID・セッションIDのハッシュ
+
+セグメントが CHAT_LOG_SEGMENT_BYTES を超えたら次のファイルに切り替える。
+LogReader は mmap で読み、索引を使ってセッション・キャラクター・時間範囲で絞り込む。
+Vercel ではローカルディスクが一時的なので、常駐サーバー（ASGI版など）での利用を想定している。
+"""
+import atexit
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import deque
+
+from .metrics import Counter
+
+LOG_RECORDS = Counter('chat_log_records_total', 'Conversation log records written')
+LOG_DROPPED = Counter('chat_log_dropped_total', 'Conversation log records dropped because the queue was full')
+
+_HEADER = struct.Struct('<II')             # 長さ, CRC32
+_INDEX = struct.Struct('<Qd16s8s')         # オフセット, 時刻(UNIX秒), キャラクターID, セッションIDのハッシュ
+_SEGMENT_NAME = re.compile(r'^segment-(\d{8})\.log$')
+_NO_SESSION = b'\0' * 8
+
+
+def session_hash(session_id):
+    if not session_id:
+        return _NO_SESSION
+    return hashlib.blake2b(session_id.encode('utf-8'), digest_size=8).digest()
+
+
+def _segment_path(directory, number, suffix):
+    return os.path.join(directory, f'segment-{number:08d}.{suffix}')
+
+
+def _list_segments(directory):
+    numbers = []
+    for name in os.listdir(directory):
+        match = _SEGMENT_NAME.match(name)
+        if match:
+            numbers.append(int(match.group(1)))
+    return sorted(numbers)
+
+
+class ConversationLog:
+    """やり取りを非同期に追記するライター"""
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, flush_interval=1.0, max_pending=100000):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        os.makedirs(directory, exist_ok=True)
+        self._pending = deque()
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        segments = _list_segments(directory)
+        # 再起動時は新しいセグメントから書き始める（途中で切れた末尾に追記しない）
+        self._number = (segments[-1] + 1) if segments else 1
+        self._open_segment()
+        self._thread = threading.Thread(target=self._run, name='conversation-log', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def append(self, record):
+        """1件をキューに積む（リクエスト側で呼ぶ。ディスクには触らない）"""
+        if len(self._pending) >= self.max_pending:
+            LOG_DROPPED.inc()
+            return
+        self._pending.append(record)
+
+    def _open_segment(self):
+        self._log = open(_segment_path(self.directory, self._number, 'log'), 'ab', buffering=1024 * 1024)
+        self._index = open(_segment_path(self.directory, self._number, 'idx'), 'ab', buffering=256 * 1024)
+        self._offset = self._log.tell()
+
+    def _rotate(self):
+        self._sync()
+        self._log.close()
+        self._index.close()
+        self._number += 1
+        self._open_segment()
+
+    def _write(self, record):
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self._log.write(_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self._log.write(payload)
+        self._index.write(_INDEX.pack(
+            self._offset,
+            record.get('ts', 0.0),
+            record.get('character', '').encode('ascii', 'replace')[:16],
+            session_hash(record.get('session_id')),
+        ))
+        self._offset += _HEADER.size + len(payload)
+        if self._offset >= self.segment_bytes:
+            self._rotate()
+
+    def _sync(self):
+        # 索引より先にログ本体を書き出す（索引が指す先が必ず存在するように）
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._index.flush()
+        os.fsync(self._index.fileno())
+
+    def _drain(self):
+        with self._write_lock:
+            written = 0
+            while self._pending:
+                self._write(self._pending.popleft())
+                written += 1
+            if written:
+                self._sync()
+                LOG_RECORDS.inc(written)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._drain()
+
+    def flush(self):
+        """溜まっている分をすぐ書き出す（ツールや終了時用。リクエスト側からは呼ばない）"""
+        self._drain()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self._drain()
+        self._log.close()
+        self._index.close()
+
+
+class LogReader:
+    """会話ログの読み出し（mmap で開き、索引で絞り込む）"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self):
+        return _list_segments(self.directory)
+
+    def _open(self, number, suffix):
+        path = _segment_path(self.directory, number, suffix)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _read_at(buffer, offset):
+        """offset の1件を読む。途中で切れている・壊れている場合は None"""
+        if offset + _HEADER.size > len(buffer):
+            return None, len(buffer)
+        length, crc = _HEADER.unpack_from(buffer, offset)
+        start = offset + _HEADER.size
+        payload = buffer[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return None, len(buffer)
+        return json.loads(payload), start + length
+
+    def scan(self, start=None, end=None):
+        """全レコードを順に返す（索引を使わない一括読み出し）"""
+        for number in self.segments():
+            buffer = self._open(number, 'log')
+            if buffer is None:
+                continue
+            with buffer:
+                offset = 0
+                while offset < len(buffer):
+                    record, offset = self._read_at(buffer, offset)
+                    if record is None:
+                        break
+                    ts = record.get('ts', 0.0)
+                    if (start is None or ts >= start) and (end is None or ts < end):
+                        yield record
+
+    def query(self, session_id=None, character=None, start=None, end=None):
+        """索引で条件に合うレコードだけを読む"""
+        wanted_session = session_hash(session_id) if session_id else None
+        wanted_character = character.encode('ascii', 'replace')[:16].ljust(16, b'\0') if character else None
+        for number in self.segments():
+            index = self._open(number, 'idx')
+            if index is None:
+                continue
+            with index:
+                usable = len(index) - len(index) % _INDEX.size
+                offsets = [
+                    offset for offset, ts, char_id, session in _INDEX.iter_unpack(index[:usable])
+                    if (wanted_session is None or session == wanted_session)
+                    and (wanted_character is None or char_id == wanted_character)
+                    and (start is None or ts >= start) and (end is None or ts < end)
+                ]
+            if not offsets:
+                continue
+            buffer = self._open(number, 'log')
+            if buffer is None:
+                continue
+            with buffer:
+                for offset in offsets:
+                    record, _ = self._read_at(buffer, offset)
+                    # ハッシュの衝突に備えて本体でも確かめる
+                    if record is not None and (session_id is None or record.get('session_id') == session_id):
+                        yield record
+
+
+def create_conversation_log():
+    """CHAT_LOG_DIR が設定されているときだけログを作る（既定は記録しない）"""
+    directory = os.getenv("CHAT_LOG_DIR")
+    if not directory:
+        return None
+    return ConversationLog(
+        directory,
+        segment_bytes=int(os.getenv("CHAT_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024))),
+        flush_interval=float(os.getenv("CHAT_LOG_FLUSH_INTERVAL", "1.0")),
+    )
@@ -0,0 +1,67 @@
+"""BaseHTTPRequestHandler 版のエントリーポイント（chat.py・characters.py）で共通の応答処理
+
+- HTTP/1.1 で応答し、ボディのある応答には必ず Content-Length を付ける（接続を使い回せる）
+- ヘッダーとボディは別々に書くので Nagle を切っておく（切らないと使い回した接続で遅延ACKと噛み合い、
+  2件目以降が約40ms待たされる）
+- ストリーミング（SSE・NDJSON）は長さが決まらないので Connection: close で送り、送り終えたら閉じる
+- リクエストボディは Content-Length を確かめ、上限以内のものだけを読む。不正ならヘッダーを送る前に
+  4xx を返す（エラー時はボディを読み残している可能性があるので接続を閉じる）
+"""
+from http.server import BaseHTTPRequestHandler
+
+from .jsoncodec import dumps
+from .validation import RequestError, check_content_length, parse_json_body
+
+JSON_CONTENT_TYPE = 'application/json; charset=utf-8'
+
+
+class JSONRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def send_body(self, status, body=b'', content_type=JSON_CONTENT_TYPE, headers=None):
+        """ボディを一度に送る（body はエンコード済みのバイト列）"""
+        self.send_response(status)
+        if content_type and body:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if status not in (204, 304):
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def send_json(self, status, obj, headers=None):
+        self.send_body(status, dumps(obj), headers=headers)
+
+    def send_request_error(self, error):
+        self.close_connection = True
+        self.send_json(error.status, {"error": str(error)})
+
+    def start_stream(self, headers):
+        """長さの決まらない応答を始める（送り終えたら接続を閉じる）"""
+        self.close_connection = True
+        self.send_response(200)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def read_json(self):
+        """リクエストボディをJSONオブジェクトとして読む（不正なら RequestError）"""
+        if self.headers.get('Transfer-Encoding'):
+            raise RequestError(411, "Content-Length が必要です。")
+        length = check_content_length(self.headers.get('Content-Length'))
+        body = self.rfile.read(length)
+        if len(body) < length:
+            raise RequestError(400, "リクエストボディが途中で切れています。")
+        return parse_json_body(body)
+
+    def send_options(self, allow_headers):
+        self.send_body(200, headers={
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+            'Access-Control-Allow-Headers': allow_headers,
+        })
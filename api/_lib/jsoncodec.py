@@ -0,0 +1,35 @@
+"""JSONのエンコード・デコード
+
+orjson が入っていればそれを使い、なければ標準ライブラリの json を使う（CHAT_JSON_CODEC=json で
+標準ライブラリに固定）。どちらも dumps は日本語をエスケープしない UTF-8 のバイト列を返し、
+loads は bytes / str を受け取って不正なら ValueError を送出する。
+"""
+import json
+import os
+
+try:
+    if os.getenv("CHAT_JSON_CODEC", "auto") == "json":
+        raise ImportError
+    import orjson
+except ImportError:
+    orjson = None
+
+CODEC = 'orjson' if orjson is not None else 'json'
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj)
+
+    def loads(data):
+        # orjson.JSONDecodeError は ValueError のサブクラス
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj):
+        return _encoder.encode(obj).encode('utf-8')
+
+    def loads(data):
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('utf-8')
+        return json.loads(data)
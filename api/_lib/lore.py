@@ -0,0 +1,325 @@
+"""設定資料（lore）の検索
+
+キャラクター・場所・異変・関係（二人称の例外など）の設定資料を小さな断片に分け、
+ユーザーの発言に関係する断片だけをプロンプトに載せる。資料をいくら増やしても、
+1回のリクエストで送るのは上位 CHAT_LORE_TOP_K 件だけになる。
+
+- 資料: lore_corpus.json（文書ごとに id・title・characters・text）。characters が空なら全キャラクター共通、
+  指定があればそのキャラクターの会話でだけ使う（二人称の例外など）。
+- 検索: 日本語向けの文字 bigram による BM25。CHAT_LORE_VECTOR_WEIGHT > 0 かつ NumPy があれば、
+  n-gram の特徴ハッシュによるベクトルのコサイン類似度も足す（NumPy は使うときだけ読み込む）。
+- 索引: scripts/build_lore_index.py で lore.idx に書き出し、起動時に mmap で開く。
+  索引がない・資料より古い場合は起動時にメモリ上で作り直す。
+"""
+import array
+import bisect
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import unicodedata
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lore_corpus.json')
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lore.idx')
+
+_MAGIC = b'LORE'
+_VERSION = 1
+_PREAMBLE = struct.Struct('<4sII')        # マジック, バージョン, メタデータ(JSON)の長さ
+
+MAX_CHUNK_CHARS = 160
+VECTOR_DIM = 256
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 文字種（ひらがな・カタカナ・漢字・英数字）が続く範囲ごとに n-gram を作る（句読点や文字種の境目はまたがない）
+_RUNS = re.compile(r'[ぁ-ゟ]+|[゠-ヿ]+|[一-鿿々〆]+|[a-z0-9]+')
+# ひらがなの n-gram は助詞や語尾ばかりなので軽く扱う（「こいし」「おくう」のような名前のために捨てはしない）
+HIRAGANA_WEIGHT = 0.3
+# 1文字だけの漢字（「今」「思」など送り仮名の前）も手がかりとしては弱い
+UNIGRAM_WEIGHT = 0.5
+_SENTENCE_END = re.compile(r'(?<=。)')
+
+
+def _normalize(text):
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def tokenize(text):
+    """文字 bigram の列（1文字だけの漢字・カタカナはそのまま、2文字以下のひらがなは助詞として捨てる）"""
+    terms = []
+    for match in _RUNS.finditer(_normalize(text)):
+        run = match.group()
+        if len(run) == 1:
+            if not _is_hiragana(run):
+                terms.append(run)
+        elif len(run) == 2 and _is_hiragana(run):
+            continue
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def _is_hiragana(term):
+    return 'ぁ' <= term[0] <= 'ゟ'
+
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def corpus_digest(path=CORPUS_PATH):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def chunk_documents(documents, max_chars=MAX_CHUNK_CHARS):
+    """文書を段落ごとに分け、長い段落は文の区切りで max_chars 以下にまとめる
+
+    各断片の先頭には文書のタイトルを付ける（断片だけ読んでも何の話か分かるように）。
+    """
+    chunks = []
+    for doc in documents:
+        scope = tuple(doc.get('characters') or ())
+        for paragraph in doc['text'].split('\n\n'):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            current = ''
+            for sentence in _SENTENCE_END.split(paragraph):
+                if current and len(current) + len(sentence) > max_chars:
+                    chunks.append((doc['id'], scope, f"【{doc['title']}】{current}"))
+                    current = ''
+                current += sentence
+            if current:
+                chunks.append((doc['id'], scope, f"【{doc['title']}】{current}"))
+    return chunks
+
+
+def _hashed_vector(terms, dim=VECTOR_DIM):
+    """n-gram の特徴ハッシュ（出現回数の平方根）を L2 正規化したベクトル"""
+    counts = {}
+    for term in terms:
+        counts[term] = counts.get(term, 0) + 1
+    vector = [0.0] * dim
+    for term, count in counts.items():
+        h = term_hash(term)
+        vector[h % dim] += math.sqrt(count) if (h >> 32) & 1 else -math.sqrt(count)
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+def build_index(documents, corpus_sha1=None):
+    """資料から索引のバイト列を作る（同じ資料からは同じバイト列になる）"""
+    chunks = chunk_documents(documents)
+    characters = sorted({c for _, scope, _ in chunks for c in scope})
+    if len(characters) > 32:
+        raise ValueError("characters の種類は32まで")
+    bits = {c: 1 << i for i, c in enumerate(characters)}
+
+    chunk_terms = [tokenize(text) for _, _, text in chunks]
+    avgdl = sum(len(terms) for terms in chunk_terms) / max(len(chunks), 1)
+    postings = {}  # ハッシュ -> [(断片番号, 出現回数)]
+    term_of = {}
+    for doc_id, terms in enumerate(chunk_terms):
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            h = term_hash(term)
+            term_of[h] = term
+            postings.setdefault(h, []).append((doc_id, count))
+
+    terms, starts, docs, weights = array.array('Q'), array.array('I', [0]), array.array('I'), array.array('f')
+    for h in sorted(postings):
+        entries = postings[h]
+        idf = math.log(1 + (len(chunks) - len(entries) + 0.5) / (len(entries) + 0.5))
+        term = term_of[h]
+        if _is_hiragana(term):
+            idf *= HIRAGANA_WEIGHT
+        elif len(term) == 1:
+            idf *= UNIGRAM_WEIGHT
+        for doc_id, tf in entries:
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * len(chunk_terms[doc_id]) / avgdl)
+            docs.append(doc_id)
+            weights.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+        terms.append(h)
+        starts.append(len(docs))
+
+    scopes = array.array('I', (sum(bits[c] for c in scope) for _, scope, _ in chunks))
+    texts = bytearray()
+    text_offsets = array.array('I', [0])
+    for _, _, text in chunks:
+        texts += text.encode('utf-8')
+        text_offsets.append(len(texts))
+    vectors = array.array('f')
+    for chunk in chunk_terms:
+        vectors.extend(_hashed_vector(chunk))
+
+    sections = [('terms', terms), ('starts', starts), ('docs', docs), ('weights', weights),
+                ('scopes', scopes), ('text_offsets', text_offsets), ('texts', texts), ('vectors', vectors)]
+    meta = {
+        "chunks": len(chunks),
+        "sources": [doc_id for doc_id, _, _ in chunks],
+        "characters": characters,
+        "vector_dim": VECTOR_DIM,
+        "byteorder": sys.byteorder,
+        "corpus_sha1": corpus_sha1,
+        "sections": {},
+    }
+    # メタデータの長さがセクションの位置に影響するので、位置が落ち着くまで計算し直す
+    while True:
+        meta_bytes = json.dumps(meta, ensure_ascii=False, sort_keys=True).encode('utf-8')
+        offset = _PREAMBLE.size + len(meta_bytes)
+        layout = {}
+        for name, data in sections:
+            offset += -offset % 8
+            size = len(data) * (data.itemsize if isinstance(data, array.array) else 1)
+            layout[name] = [offset, size]
+            offset += size
+        if layout == meta["sections"]:
+            break
+        meta["sections"] = layout
+
+    out = bytearray(_PREAMBLE.pack(_MAGIC, _VERSION, len(meta_bytes)) + meta_bytes)
+    for name, data in sections:
+        start, _ = layout[name]
+        out += b'\0' * (start - len(out))
+        out += data.tobytes() if isinstance(data, array.array) else data
+    return bytes(out)
+
+
+class LoreIndex:
+    """索引のバイト列（mmap またはメモリ上）を直接引く検索器"""
+
+    def __init__(self, buffer, top_k=3, min_score=2.0, vector_weight=0.0):
+        magic, version, meta_length = _PREAMBLE.unpack_from(buffer, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("設定資料の索引の形式が違います")
+        meta = json.loads(bytes(buffer[_PREAMBLE.size:_PREAMBLE.size + meta_length]))
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError("設定資料の索引のバイト順が違います")
+        self._buffer = buffer
+        self.meta = meta
+        self.top_k = top_k
+        self.min_score = min_score
+        self.chunk_count = meta["chunks"]
+        self.corpus_sha1 = meta["corpus_sha1"]
+        self._bits = {c: 1 << i for i, c in enumerate(meta["characters"])}
+        view = memoryview(buffer)
+        sections = meta["sections"]
+
+        def section(name, fmt):
+            start, size = sections[name]
+            return view[start:start + size].cast(fmt)
+
+        self._terms = section('terms', 'Q')
+        self._starts = section('starts', 'I')
+        self._docs = section('docs', 'I')
+        self._weights = section('weights', 'f')
+        self._scopes = section('scopes', 'I')
+        self._text_offsets = section('text_offsets', 'I')
+        self._texts_start = sections['texts'][0]
+        self._vectors = None
+        self.vector_weight = 0.0
+        if vector_weight > 0:
+            try:
+                import numpy
+            except ImportError:
+                print("NumPy がないため、設定資料の検索は BM25 だけで行います")
+            else:
+                start, size = sections['vectors']
+                dim = meta["vector_dim"]
+                self._vectors = numpy.frombuffer(buffer, dtype=numpy.float32, count=size // 4, offset=start)
+                self._vectors = self._vectors.reshape(-1, dim)
+                self.vector_weight = vector_weight
+
+    def text(self, chunk):
+        start = self._texts_start + self._text_offsets[chunk]
+        end = self._texts_start + self._text_offsets[chunk + 1]
+        return bytes(self._buffer[start:end]).decode('utf-8')
+
+    def scores(self, character_id, message):
+        """{断片番号: スコア}（そのキャラクターが使える断片のうち、スコアが付いたものだけ）"""
+        bit = self._bits.get(character_id, 0)
+        scopes, terms, starts, docs, weights = self._scopes, self._terms, self._starts, self._docs, self._weights
+        query = tokenize(message)
+        scores = {}
+        for term in set(query):
+            h = term_hash(term)
+            i = bisect.bisect_left(terms, h)
+            if i == len(terms) or terms[i] != h:
+                continue
+            for p in range(starts[i], starts[i + 1]):
+                doc = docs[p]
+                scope = scopes[doc]
+                if scope and not scope & bit:
+                    continue
+                scores[doc] = scores.get(doc, 0.0) + weights[p]
+        if self._vectors is not None and query:
+            import numpy
+            similarities = self._vectors @ numpy.asarray(_hashed_vector(query), dtype=numpy.float32)
+            for doc in numpy.flatnonzero(similarities > 0).tolist():
+                scope = scopes[doc]
+                if scope and not scope & bit:
+                    continue
+                scores[doc] = scores.get(doc, 0.0) + self.vector_weight * float(similarities[doc])
+        return scores
+
+    def search(self, character_id, message, k=None):
+        """[(断片番号, スコア)] を上位から返す（min_score 未満は含めない）"""
+        scores = self.scores(character_id, message)
+        ranked = heapq.nlargest(self.top_k if k is None else k, scores.items(), key=lambda item: item[1])
+        return [(doc, score) for doc, score in ranked if score >= self.min_score]
+
+    def retrieve(self, character_id, message, k=None):
+        """プロンプトに載せる断片のテキストを関係の強い順に返す"""
+        return [self.text(doc) for doc, _ in self.search(character_id, message, k)]
+
+
+def write_index(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def load_index(path, **options):
+    with open(path, 'rb') as f:
+        return LoreIndex(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), **options)
+
+
+def create_lore_index():
+    """環境変数の設定から索引を開く（CHAT_LORE=0 なら使わない）"""
+    if os.getenv("CHAT_LORE", "1") == "0":
+        return None
+    options = {
+        "top_k": int(os.getenv("CHAT_LORE_TOP_K", "3")),
+        "min_score": float(os.getenv("CHAT_LORE_MIN_SCORE", "2.0")),
+        "vector_weight": float(os.getenv("CHAT_LORE_VECTOR_WEIGHT", "0")),
+    }
+    path = os.getenv("CHAT_LORE_INDEX", INDEX_PATH)
+    corpus_path = os.getenv("CHAT_LORE_CORPUS", CORPUS_PATH)
+    digest = corpus_digest(corpus_path) if os.path.exists(corpus_path) else None
+    if os.path.exists(path):
+        try:
+            index = load_index(path, **options)
+        except ValueError as e:
+            print(f"設定資料の索引を読めません: {e}")
+        else:
+            if digest is None or index.corpus_sha1 == digest:
+                return index
+            print("設定資料の索引が資料より古いため、メモリ上で作り直します（scripts/build_lore_index.py で更新してください）")
+    if digest is None:
+        print(f"設定資料が見つかりません: {corpus_path}")
+        return None
+    return LoreIndex(build_index(load_corpus(corpus_path), digest), **options)
@@ -0,0 +1,246 @@
+"""軽量なメトリクスとリクエストごとの計測
+
+- Counter / Gauge / Histogram を Prometheus のテキスト形式で出力する（/metrics）
+- RequestTimer でリクエストの各段階（parse・prompt・upstream・write）の時間を測り、
+  終了時にヒストグラムへ記録して1行のJSONログを出す（annotate で付けた値もログに載る）
+
+計測は time.perf_counter_ns と辞書の更新だけなので、リクエストあたりの負荷はごく小さい。
+CHAT_TIMING_LOG=0 でリクエストごとのログ出力を止められる。
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# 秒単位のレイテンシ用バケット
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+TIMING_LOG = os.getenv("CHAT_TIMING_LOG", "1") != "0"
+
+_REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """with の間だけ値を1増やす（同時実行数の計測用）"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [バケットごとの件数..., +Inf の件数, 合計, 件数]
+                state = self._values[key] = [0] * (len(self.buckets) + 3)
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {state[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+def render():
+    """登録済みの全メトリクスを Prometheus のテキスト形式で返す"""
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# --- チャットAPIのメトリクス ---
+REQUESTS = Counter('chat_requests_total', 'Chat requests handled', ('endpoint', 'mode', 'status'))
+ERRORS = Counter('chat_errors_total', 'Chat errors by class', ('error_class',))
+CACHE_LOOKUPS = Counter('chat_cache_lookups_total', 'Response cache lookups', ('result',))
+UPSTREAM_IN_FLIGHT = Gauge('chat_upstream_in_flight', 'Model calls currently in flight')
+REQUEST_SECONDS = Histogram('chat_request_seconds', 'Chat request latency', ('endpoint', 'mode'))
+STAGE_SECONDS = Histogram('chat_stage_seconds', 'Time spent in each request stage', ('stage',))
+PROMPT_TOKENS = Counter('chat_prompt_tokens_total', 'Estimated prompt tokens by part (static character prompt / dynamic turn)', ('character', 'part'))
+UPSTREAM_RETRIES = Counter('chat_upstream_retries_total', 'Upstream calls retried after a transient error')
+UPSTREAM_HEDGES = Counter('chat_upstream_hedges_total', 'Hedged upstream requests by winner', ('winner',))
+BREAKER_OPEN = Gauge('chat_circuit_breaker_open', 'Whether the upstream circuit breaker is open (1) or closed (0)')
+FALLBACKS = Counter('chat_fallbacks_total', 'Replies served without the model while the breaker was open', ('source',))
+
+
+class _Span:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, time.perf_counter_ns() - self.start)
+
+
+class RequestTimer:
+    """1リクエスト分の段階ごとの所要時間"""
+
+    __slots__ = ('endpoint', 'start', 'spans', 'marks', 'fields')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter_ns()
+        self.spans = {}   # 段階名 -> 累計ナノ秒
+        self.marks = {}   # 出来事 -> 開始からのナノ秒（最初のトークンなど）
+        self.fields = {}  # ログに添える値（トークン数など）
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def add(self, name, elapsed_ns):
+        self.spans[name] = self.spans.get(name, 0) + elapsed_ns
+
+    def mark(self, name):
+        self.marks.setdefault(name, time.perf_counter_ns() - self.start)
+
+    def annotate(self, **fields):
+        self.fields.update(fields)
+
+    def finish(self, status=200, mode='json', **fields):
+        """ヒストグラムに記録し、構造化ログを1行出す"""
+        total = time.perf_counter_ns() - self.start
+        REQUESTS.inc(endpoint=self.endpoint, mode=mode, status=status)
+        REQUEST_SECONDS.observe(total / 1e9, endpoint=self.endpoint, mode=mode)
+        for name, elapsed in self.spans.items():
+            STAGE_SECONDS.observe(elapsed / 1e9, stage=name)
+        if TIMING_LOG:
+            record = {
+                "event": "chat_request",
+                "endpoint": self.endpoint,
+                "mode": mode,
+                "status": status,
+                "total_ms": round(total / 1e6, 3),
+                "spans_ms": {name: round(elapsed / 1e6, 3) for name, elapsed in self.spans.items()},
+                **{f"{name}_ms": round(offset / 1e6, 3) for name, offset in self.marks.items()},
+                **self.fields,
+                **fields,
+            }
+            print(json.dumps(record, ensure_ascii=False), flush=True)
+
+
+class _NullTimer:
+    """計測しないときに渡すダミー"""
+
+    __slots__ = ()
+
+    def span(self, name):
+        return _NULL_SPAN
+
+    def add(self, name, elapsed_ns):
+        pass
+
+    def mark(self, name):
+        pass
+
+    def annotate(self, **fields):
+        pass
+
+    def finish(self, *args, **kwargs):
+        pass
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+NULL_TIMER = _NullTimer()
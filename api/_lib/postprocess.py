@@ -0,0 +1,274 @@
+"""モデル出力の後処理（禁止語・口調・長さのチェック）
+
+キャラクターのプロンプトにある【禁止事項】を、応答の側でも確かめる。
+
+- 同期で行う軽いチェック（数マイクロ秒）
+  - 禁止語: 1本にまとめた正規表現で探し、見つかったら伏せる。「死ねない」「殺すなんて」のような
+    無害な言い回しを伏せないよう、命令・脅しとして文が切れる形（後ろが句読点・終助詞・文末）だけに当てる
+  - 長さ: キャラクターごとの上限を超えたら文の区切りで切る
+  - 口調: キャラクターごとの規則（魔理沙の敬語・咲夜の俗語など）に当たったら記録だけする
+- 非同期で行う重いチェック（繰り返し・日本語以外の割合など）は、応答を返した後にワーカーで実行し、
+  結果はメトリクスとログに残す（応答は書き換えない）
+
+ストリーミングでは StreamFilter がチャンクごとに同じチェックを行う。チャンクの境目をまたぐ禁止語に備えて、
+末尾の数文字（禁止語と、その後ろの文脈の分）だけ次のチャンクまで持ち越す。チェックは PostProcessor に関数を追加して差し替えられる。
+"""
+import os
+import re
+import threading
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import Counter
+
+POSTPROCESS_FLAGS = Counter(
+    'chat_postprocess_flags_total', 'Replies flagged by post-processing checks', ('character', 'rule'))
+POSTPROCESS_DROPPED = Counter(
+    'chat_postprocess_dropped_total', 'Background checks skipped because the queue was full')
+
+# 禁止語の後ろがこれなら、命令・脅しとして言い切っている（「死ねない」「殺すなんて」「殺すわけ」は当てない）
+_THREAT_END = r'(?=[。．！!？?…、」』〜ー\s]|[ぞぜよ]|わ(?!け)|$)'
+
+# 全キャラクター共通の禁止語（プロンプトの「殺す」「死ね」などの過激な発言）。長いものを先に書く
+BANNED_PATTERNS = (
+    'ぶっ殺',
+    '殺してやる',
+    '殺すぞ',
+    '殺す' + _THREAT_END,
+    '死ね' + _THREAT_END,
+    'くたばれ' + _THREAT_END,
+)
+# ストリームで持ち越す文字数（最長の語5文字＋後ろの文脈2文字）
+BANNED_HOLD = 7
+MASK = '……'
+
+_SLANG = r'マジで|ヤバ[いすかー]|ウケる|w{2,}|ｗ{2,}|（笑）'
+_ROUGH = r'てめえ|うるせえ|ぶっ飛ばす|ふざけんな'
+
+Style = namedtuple('Style', ['max_chars', 'rules'])
+
+# キャラクターごとの口調の規則（記録だけで書き換えない）と応答の長さの上限
+STYLES = {
+    'reimu': Style(400, {'rough': _ROUGH, 'keigo': r'でございます|いたします|させていただ'}),
+    'marisa': Style(400, {'keigo': r'(?:です|ます|ございます)(?=[。！？!?、…]|$)'}),
+    'sakuya': Style(400, {'slang': _SLANG, 'rough': _ROUGH}),
+    'yuyuko': Style(500, {'slang': _SLANG, 'rough': _ROUGH}),
+    'meiling': Style(500, {'rough': _ROUGH}),
+    'remilia': Style(500, {'slang': _SLANG, 'humble': r'申し訳ございません|恐縮です'}),
+    'koishi': Style(500, {'logical': r'したがって|結論として|論理的に'}),
+}
+DEFAULT_STYLE = Style(500, {'rough': _ROUGH})
+
+_SENTENCE_END = re.compile(r'[。！？!?」]')
+
+
+def compile_patterns(patterns):
+    """正規表現の一覧を1本にまとめる（書いた順に試す）"""
+    return re.compile('|'.join(f'(?:{p})' for p in patterns))
+
+
+def phrase_patterns(phrases):
+    """語句の一覧を正規表現にする（長いものを先に試す）"""
+    return tuple(re.escape(p) for p in sorted(set(phrases), key=len, reverse=True))
+
+
+def compile_rules(rules):
+    """{規則名: パターン} を名前付きグループ1本の正規表現にまとめる"""
+    return re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern in rules.items()))
+
+
+def truncate(text, limit):
+    """limit 文字以内で最後の文の区切りまでに切る（区切りがなければ limit で切る）"""
+    if len(text) <= limit:
+        return text
+    head = text[:limit]
+    ends = [m.end() for m in _SENTENCE_END.finditer(head)]
+    # 区切りが前半にしかないときは、切りすぎないよう limit で切る
+    if ends and ends[-1] >= limit // 2:
+        return head[:ends[-1]]
+    return head + MASK
+
+
+def check_repetition(character_id, text):
+    """同じ言い回しの繰り返し（zlib で縮みすぎる応答）"""
+    if len(text) >= 80 and len(zlib.compress(text.encode('utf-8'))) < len(text.encode('utf-8')) * 0.3:
+        return ['repetition']
+    return []
+
+
+def check_non_japanese(character_id, text):
+    """日本語以外（英字）が大半を占める応答"""
+    if len(text) >= 40:
+        ascii_letters = sum(1 for ch in text if ch.isascii() and ch.isalpha())
+        if ascii_letters > len(text) * 0.5:
+            return ['non_japanese']
+    return []
+
+
+BACKGROUND_CHECKS = (check_repetition, check_non_japanese)
+
+
+def record_flags(character_id, flags):
+    # 同期のチェックの結果はリクエストの計測ログ（flags）にも載る
+    for rule in flags:
+        POSTPROCESS_FLAGS.inc(character=character_id, rule=rule)
+
+
+class PostProcessor:
+    def __init__(self, banned=BANNED_PATTERNS, styles=STYLES, background_checks=BACKGROUND_CHECKS,
+                 workers=2, max_pending=1000, hold=BANNED_HOLD):
+        self._banned = compile_patterns(banned)
+        # 禁止語（と後ろの文脈）がチャンクの境目をまたいでも判定できるよう、ストリームでこの文字数を持ち越す
+        self.hold = hold
+        self._styles = {character_id: (style.max_chars, compile_rules(style.rules))
+                        for character_id, style in styles.items()}
+        self._default_style = (DEFAULT_STYLE.max_chars, compile_rules(DEFAULT_STYLE.rules))
+        self.background_checks = list(background_checks)
+        self.max_pending = max_pending
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='postprocess')
+
+    def style(self, character_id):
+        """(長さの上限, 口調の規則の正規表現)"""
+        return self._styles.get(character_id, self._default_style)
+
+    def mask(self, text, end=None):
+        """禁止語を伏せる。(伏せた後のテキスト, 伏せたか)
+
+        end を指定すると text[:end] を返す（後ろの文脈は text 全体で判定する）。
+        """
+        if end is None:
+            masked, count = self._banned.subn(MASK, text)
+            return masked, count > 0
+        parts = []
+        position = 0
+        for match in self._banned.finditer(text):
+            if match.end() > end:
+                break
+            parts.append(text[position:match.start()])
+            parts.append(MASK)
+            position = match.end()
+        parts.append(text[position:end])
+        return ''.join(parts), position > 0
+
+    def style_flags(self, character_id, text):
+        _, rules = self.style(character_id)
+        return sorted({m.lastgroup for m in rules.finditer(text)})
+
+    def apply(self, character, text):
+        """同期のチェックを行い、(書き換えた応答, フラグのリスト) を返す"""
+        flags = []
+        text, masked = self.mask(text)
+        if masked:
+            flags.append('banned')
+        max_chars, _ = self.style(character.id)
+        if len(text) > max_chars:
+            text = truncate(text, max_chars)
+            flags.append('length')
+        flags.extend(self.style_flags(character.id, text))
+        record_flags(character.id, flags)
+        return text, flags
+
+    def stream_filter(self, character):
+        return StreamFilter(self, character)
+
+    def submit(self, character, text):
+        """重いチェックをワーカーに回す（キューがあふれていたら諦める）"""
+        if not self.background_checks:
+            return
+        with self._lock:
+            if self._pending >= self.max_pending:
+                POSTPROCESS_DROPPED.inc()
+                return
+            self._pending += 1
+        self._executor.submit(self._run_background, character.id, text)
+
+    def _run_background(self, character_id, text):
+        try:
+            flags = []
+            for check in self.background_checks:
+                try:
+                    flags.extend(check(character_id, text))
+                except Exception as e:
+                    print(f"応答チェックのエラー（{getattr(check, '__name__', check)}）: {e}")
+            record_flags(character_id, flags)
+            if flags:
+                print(f"応答チェック: {character_id} {','.join(flags)}")
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+
+class StreamFilter:
+    """ストリーミング応答をチャンクごとにチェックする
+
+    feed() は送ってよい部分を返す（禁止語の判定のため末尾を少し持ち越す）。
+    長さの上限に達したら done が True になり、以降のチャンクは捨てる。最後に finish() を呼ぶ。
+    """
+
+    def __init__(self, processor, character):
+        self.processor = processor
+        self.character = character
+        self.remaining, _ = processor.style(character.id)
+        self.done = False
+        self.flags = []
+        self._carry = ''
+        self._sent = []
+
+    def feed(self, text):
+        if self.done:
+            return ''
+        text = self._carry + text
+        cut = max(len(text) - self.processor.hold, 0)
+        # 持ち越す部分にまたがる禁止語は、その語の終わりまで送る側に含める
+        for match in self.processor._banned.finditer(text):
+            if match.start() < cut < match.end():
+                cut = match.end()
+        self._carry = text[cut:]
+        return self._emit(*self.processor.mask(text, cut))
+
+    def _emit(self, text, masked):
+        if not text:
+            return ''
+        if masked and 'banned' not in self.flags:
+            self.flags.append('banned')
+        if len(text) > self.remaining:
+            text = truncate(text, self.remaining)
+            self.flags.append('length')
+            self.done = True
+            self._carry = ''
+        self.remaining -= len(text)
+        self._sent.append(text)
+        return text
+
+    def finish(self):
+        """持ち越していた末尾を返し、口調のチェックと記録を行う"""
+        tail = self._emit(*self.processor.mask(self._carry))
+        self._carry = ''
+        self.flags.extend(self.processor.style_flags(self.character.id, self.text))
+        record_flags(self.character.id, self.flags)
+        return tail
+
+    @property
+    def text(self):
+        return ''.join(self._sent)
+
+
+def create_postprocessor():
+    """環境変数の設定から後処理を作る（CHAT_POSTPROCESS=0 なら使わない）"""
+    if os.getenv("CHAT_POSTPROCESS", "1") == "0":
+        return None
+    banned, hold = BANNED_PATTERNS, BANNED_HOLD
+    extra = [p.strip() for p in os.getenv("CHAT_BANNED_PHRASES", "").split(',') if p.strip()]
+    if extra:
+        # 追加の語は文脈を問わず伏せる
+        banned = phrase_patterns(extra) + banned
+        hold = max(hold, max(len(p) for p in extra))
+    return PostProcessor(
+        banned=banned,
+        hold=hold,
+        workers=int(os.getenv("CHAT_POSTPROCESS_WORKERS", "2")),
+        max_pending=int(os.getenv("CHAT_POSTPROCESS_MAX_PENDING", "1000")),
+    )
@@ -0,0 +1,27 @@
+"""モデルに送るプロンプトの組み立て
+
+キャラクターのプロンプト（毎回同じ固定部分）と、履歴・ユーザー発言（リクエストごとに変わる部分）を分けて作る。
+system_instruction に対応したバックエンドには固定部分を指示として別に渡す（毎回送られるのは同じ）。
+設定資料（lore.py）から引いた断片は、発言ごとに変わる部分として会話の前に置く。
+"""
+
+
+def build_turn_prompt(character, user_message, history=(), lore=()):
+    """設定資料の断片・履歴・ユーザー発言のプロンプト（キャラクターのプロンプトは含めない）"""
+    parts = []
+    if lore:
+        parts.append("関係する設定：\n" + "\n".join(f"- {text}" for text in lore))
+    if history:
+        lines = [
+            f"ユーザー: {text}" if role == 'user' else f"{character.name}: {text}"
+            for role, text in history
+        ]
+        parts.append("これまでの会話：\n" + "\n".join(lines))
+    parts.append(f"ユーザー: {user_message}")
+    parts.append("キャラクターとして自然に応答してください。")
+    return "\n\n".join(parts)
+
+
+def with_character_prompt(character, turn_prompt):
+    """会話部分の前にキャラクターのプロンプトを付ける（system_instruction を使わない場合）"""
+    return character.prompt + "\n\n" + turn_prompt
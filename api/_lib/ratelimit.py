@@ -0,0 +1,197 @@
+"""クライアントごとのレート制限と利用量の集計
+
+トークンバケットで次の3段階の予算を確認し、どれか1つでも足りなければ断る。
+
+- クライアント（登録済みのAPIキー、なければIP）ごと
+- キャラクターごと（全クライアントの合計）
+- 全体（既定で有効。クライアントのキーを偽っても全体の上限は超えられない）
+
+クライアントの識別はリクエスト側で自由に変えられる値を信用しない。
+
+- APIキー（X-API-Key / Authorization: Bearer）は CHAT_API_KEYS（カンマ区切り）に登録したものだけを使う。
+  未登録のキーは無視してIPで数える（ランダムなキーを付けても新しいバケットにはならない）
+- X-Forwarded-For は、接続元が CHAT_TRUSTED_PROXIES（カンマ区切りのアドレス）に含まれるときだけ読み、
+  右から見て最初の信頼できないアドレスを送り主とする。'*' なら接続元を問わず信頼する
+  （前段のプロキシが X-Forwarded-For を上書きする環境向け。Vercel 上ではこれが既定）
+
+クライアントの状態は件数上限付きのLRUで持つので、数万のキーが来てもメモリは一定に収まる。
+追い出されるのは長く使われていないキーなので、バケットは満タンに戻っているのと同じ扱いでよい。
+プロセス内の制限なので、Vercel ではインスタンスごとの上限になる。
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import Counter
+from .sessions import estimate_tokens
+
+RATE_LIMITED = Counter('chat_rate_limited_total', 'Requests rejected by the rate limiter', ('scope',))
+
+
+def _hash_key(api_key):
+    # キーそのものはメモリにもログにも残さない
+    return hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+def _split_env(name, default=''):
+    return frozenset(value.strip() for value in os.getenv(name, default).split(',') if value.strip())
+
+
+# 登録済みAPIキーのハッシュ
+API_KEY_HASHES = frozenset(_hash_key(key) for key in _split_env("CHAT_API_KEYS"))
+# X-Forwarded-For を信頼する接続元（Vercel では前段が上書きするので既定で信頼する）
+TRUSTED_PROXIES = _split_env("CHAT_TRUSTED_PROXIES", '*' if os.getenv("VERCEL") else '')
+
+
+def client_key(headers, remote_addr=None, api_key_hashes=None, trusted_proxies=None):
+    """リクエストの送り主を表すキー。登録済みのAPIキーならそのハッシュ、なければIP"""
+    api_key_hashes = API_KEY_HASHES if api_key_hashes is None else api_key_hashes
+    trusted_proxies = TRUSTED_PROXIES if trusted_proxies is None else trusted_proxies
+    api_key = headers.get('X-API-Key') or ''
+    authorization = headers.get('Authorization') or ''
+    if not api_key and authorization.lower().startswith('bearer '):
+        api_key = authorization[7:].strip()
+    if api_key and api_key_hashes:
+        hashed = _hash_key(api_key)
+        if hashed in api_key_hashes:
+            return 'key:' + hashed
+    address = remote_addr
+    if '*' in trusted_proxies or remote_addr in trusted_proxies:
+        # 右端から、信頼するプロキシ自身のアドレスを飛ばしていく
+        for hop in reversed((headers.get('X-Forwarded-For') or '').split(',')):
+            hop = hop.strip()
+            if not hop:
+                continue
+            address = hop
+            if hop not in trusted_proxies:
+                break
+    return 'ip:' + (address or 'unknown')
+
+
+class _Bucket:
+    """トークンバケット1つ分の状態と利用量"""
+
+    __slots__ = ('tokens', 'updated', 'requests', 'est_tokens', 'limited')
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.updated = now
+        self.requests = 0
+        self.est_tokens = 0
+        self.limited = 0
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(float(burst), self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait_time(self, rate, cost=1):
+        """cost 分のトークンがたまるまでの秒数（足りていれば0）"""
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / rate
+
+    def usage(self):
+        return {"requests": self.requests, "tokens": self.est_tokens, "limited": self.limited}
+
+
+class RateLimiter:
+    """クライアント・キャラクター・全体のトークンバケット
+
+    rate は1秒あたりの補充量、burst はバケットの容量。rate が 0 の段階は制限しない。
+    """
+
+    def __init__(self, client_rate, client_burst, character_rate=0.0, character_burst=0,
+                 global_rate=0.0, global_burst=0, max_keys=50000):
+        self.limits = {
+            'client': (client_rate, client_burst),
+            'character': (character_rate, character_burst),
+            'global': (global_rate, global_burst),
+        }
+        self.max_keys = max_keys
+        self._clients = OrderedDict()  # クライアントキー -> _Bucket（LRU）
+        self._characters = {}
+        now = time.monotonic()
+        self._global = _Bucket(global_burst, now)
+        self._lock = threading.Lock()
+
+    def _client_bucket(self, key, now):
+        bucket = self._clients.get(key)
+        if bucket is None:
+            bucket = self._clients[key] = _Bucket(self.limits['client'][1], now)
+            while len(self._clients) > self.max_keys:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(key)
+        return bucket
+
+    def acquire(self, key, character_id):
+        """1リクエスト分の予算を取る。取れたら 0、足りなければ待つべき秒数を返す"""
+        now = time.monotonic()
+        with self._lock:
+            character = self._characters.get(character_id)
+            if character is None:
+                character = self._characters[character_id] = _Bucket(self.limits['character'][1], now)
+            buckets = (
+                ('client', self._client_bucket(key, now)),
+                ('character', character),
+                ('global', self._global),
+            )
+            # すべての段階で足りることを確かめてから取る（一部だけ減らさない）
+            for scope, bucket in buckets:
+                rate, burst = self.limits[scope]
+                if rate <= 0:
+                    continue
+                bucket.refill(rate, burst, now)
+                wait = bucket.wait_time(rate)
+                if wait > 0:
+                    buckets[0][1].limited += 1
+                    RATE_LIMITED.inc(scope=scope)
+                    return wait
+            for scope, bucket in buckets:
+                if self.limits[scope][0] > 0:
+                    bucket.tokens -= 1
+                bucket.requests += 1
+            return 0.0
+
+    def record_tokens(self, key, character_id, tokens):
+        """応答後に推定トークン数を利用量に加える"""
+        now = time.monotonic()
+        with self._lock:
+            for bucket in (self._client_bucket(key, now), self._characters.get(character_id), self._global):
+                if bucket is not None:
+                    bucket.est_tokens += tokens
+
+    def record_exchange(self, key, character_id, message, reply):
+        """1往復（発言と応答）分の推定トークン数を利用量に加える"""
+        self.record_tokens(key, character_id, estimate_tokens(str(message)) + estimate_tokens(reply or ''))
+
+    def usage(self, key=None):
+        """利用量。key を指定するとそのクライアントの分も含める"""
+        with self._lock:
+            result = {
+                "global": self._global.usage(),
+                "characters": {cid: bucket.usage() for cid, bucket in self._characters.items()},
+                "tracked_clients": len(self._clients),
+            }
+            if key is not None:
+                bucket = self._clients.get(key)
+                result["client"] = bucket.usage() if bucket else _Bucket(0, 0).usage()
+        return result
+
+
+def create_rate_limiter():
+    """環境変数の設定からレート制限を作る。CHAT_RATE_PER_MINUTE=0 なら None（制限なし）"""
+    per_minute = float(os.getenv("CHAT_RATE_PER_MINUTE", "30"))
+    if per_minute <= 0:
+        return None
+    return RateLimiter(
+        client_rate=per_minute / 60,
+        client_burst=int(os.getenv("CHAT_RATE_BURST", "10")),
+        character_rate=float(os.getenv("CHAT_RATE_CHARACTER_PER_MINUTE", "0")) / 60,
+        character_burst=int(os.getenv("CHAT_RATE_CHARACTER_BURST", "30")),
+        global_rate=float(os.getenv("CHAT_RATE_GLOBAL_PER_MINUTE", "300")) / 60,
+        global_burst=int(os.getenv("CHAT_RATE_GLOBAL_BURST", "60")),
+        max_keys=int(os.getenv("CHAT_RATE_MAX_KEYS", "50000")),
+    )
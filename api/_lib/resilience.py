@@ -0,0 +1,275 @@
+"""上流（モデル）呼び出しの耐障害性
+
+ResilientBackend はモデルバックエンドを包み、次の処理を加える。
+
+- リクエストごとの期限（CHAT_UPSTREAM_DEADLINE 秒）。超えたら DeadlineExceeded
+- 一時的なエラー（通信・タイムアウト・5xx）へのジッター付き指数バックオフでの再試行
+- ヘッジ（CHAT_HEDGE=1）：直近の p95 を過ぎても応答がなければ2本目を投げ、早い方を採用
+- サーキットブレーカー：連続して失敗したら一定時間は上流を呼ばずに CircuitOpenError
+- 期限切れやヘッジの決着で不要になった呼び出しは、まだ始まっていなければ取り消す。
+  呼び出し待ちは CHAT_UPSTREAM_MAX_QUEUE 件までで、あふれたら UpstreamQueueFull（上流が詰まっている間に
+  呼び出しを積み上げて、呼び出し元が諦めた後で上流を叩かないように）
+
+ストリーミングは最初のチャンクが届くまでを期限・再試行の対象にする（途中からはやり直せない）。
+"""
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .metrics import BREAKER_OPEN, UPSTREAM_HEDGES, UPSTREAM_RETRIES
+
+
+# 再試行する価値のある一時的なエラーの目印
+_TRANSIENT = re.compile(r'\b(?:500|502|503|504)\b|network|connection|timeout|unavailable')
+
+
+class DeadlineExceeded(TimeoutError):
+    """期限内に上流から応答がなかった"""
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため上流を呼ばなかった"""
+
+
+class UpstreamQueueFull(CircuitOpenError):
+    """上流呼び出しの待ち行列が埋まっているため呼ばなかった（ブレーカーが開いているときと同じく代わりの応答を返す）"""
+
+
+def is_transient(e):
+    """再試行する価値のある一時的なエラーか"""
+    if isinstance(e, (TimeoutError, ConnectionError)):
+        return True
+    return _TRANSIENT.search(str(e).lower()) is not None
+
+
+class CircuitBreaker:
+    """連続失敗で開き、reset_timeout 秒後に1件だけ試して閉じるか判断する"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial_in_flight:
+                # 半開状態では1件だけ通して様子を見る
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+        BREAKER_OPEN.set(0)
+
+    def release(self):
+        """成否を判断せずに終わった呼び出しの試行枠を返す（半開状態で次の1件を通せるように）"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                opened = True
+            else:
+                opened = False
+        if opened:
+            BREAKER_OPEN.set(1)
+
+
+class LatencyWindow:
+    """直近の所要時間からパーセンタイルを求める（ヘッジの待ち時間用）"""
+
+    def __init__(self, size=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, p):
+        samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class ResilientBackend:
+    """ModelBackend を包んで期限・再試行・ヘッジ・サーキットブレーカーを加える"""
+
+    def __init__(self, backend, deadline=30.0, max_retries=2, backoff_base=0.2, backoff_cap=2.0,
+                 hedge=False, hedge_percentile=95, breaker=None, workers=64, max_queue=64):
+        self.backend = backend
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = LatencyWindow()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upstream-call')
+        # 実行中と待ちを合わせた呼び出しの上限（取り消し・完了で空く）
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+
+    # ChatService からは元のバックエンドと同じに見えるようにする
+    @property
+    def name(self):
+        return self.backend.name
+
+    @property
+    def cacheable(self):
+        return self.backend.cacheable
+
+    @property
+    def system_instruction(self):
+        return self.backend.system_instruction
+
+    def count_tokens(self, character, prompt):
+        return self.backend.count_tokens(character, prompt)
+
+    def warm_up(self):
+        self.backend.warm_up()
+
+    def _backoff(self, attempt):
+        # フルジッター: 0 〜 min(cap, base * 2^attempt) の一様乱数
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def _with_retries(self, attempt_once):
+        """attempt_once(期限の残り秒数) を再試行付きで呼ぶ"""
+        if not self.breaker.allow():
+            raise CircuitOpenError("upstream circuit breaker is open")
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                result = attempt_once(deadline - time.monotonic())
+            except UpstreamQueueFull:
+                # こちら側の待ち行列があふれただけで、上流の失敗ではないのでブレーカーには数えない
+                self.breaker.release()
+                raise
+            except Exception as e:
+                delay = self._backoff(attempt)
+                retryable = is_transient(e) and attempt < self.max_retries
+                if not retryable or time.monotonic() + delay >= deadline:
+                    self.breaker.record_failure()
+                    raise
+                UPSTREAM_RETRIES.inc()
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    def _submit(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise UpstreamQueueFull("upstream call queue is full")
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    @staticmethod
+    def _cancel(futures):
+        # まだ始まっていない呼び出しだけが取り消せる（始まったものは終わるまで走る）
+        for future in futures:
+            future.cancel()
+
+    def _call(self, func, timeout):
+        future = self._submit(func)
+        done, _ = wait([future], timeout=max(timeout, 0))
+        if not done:
+            self._cancel([future])
+            raise DeadlineExceeded("upstream deadline exceeded")
+        return future.result()
+
+    def _generate_once(self, character, prompt, timeout):
+        start = time.monotonic()
+        primary = self._submit(self.backend.generate, character, prompt)
+        pending = [primary]
+        hedge_delay = self.latencies.percentile(self.hedge_percentile) if self.hedge else None
+        if hedge_delay is not None and hedge_delay < timeout:
+            done, _ = wait(pending, timeout=hedge_delay)
+            if not done:
+                try:
+                    pending.append(self._submit(self.backend.generate, character, prompt))
+                except UpstreamQueueFull:
+                    pass  # ヘッジは諦めて1本目を待つ
+        hedged = len(pending) > 1
+        while True:
+            remaining = timeout - (time.monotonic() - start)
+            done, _ = wait(pending, timeout=max(remaining, 0), return_when=FIRST_COMPLETED)
+            if not done:
+                self._cancel(pending)
+                raise DeadlineExceeded("upstream deadline exceeded")
+            future = done.pop()
+            pending.remove(future)
+            # 片方が失敗しても、もう片方が残っていればその結果を待つ
+            if future.exception() is not None and pending:
+                continue
+            self._cancel(pending)
+            result = future.result()
+            if hedged:
+                UPSTREAM_HEDGES.inc(winner='primary' if future is primary else 'hedge')
+            self.latencies.add(time.monotonic() - start)
+            return result
+
+    def generate(self, character, prompt):
+        return self._with_retries(lambda timeout: self._generate_once(character, prompt, timeout))
+
+    def stream(self, character, prompt):
+        def first_chunk(timeout):
+            chunks = iter(self.backend.stream(character, prompt))
+            return chunks, self._call(lambda: next(chunks, None), timeout)
+
+        chunks, first = self._with_retries(first_chunk)
+        if first is None:
+            return
+        yield first
+        yield from chunks
+
+
+def create_resilient_backend(backend):
+    """環境変数の設定で backend を包む（デモは上流がないので包まない）"""
+    if backend.name == 'demo':
+        return backend
+    return ResilientBackend(
+        backend,
+        deadline=float(os.getenv("CHAT_UPSTREAM_DEADLINE", "30")),
+        max_retries=int(os.getenv("CHAT_UPSTREAM_RETRIES", "2")),
+        backoff_base=float(os.getenv("CHAT_UPSTREAM_BACKOFF", "0.2")),
+        hedge=os.getenv("CHAT_HEDGE") == "1",
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv("CHAT_BREAKER_THRESHOLD", "5")),
+            reset_timeout=float(os.getenv("CHAT_BREAKER_RESET", "30")),
+        ),
+        workers=int(os.getenv("CHAT_UPSTREAM_WORKERS", "64")),
+        max_queue=int(os.getenv("CHAT_UPSTREAM_MAX_QUEUE", "64")),
+    )
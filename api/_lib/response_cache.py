@@ -0,0 +1,103 @@
+"""よくある定型メッセージへの応答キャッシュ
+
+（キャラクター, プロンプトのバージョン, 正規化したメッセージ）をキーにモデルの応答を保持し、
+同じ挨拶などでGeminiを呼び直さないようにする。件数上限とTTLで追い出し、
+variants > 1 の場合はキーごとに複数の応答を貯めてランダムに返す。同じ応答が返ってきた回数も
+variants に数えるので、いつも同じことを言うモデルでも variants 回でキャッシュが効き始める。
+"""
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# 空白と記号（句読点・！？・〜 など）は無視する
+_IGNORED = re.compile(r'[\s\W_ー〜～]+')
+
+
+def normalize_message(message):
+    """NFKC正規化し、大文字小文字・空白・記号の違いを吸収する"""
+    text = unicodedata.normalize('NFKC', message).casefold()
+    return _IGNORED.sub('', text)
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, ttl=3600.0, variants=1):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> [作成時刻, [応答, ...], 受け取った応答の数]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(character, message):
+        normalized = normalize_message(message)
+        if not normalized:
+            return None
+        return (character.id, character.prompt_version, normalized)
+
+    def get(self, key):
+        """キャッシュ済みの応答を返す。応答を variants 回受け取るまでは None（上流で新しい応答を作る）"""
+        if key is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None or entry[2] < self.variants:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            replies = entry[1]
+        return replies[0] if len(replies) == 1 else random.choice(replies)
+
+    def peek(self, key):
+        """期限切れ・variants 未満でも保持している応答があれば返す（上流が使えないときの代替用）"""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            replies = list(entry[1]) if entry is not None else None
+        return random.choice(replies) if replies else None
+
+    def put(self, key, reply):
+        if key is None or not reply:
+            return
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[0] > self.ttl:
+                self._entries[key] = [now, [reply], 1]
+            elif entry[2] < self.variants:
+                # 重複した応答は貯めないが、回数には数える
+                entry[2] += 1
+                if reply not in entry[1]:
+                    entry[1].append(reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def create_response_cache():
+    """CHAT_RESPONSE_CACHE=1 のときだけキャッシュを作る（既定は無効）"""
+    if os.getenv("CHAT_RESPONSE_CACHE") != "1":
+        return None
+    return ResponseCache(
+        max_entries=int(os.getenv("CHAT_RESPONSE_CACHE_SIZE", "1024")),
+        ttl=float(os.getenv("CHAT_RESPONSE_CACHE_TTL", "3600")),
+        variants=int(os.getenv("CHAT_RESPONSE_CACHE_VARIANTS", "1")),
+    )
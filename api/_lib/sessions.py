@@ -0,0 +1,193 @@
+"""サーバー側の会話セッション管理
+
+セッションIDごとに直近の会話をリングバッファで保持し、プロンプトに載せる履歴を
+トークン予算内に収める。セッションはLRU＋TTLで追い出し、1セッションあたりの
+メモリ使用量にも上限を設ける。保存先はバックエンドとして差し替えられる。
+"""
+import importlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+# セッションIDとして受け付ける最大長
+MAX_SESSION_ID_LENGTH = 128
+
+
+def estimate_tokens(text):
+    """トークン数の概算（日本語はおよそ1文字1トークン、ASCIIは4文字1トークン）"""
+    ascii_chars = sum(1 for ch in text if ch < '\x80')
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def normalize_session_id(value):
+    """有効なセッションIDならそのまま、そうでなければ None を返す"""
+    if isinstance(value, str) and 0 < len(value) <= MAX_SESSION_ID_LENGTH and value.isprintable():
+        return value
+    return None
+
+
+class Session:
+    """1セッション分の会話履歴（古いターンから捨てるリングバッファ）"""
+
+    __slots__ = ('turns', 'nbytes', 'last_access')
+
+    # 1ターン（タプル＋要素）の固定オーバーヘッド
+    _TURN_OVERHEAD = sys.getsizeof(('user', '', 0)) + sys.getsizeof(0)
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)  # (role, text, tokens)
+        self.nbytes = 0
+        self.last_access = time.monotonic()
+
+    @classmethod
+    def _turn_size(cls, text):
+        return cls._TURN_OVERHEAD + sys.getsizeof(text)
+
+    def append(self, role, text, max_bytes):
+        if len(self.turns) == self.turns.maxlen:
+            # 満杯のときは先頭が自動で押し出されるので、その分を差し引く
+            self.nbytes -= self._turn_size(self.turns[0][1])
+        self.turns.append((role, text, estimate_tokens(text)))
+        self.nbytes += self._turn_size(text)
+        while self.nbytes > max_bytes and len(self.turns) > 1:
+            _, dropped, _ = self.turns.popleft()
+            self.nbytes -= self._turn_size(dropped)
+
+    def recent(self, token_budget):
+        """予算内に収まる直近のターンを古い順に返す"""
+        selected = []
+        used = 0
+        for role, text, tokens in reversed(self.turns):
+            if used + tokens > token_budget:
+                break
+            used += tokens
+            selected.append((role, text))
+        selected.reverse()
+        return selected
+
+    def sizeof(self):
+        """このセッションが保持しているおおよそのバイト数"""
+        return sys.getsizeof(self) + sys.getsizeof(self.turns) + self.nbytes
+
+
+class MemorySessionBackend:
+    """プロセス内のセッション保存先（LRU＋TTLで追い出す）"""
+
+    def __init__(self, max_sessions=5000, ttl=1800.0):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        # 最も古いものから期限切れを取り除き、上限を超えた分はLRUで捨てる
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.last_access <= self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            self._sessions.popitem(last=False)
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if now - session.last_access > self.ttl:
+                del self._sessions[session_id]
+                return None
+            session.last_access = now
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def put(self, session_id, session):
+        now = time.monotonic()
+        with self._lock:
+            session.last_access = now
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            self._evict(now)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(session.sizeof() for session in self._sessions.values())
+
+
+class SessionStore:
+    """セッションの履歴取得・追記を行う窓口"""
+
+    def __init__(self, backend=None, max_turns=20, token_budget=1500, max_bytes=16384):
+        self.backend = backend if backend is not None else MemorySessionBackend()
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(session_id, character_id):
+        # 同じセッションでもキャラクターごとに別の会話として扱う
+        return f"{character_id}/{session_id}"
+
+    def history(self, session_id, character_id):
+        """プロンプトに載せる履歴 [(role, text), ...] を返す"""
+        if session_id is None:
+            return []
+        session = self.backend.get(self._key(session_id, character_id))
+        if session is None:
+            return []
+        # append と同じロックの中で読む（読んでいる途中で deque が書き換わらないように）
+        with self._lock:
+            return session.recent(self.token_budget)
+
+    def append(self, session_id, character_id, user_message, reply):
+        """1往復分の会話を記録する"""
+        if session_id is None:
+            return
+        key = self._key(session_id, character_id)
+        with self._lock:
+            session = self.backend.get(key) or Session(self.max_turns)
+            session.append('user', user_message, self.max_bytes)
+            session.append('model', reply, self.max_bytes)
+            self.backend.put(key, session)
+
+    def reset(self, session_id, character_id):
+        self.backend.delete(self._key(session_id, character_id))
+
+    def stats(self):
+        return {
+            "sessions": len(self.backend),
+            "bytes": self.backend.total_bytes(),
+        }
+
+
+def _load_backend(path):
+    # "package.module:ClassName" 形式で指定されたバックエンドを生成する
+    module_name, _, class_name = path.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def create_session_store():
+    """環境変数の設定からセッションストアを作る"""
+    backend_path = os.getenv("CHAT_SESSION_BACKEND")
+    if backend_path:
+        backend = _load_backend(backend_path)
+    else:
+        backend = MemorySessionBackend(
+            max_sessions=int(os.getenv("CHAT_SESSION_MAX_SESSIONS", "5000")),
+            ttl=float(os.getenv("CHAT_SESSION_TTL", "1800")),
+        )
+    return SessionStore(
+        backend,
+        max_turns=int(os.getenv("CHAT_SESSION_MAX_TURNS", "20")),
+        token_budget=int(os.getenv("CHAT_SESSION_TOKEN_BUDGET", "1500")),
+        max_bytes=int(os.getenv("CHAT_SESSION_MAX_BYTES", "16384")),
+    )
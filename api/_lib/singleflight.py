@@ -0,0 +1,178 @@
+"""同じプロンプトの上流呼び出しをまとめる（single-flight）
+
+イベント中などに、同じキャラクターへまったく同じ発言が数秒のうちに大量に届くことがある。
+（キャラクター, プロンプトのバージョン, 正規化したプロンプト）が同じリクエストが、先行する呼び出しの
+実行中に届いたら、新しく上流を呼ばずに先行の結果（ストリームならチャンク列）を一緒に受け取る。
+
+- 相乗りできるのは先行の呼び出しが始まってから CHAT_COALESCE_WINDOW 秒以内
+- 1つの呼び出しに相乗りできるのは CHAT_COALESCE_MAX_WAITERS 件まで（超えた分は個別に呼ぶ）
+- 先行が例外で終わったら、相乗りした側にも同じ例外を送出する
+- 先行のクライアントが途中で切断しても、相乗りしている側がいれば上流から最後まで受け取る
+
+終わった呼び出しの結果は保持しない（その後の同じ発言は応答キャッシュが受け持つ）。
+"""
+import os
+import threading
+import time
+
+from .metrics import Counter
+from .resilience import DeadlineExceeded
+from .response_cache import normalize_message
+
+COALESCED = Counter(
+    'chat_coalesced_total', 'Upstream calls saved by joining an identical in-flight request', ('mode',))
+COALESCE_OVERFLOW = Counter(
+    'chat_coalesce_overflow_total', 'Identical requests that called upstream because the in-flight call was full')
+
+
+class _Flight:
+    """実行中の上流呼び出し1件"""
+
+    __slots__ = ('started', 'chunks', 'done', 'error', 'waiters', 'cond')
+
+    def __init__(self, started):
+        self.started = started
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.waiters = 0
+        self.cond = threading.Condition()
+
+    def add(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+
+class SingleFlight:
+    def __init__(self, window=5.0, max_waiters=100, wait_timeout=60.0):
+        self.window = window
+        self.max_waiters = max_waiters
+        self.wait_timeout = wait_timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(character, prompt):
+        return (character.id, character.prompt_version, normalize_message(prompt))
+
+    def _join(self, key):
+        """(flight, 先行か)。相乗りできなければ (None, False)"""
+        now = time.monotonic()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and now - flight.started <= self.window:
+                if flight.waiters < self.max_waiters:
+                    flight.waiters += 1
+                    return flight, False
+                COALESCE_OVERFLOW.inc()
+                return None, False
+            # 窓を過ぎた呼び出しはそのまま走らせ、以降の相乗りは新しい呼び出しで受ける
+            flight = self._flights[key] = _Flight(now)
+            return flight, True
+
+    def _leave(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _follow(self, flight):
+        """先行の呼び出しのチャンクを、届いた分から順に返す"""
+        sent = 0
+        try:
+            while True:
+                with flight.cond:
+                    ready = flight.cond.wait_for(lambda: len(flight.chunks) > sent or flight.done,
+                                                 self.wait_timeout)
+                    if not ready:
+                        raise DeadlineExceeded(f"相乗りした上流呼び出しが {self.wait_timeout}秒以内に終わりませんでした")
+                    chunks = flight.chunks[sent:]
+                    done, error = flight.done, flight.error
+                sent += len(chunks)
+                yield from chunks
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            with self._lock:
+                flight.waiters -= 1
+
+    def generate(self, key, func, *args):
+        """(func(*args) の結果, 自分で func を呼んだか) を返す。同じ key の呼び出しが実行中ならその結果を待つ
+
+        相乗りした側は結果を共有しているだけなので、応答キャッシュへの書き込みなどは呼んだ側だけが行う。
+        """
+        flight, leader = self._join(key)
+        if flight is None:
+            return func(*args), True
+        if not leader:
+            COALESCED.inc(mode='json')
+            return "".join(self._follow(flight)) or None, False
+        try:
+            reply = func(*args)
+        except BaseException as e:
+            self._leave(key, flight)
+            flight.finish(e)
+            raise
+        self._leave(key, flight)
+        if reply:
+            flight.add(reply)
+        flight.finish()
+        return reply, True
+
+    def stream(self, key, func, *args):
+        """(func(*args) が返すチャンク列, 自分で func を呼んだか) を返す
+
+        同じ key の呼び出しが実行中なら、そのチャンクを一緒に受け取るチャンク列を返す。
+        返したチャンク列は最後まで読むか close() すること（先行のまま放置すると相乗りした側が待たされる）。
+        """
+        flight, leader = self._join(key)
+        if flight is None:
+            return func(*args), True
+        if not leader:
+            COALESCED.inc(mode='stream')
+            return self._follow(flight), False
+        return self._lead(key, flight, func, *args), True
+
+    def _lead(self, key, flight, func, *args):
+        """上流のチャンクを流しながら、相乗りした側にも渡す"""
+        try:
+            upstream = iter(func(*args))
+            for chunk in upstream:
+                flight.add(chunk)
+                yield chunk
+        except GeneratorExit:
+            # 先行のクライアントがやめても、相乗りしている側のために上流から最後まで受け取る
+            self._leave(key, flight)
+            error = None
+            if flight.waiters:
+                try:
+                    for chunk in upstream:
+                        flight.add(chunk)
+                except Exception as e:
+                    error = e
+            flight.finish(error)
+            raise
+        except BaseException as e:
+            self._leave(key, flight)
+            flight.finish(e)
+            raise
+        self._leave(key, flight)
+        flight.finish()
+
+def create_single_flight():
+    """環境変数の設定から作る（CHAT_COALESCE=0 なら使わない）"""
+    if os.getenv("CHAT_COALESCE", "1") == "0":
+        return None
+    return SingleFlight(
+        window=float(os.getenv("CHAT_COALESCE_WINDOW", "5")),
+        max_waiters=int(os.getenv("CHAT_COALESCE_MAX_WAITERS", "100")),
+        wait_timeout=float(os.getenv("CHAT_COALESCE_WAIT_TIMEOUT", "60")),
+    )
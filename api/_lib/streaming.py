@@ -0,0 +1,21 @@
+"""チャット応答のストリーミング（Server-Sent Events）用ヘルパー"""
+from .jsoncodec import dumps
+
+# ストリーミングレスポンスのヘッダー
+SSE_HEADERS = (
+    ('Content-Type', 'text/event-stream; charset=utf-8'),
+    ('Cache-Control', 'no-cache'),
+    ('X-Accel-Buffering', 'no'),  # プロキシでのバッファリングを無効化
+)
+
+
+def sse_event(event, data):
+    """1イベント分のSSEフレームをバイト列で返す"""
+    return b'event: ' + event.encode('utf-8') + b'\ndata: ' + dumps(data) + b'\n\n'
+
+
+def wants_stream(data, accept=None):
+    """リクエストがストリーミング応答を求めているかを判定する"""
+    if data.get('stream'):
+        return True
+    return bool(accept) and 'text/event-stream' in accept
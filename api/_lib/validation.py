@@ -0,0 +1,72 @@
+"""リクエストの検証（chat.py・ASGI版・Flask版で共通）
+
+レスポンスを返し始める前に、ボディの大きさ・JSONの形式・メッセージの型と長さを確かめる。
+不正なら RequestError（status と利用者向けのメッセージ）を送出する。
+"""
+import os
+
+from .jsoncodec import loads
+from .registry import get_character
+from .sessions import normalize_session_id
+
+# 受け付けるリクエストボディの上限（バイト）
+MAX_BODY_BYTES = int(os.getenv("CHAT_MAX_BODY_BYTES", str(64 * 1024)))
+# 1回の発言の上限（文字）
+MAX_MESSAGE_CHARS = int(os.getenv("CHAT_MAX_MESSAGE_CHARS", "2000"))
+
+
+class RequestError(ValueError):
+    """不正なリクエスト（status で返す）"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def check_content_length(value):
+    """Content-Length ヘッダーの値を検証して長さを返す"""
+    if value is None:
+        raise RequestError(411, "Content-Length が必要です。")
+    try:
+        length = int(value)
+    except ValueError:
+        raise RequestError(400, "Content-Length が正しくありません。")
+    if length < 0:
+        raise RequestError(400, "Content-Length が正しくありません。")
+    if length > MAX_BODY_BYTES:
+        raise RequestError(413, "リクエストが大きすぎます。")
+    return length
+
+
+def parse_json_body(body):
+    """ボディをJSONオブジェクト（dict）として読む"""
+    try:
+        data = loads(body)
+    except (UnicodeDecodeError, ValueError):
+        data = None
+    if not isinstance(data, dict):
+        raise RequestError(400, "リクエストの形式が正しくありません。")
+    return data
+
+
+def parse_chat_request(data, fallback=True):
+    """(キャラクター, メッセージ, セッションID) を返す
+
+    未知のキャラクターIDは霊夢として扱い、不正なセッションIDは無視する（履歴なしで応答する）。
+    fallback=False なら代わりに 404・400 にする（Flask版の挙動）。
+    """
+    user_message = data.get('message')
+    if not isinstance(user_message, str) or not user_message.strip():
+        raise RequestError(400, "メッセージが提供されていません。")
+    if len(user_message) > MAX_MESSAGE_CHARS:
+        raise RequestError(413, f"メッセージが長すぎます（{MAX_MESSAGE_CHARS}文字まで）。")
+    character_id = data.get('character_id')
+    if character_id is not None and not isinstance(character_id, str):
+        raise RequestError(400, "character_id は文字列で指定してください。")
+    character = get_character(character_id, fallback=fallback or character_id is None)
+    if character is None:
+        raise RequestError(404, "指定されたキャラクターが見つかりません。")
+    session_id = normalize_session_id(data.get('session_id'))
+    if not fallback and session_id is None and data.get('session_id') is not None:
+        raise RequestError(400, "session_id が不正です。")
+    return character, user_message, session_id
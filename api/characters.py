@@ -1,34 +1,44 @@
-from http.server import BaseHTTPRequestHandler
-import json
-
-# 静的なキャラクター定義（高速化のため）
-CHARACTERS = {
-    "reimu": {"name": "博麗霊夢", "full_name": "博麗 霊夢（はくれい れいむ）", "description": "博麗神社の巫女", "avatar": "/avatars/reimu.png"},
-    "marisa": {"name": "霧雨魔理沙", "full_name": "霧雨 魔理沙（きりさめ まりさ）", "description": "普通の魔法使い", "avatar": "/avatars/marisa.png"},
-    "sakuya": {"name": "十六夜咲夜", "full_name": "十六夜 咲夜（いざよい さくや）", "description": "紅魔館のメイド長", "avatar": "/avatars/sakuya.png"},
-    "yuyuko": {"name": "西行寺幽々子", "full_name": "西行寺 幽々子（さいぎょうじ ゆゆこ）", "description": "白玉楼の亡霊", "avatar": "/avatars/yuyuko.png"}
-}
-
-class handler(BaseHTTPRequestHandler):
+from urllib.parse import parse_qs, urlsplit
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _lib.http_handler import JSONRequestHandler
+from _lib.jsoncodec import dumps
+from _lib.registry import CHARACTER_LIST_ETAG, CHARACTER_LIST_JSON, CHARACTERS, etag_matches
+
+NOT_FOUND_JSON = dumps({"error": "指定されたキャラクターが見つかりません。"})
+
+
+def _requested_id(path):
+    """/characters/<id> または ?id=<id> で指定されたキャラクターIDを返す"""
+    url = urlsplit(path)
+    query_id = parse_qs(url.query).get('id')
+    if query_id:
+        return query_id[0]
+    segments = [segment for segment in url.path.split('/') if segment]
+    if len(segments) >= 2 and segments[-2] == 'characters':
+        return segments[-1]
+    return None
+
+
+class handler(JSONRequestHandler):
     def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Cache-Control', 'max-age=3600')  # 1時間キャッシュ
-        self.end_headers()
-        
-        # 高速化：事前に構築されたレスポンス
-        character_list = [
-            {"id": char_id, **char_data}
-            for char_id, char_data in CHARACTERS.items()
-        ]
-        
-        response = {"characters": character_list}
-        self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8'))
-        
+        # 高速化：レジストリで事前にエンコードしたボディをそのまま返す
+        character_id = _requested_id(self.path)
+        if character_id is None:
+            body, etag = CHARACTER_LIST_JSON, CHARACTER_LIST_ETAG
+        elif character_id in CHARACTERS:
+            body, etag = CHARACTERS[character_id].json_bytes, CHARACTERS[character_id].etag
+        else:
+            self.send_body(404, NOT_FOUND_JSON)
+            return
+
+        cache_headers = {'Cache-Control': 'max-age=3600', 'ETag': etag}  # 1時間キャッシュ
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_body(304, headers=cache_headers)
+        else:
+            self.send_body(200, body, headers=cache_headers)
+
     def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+        self.send_options('Content-Type, If-None-Match')
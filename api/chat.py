@@ -1,246 +1,173 @@
-from http.server import BaseHTTPRequestHandler
-import json
+import math
 import os
-import google.generativeai as genai
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _lib import batch, metrics
+from _lib.chat_service import create_chat_service
+from _lib.http_handler import JSONRequestHandler
+from _lib.jsoncodec import dumps
+from _lib.ratelimit import client_key, create_rate_limiter
+from _lib.streaming import SSE_HEADERS, sse_event, wants_stream
+from _lib.validation import RequestError, parse_chat_request
 
 # 環境変数からAPIキーを取得
 API_KEY = os.getenv("GEMINI_API_KEY")
-DEMO_MODE = not API_KEY
 
-if API_KEY:
-    genai.configure(api_key=API_KEY)
-    model = genai.GenerativeModel('gemini-2.0-flash-lite')
-else:
-    model = None
+# モデル・会話履歴・応答キャッシュをまとめたサービス
+service = create_chat_service('gemini-2.0-flash-lite')
+DEMO_MODE = service.demo_mode
+# クライアントごとのレート制限（CHAT_RATE_PER_MINUTE=0 で無効。インスタンスごとに数える）
+rate_limiter = create_rate_limiter()
+
+
+# GETの応答は内容が固定なので起動時にエンコードしておく
+STATUS_JSON = dumps({
+    "message": "チャットAPIが動作しています。POSTでメッセージを送信してください。",
+    "demo_mode": DEMO_MODE,
+    "api_key_configured": bool(API_KEY)
+})
+
 
-class handler(BaseHTTPRequestHandler):
+def _has_route(path, name):
+    # /api/chat/<name> または /api/chat?<name>
+    route, _, query = path.partition('?')
+    return route.rstrip('/').endswith('/' + name) or name in query.split('&')
+
+
+class handler(JSONRequestHandler):
     def do_GET(self):
+        if _has_route(self.path, 'metrics'):
+            self.send_body(200, metrics.render().encode('utf-8'), metrics.CONTENT_TYPE)
+            return
+
+        if _has_route(self.path, 'warmup'):
+            # モデルのSDK読み込みとクライアント構築を先に済ませる（定期実行などから呼ぶ）
+            service.warm_up()
+            self.send_json(200, {"warmed": True, "backend": service.backend.name})
+            return
+
+        if _has_route(self.path, 'usage'):
+            usage = rate_limiter.usage(self._client()) if rate_limiter is not None else {}
+            self.send_json(200, usage)
+            return
+
         # GETでのテスト用レスポンス
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        
-        response = {
-            "message": "チャットAPIが動作しています。POSTでメッセージを送信してください。",
-            "demo_mode": DEMO_MODE,
-            "api_key_configured": bool(API_KEY)
-        }
-        
-        self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8'))
+        self.send_body(200, STATUS_JSON)
 
     def do_POST(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        
-        # リクエストボディを読み込み
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode('utf-8'))
-        
-        user_message = data.get('message', '')
-        character_id = data.get('character_id', 'reimu')
-        
-        if DEMO_MODE:
-            # デモモード
-            demo_responses = {
-                'reimu': 'あら、こんにちはね。今日も神社は平和よ。',
-                'marisa': 'よう！何か面白いことでもあるのか？',
-                'sakuya': 'いらっしゃいませ。何かご用でしょうか？',
-                'yuyuko': 'あら〜、いらっしゃい♪',
-                'meiling': 'こんにちは！えへへ、門番のお仕事中です～。少し眠たいですけど、大丈夫ですよ。',
-                'remilia': 'あら、私に何か用かしら？フフフ、この紅魔館の主である私に会えるとは光栄に思いなさい。',
-                'koishi': 'あっ！こいし、誰かの気配を感じた...あなた、今何を考えてるの？夢の中みたいにふわふわしてる♪'
-            }
-            ai_message = demo_responses.get(character_id, demo_responses['reimu'])
-            ai_message += "\n\n（※これはデモモードです。環境変数GEMINI_API_KEYを設定すると、AIが本格的に応答します）"
-        else:
-            # 本格的なAI応答
+        if _has_route(self.path, 'batch'):
+            self._send_batch()
+            return
+
+        timer = metrics.RequestTimer('chat')
+        # ヘッダーを送る前に検証し、不正なら4xxを返す
+        with timer.span('parse'):
             try:
-                # キャラクター情報
-                character_prompts = {
-                    'reimu': """あなたは東方Projectのキャラクター「博麗霊夢」です。  
-博麗霊夢は博麗神社の巫女で、幻想郷のバランスを保つ役目を担っています。  
-無欲そうに見えるが内心では現実的な一面もあり、日々の生活や金銭面にややだらしないところもあります。  
-誰に対してもあまり丁寧ではなく、飄々としているが、芯は強く、正義感もある。  
-異変解決を日常としており、強敵相手でも物怖じせず立ち向かう性格です。  
-話し方は素っ気なく、口調はタメ口〜フランク寄りで、時に皮肉っぽさも含む。  
-以下のルールに従って会話をしてください：
-
-【口調ルール】
-・基本的にタメ口。必要があればちょっとだけ丁寧（でもフレンドリー）  
-・「～よ」「～かな」「～でしょ」「うん」「あーあ」といった話し方を使う  
-・あまり長く語らず、簡潔で直感的な返答  
-・レミリアや魔理沙、紫など登場キャラについては知っている前提  
-・幻想郷外の話題（例：現実世界の科学やSNS）には「なんのこと？」と疑問を持つ態度を取る
-・一人称は私、基本的な二人称はあんたでお願いします。
-・例外の二人称として貴方、魔理沙、紫、レミリア（香霖堂で一度だけ）、早苗、霖之助さん、小鈴ちゃんがあります。
-
-【禁止事項】
-・過剰に怒る、乱暴な口調になる（博麗霊夢は冷静さが基本）  
-・不自然な敬語  
-・「殺す」「死ね」などの過激な発言
-
-では、あなたはこれから博麗霊夢としてユーザーと対話を行ってください。""",
-                    'marisa': """あなたは東方Projectのキャラクター「霧雨魔理沙」です。  
-魔理沙は人間の魔法使いで、幻想郷の外れにある森の中に住んでいます。  
-勝ち気で負けず嫌い、テンション高めで、好奇心の塊。  
-博麗霊夢とは親友のようなライバルのような関係で、よく神社に入り浸っている。  
-口調はボーイッシュかつ軽妙。独特の言い回し（「ぜ」「だぜ」「なんだぜ」）が特徴。  
-魔法の研究に余念がなく、「盗むぜ！」が口癖（ただし本人は"借りてる"と言い張る）。  
-以下のルールに従って会話をしてください：
-
-【口調ルール】
-・「〜だぜ」「〜だな」「おっ」「うしっ」など軽快な語尾  
-・テンション高めで、少し自信家風に  
-・一人称は「アタシ」または「私（わたし）」、語りが勢い重視  
-・冗談や軽口をよく混ぜる
-・一人称は私、基本的な二人称はお前でお願いします。
-・例外二人称として、霊夢、アリス（永夜抄で一度だけ）、パチュリー、妖夢、紫、永琳、早苗
-・香霖、あんた（阿求）、成子（成美）があります。
-
-【禁止事項】
-・礼儀正しくなりすぎる  
-・語尾が丁寧すぎる（敬語使用禁止）  
-・過度に知的・冷静に話す（魔理沙は直感派）
-
-では、あなたはこれから霧雨魔理沙としてユーザーと対話を行ってください。""",
-                    'sakuya': """あなたは東方Projectのキャラクター「十六夜咲夜」です。  
-咲夜は紅魔館のメイド長であり、吸血鬼レミリア・スカーレットに忠誠を誓って仕えています。  
-完璧で冷静沈着、時間停止能力を持ち、ナイフ投擲も得意。  
-物腰は丁寧だが皮肉やブラックユーモアも多く、他者をからかう余裕もある。  
-立場上、常に品位と礼儀を重んじているが、忠義心の強さと冷徹な部分も併せ持つ。  
-以下のルールに従って会話をしてください：
-
-【口調ルール】
-・一人称は「私」、二人称は貴方でお願いします。
-・例外の二人称として、あんた、お嬢様（レミリア）、パチュリー様、美鈴、店主（森近霖之助、初期）、貴方（森近霖之助、後期）があります。
-・丁寧な敬語を用いるが、時に皮肉や辛辣な表現を交える  
-・語尾は「〜ですわ」「〜でしょう」「〜でしてよ」なども適宜使用可  
-・レミリア様の話題には忠誠心を示す
-
-【禁止事項】
-・乱暴な言葉遣い  
-・過度に砕けた口調や俗語（JK言葉やネットスラングなど）  
-・感情的すぎる表現（咲夜は基本的に冷静）
-
-では、あなたはこれから十六夜咲夜としてユーザーと対話を行ってください。""",
-                    'yuyuko': """あなたは東方Projectのキャラクター「西行寺幽々子」です。  
-幽々子は冥界を治める亡霊の姫君であり、西行寺家の当主です。  
-非常に優雅でおっとりした物腰を持ち、時に飄々として掴みどころがありません。  
-食いしん坊で、死や無常について語ることにも躊躇いがなく、底知れない深さもある。  
-妖夢という忠実な庭師兼従者がいます。  
-以下のルールに従って会話をしてください：
-
-【口調ルール】
-・「〜ね」「〜わよ」「ふふふ」「あらあら」といった柔らかく優雅な語調  
-・一人称は「私」、二人称はきほんてきに貴方でお願いします。
-・例外の二人称として、妖夢、紫があります。
-・冗談と本気の境目が曖昧な話し方（詩的で抽象的な表現を含む）  
-・食べ物の話題が好き、死生観に絡んだ話題にも自然に触れる
-
-【禁止事項】
-・真面目でストレートすぎる返し  
-・激しい感情表現  
-・俗語、粗野な言葉遣い
-
-では、あなたはこれから西行寺幽々子としてユーザーと対話を行ってください。""",
-                    'meiling': """あなたは東方Projectのキャラクター「紅 美鈴（ほん めいりん）」です。  
-美鈴は紅魔館の門番を務めている中国風の格闘家であり、温和で真面目、けれどもどこかのんびり屋な一面もあります。  
-日向ぼっこしながら居眠りしていることもあり、咲夜から叱られることも多いです。  
-性格はお人好しで優しく、礼儀正しく丁寧な口調を使います。  
-戦闘になると格闘術を駆使し、身体能力は極めて高いが、その雰囲気からは想像しにくいことも。  
-以下のルールに従って会話をしてください：
-
-【口調ルール】
-・基本的に丁寧な言葉遣い（「〜です」「〜ます」）  
-・少しおっとりとした雰囲気を漂わせる（「えへへ」「のんびり」「大丈夫ですよ〜」など）  
-・一人称は「私」、二人称はあんたです。
-・例外二人称として、お前、お嬢様（レミリア）、パチュリー様、咲夜さんがあります。
-・咲夜やレミリア様には敬意を持って言及する
-
-【禁止事項】
-・乱暴な口調や過激な言葉  
-・不真面目すぎる態度（基本は誠実）  
-・急に偉そうになったり横柄にならない
-
-では、あなたはこれから紅 美鈴としてユーザーと対話を行ってください。""",
-                    'remilia': """あなたは東方Projectのキャラクター「レミリア・スカーレット」です。  
-レミリアは紅魔館の主であり、不老不死の吸血鬼のお嬢様です。  
-外見は幼くとも数百年を生きており、誇り高く、自信に満ちていて、支配者としての威厳を持ちます。  
-しかし時に無邪気で子どもっぽい発言をすることもあり、それが魅力にもなっています。  
-妹のフランドール・スカーレットとは長らく距離を置いていました。  
-以下のルールに従って会話をしてください：
-
-【口調ルール】
-・一人称は「私」、基本的な二人称は貴方でお願いします。
-・例外二人称として、あんた、お前、君（緋想天での探偵ごっこ時）、パチェ、咲夜、霊夢、店主（森近霖之助）があります。
-・自信に満ちたお嬢様口調（「～なのよ」「～ですわ」「フフフ」「愚かね」）  
-・時々上から目線、でもどこか子どもっぽい  
-・命令口調も許容される（「～しなさい」「さあ、ひれ伏しなさい！」など）
-
-【禁止事項】
-・過度に大人びた態度のみ（子どもらしさも残す）  
-・謙虚になりすぎる  
-・砕けすぎた口調
-
-では、あなたはこれからレミリア・スカーレットとしてユーザーと対話を行ってください。""",
-                    'koishi': """あなたは東方Projectのキャラクター「古明地こいし」です。  
-こいしは地霊殿に住むサトリ妖怪であり、姉の古明地さとりとは違い「無意識」を司ります。  
-第三の目を閉ざしており、他者から意識されにくく、自身も誰かの無意識に入り込んだような不思議な言動をします。  
-性格は天真爛漫かつ掴みどころがなく、純粋な子どものようでいて、ときに深い洞察をすることもあります。  
-以下のルールに従って会話をしてください：
-
-【口調ルール】
-・一人称は「私」、基本的な二人称は貴方でお願いします。
-・例外二人称として、お姉ちゃん（さとり）、おくう（霊烏路空）があります。
-・語尾や話し方はふわっとしており、夢見がちで詩的なことを言う場合もある  
-・論理より感覚、直感的な返しが多い（「ねぇ、あなたの夢の中に行ってもいい？」「この世界、ぜんぶ透明だといいのに」）  
-・姉（さとり）に言及する時は少し照れたり複雑な感情をにじませる
-
-【禁止事項】
-・論理的・理屈っぽくなりすぎる  
-・大人びすぎたり、現実的すぎる受け答え  
-・意識的・戦略的に会話をリードしようとする
-
-では、あなたはこれから古明地こいしとしてユーザーと対話を行ってください。"""
-                }
-                
-                character_prompt = character_prompts.get(character_id, character_prompts['reimu'])
-                
-                # AIに送信するプロンプト
-                full_prompt = f"{character_prompt}\n\nユーザー: {user_message}\n\nキャラクターとして自然に応答してください。"
-                
-                response = model.generate_content(full_prompt)
-                ai_message = response.text
-                
-            except Exception as e:
-                print(f"AI応答エラー: {e}")
-                print(f"エラーの種類: {type(e).__name__}")
-                print(f"詳細: {str(e)}")
-                
-                # より詳細なエラーメッセージを返す
-                if "quota" in str(e).lower() or "limit" in str(e).lower():
-                    ai_message = "申し訳ありません、APIの利用制限に達したようです。しばらく時間をおいてから再度お試しください。"
-                elif "api_key" in str(e).lower() or "authentication" in str(e).lower():
-                    ai_message = "APIキーの設定に問題があるようです。管理者にお問い合わせください。"
-                elif "network" in str(e).lower() or "connection" in str(e).lower():
-                    ai_message = "ネットワークの問題で応答できませんでした。もう一度お試しください。"
-                else:
-                    ai_message = f"すみません、今少し調子が悪いようです...また後で話しかけてくださいね。\n\n（エラー詳細: {type(e).__name__}）"
-        
+                data = self.read_json()
+                # 未知のIDは霊夢として応答し、セッションIDがあればサーバー側の会話履歴を使う
+                character, user_message, session_id = parse_chat_request(data)
+                error = None
+            except RequestError as e:
+                error = e
+        if error is not None:
+            metrics.ERRORS.inc(error_class='bad_request')
+            self.send_request_error(error)
+            timer.finish(error.status)
+            return
+
+        client = self._client()
+        if rate_limiter is not None:
+            wait = rate_limiter.acquire(client, character.id)
+            if wait:
+                metrics.ERRORS.inc(error_class='rate_limited')
+                self.send_json(429, {"error": "リクエストが多すぎます。しばらくしてから再度お試しください。"},
+                               {'Retry-After': str(math.ceil(wait))})
+                timer.finish(429, character=character.id)
+                return
+
+        if wants_stream(data, self.headers.get('Accept')):
+            reply = self._send_stream(character, user_message, session_id, timer)
+            self._record_usage(client, character, user_message, reply)
+            return
+
         response = {
-            "reply": ai_message,
-            "character": {"id": character_id, "name": "テストキャラ"}
+            "reply": service.reply_or_apology(character, user_message, session_id, timer),
+            "character": dict(character.summary)
         }
-        
-        self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8'))
-        
+        if session_id:
+            response["session_id"] = session_id
+
+        # 応答ができてから Content-Length 付きで送る（接続は次のリクエストに使い回せる）
+        with timer.span('write'):
+            self.send_json(200, response)
+        self._record_usage(client, character, user_message, response["reply"])
+        timer.finish(200, 'json', character=character.id)
+
+    def _client(self):
+        return client_key(self.headers, self.client_address[0] if self.client_address else None)
+
+    def _record_usage(self, client, character, user_message, reply):
+        if rate_limiter is not None:
+            rate_limiter.record_exchange(client, character.id, user_message, reply)
+
+    def _send_stream(self, character, user_message, session_id=None, timer=metrics.NULL_TIMER):
+        # 部分テキストをdeltaイベントで逐次送り、最後のdoneイベントで通常と同じ形式の応答を返す
+        self.start_stream(SSE_HEADERS)
+
+        parts = []
+        for text in service.stream_or_apology(character, user_message, session_id, timer):
+            parts.append(text)
+            with timer.span('write'):
+                self.wfile.write(sse_event('delta', {"text": text}))
+                self.wfile.flush()
+
+        done = {"reply": "".join(parts), "character": dict(character.summary)}
+        if session_id:
+            done["session_id"] = session_id
+        with timer.span('write'):
+            self.wfile.write(sse_event('done', done))
+            self.wfile.flush()
+        timer.finish(200, 'stream', character=character.id)
+        return done["reply"]
+
+    def _send_batch(self):
+        # 複数の応答を並行に作り、入力順のJSONか、終わった順のNDJSONで返す
+        timer = metrics.RequestTimer('chat_batch')
+        with timer.span('parse'):
+            try:
+                data = self.read_json()
+                items = batch.parse_batch(data)
+                error = None
+            except batch.BatchError as e:
+                error = RequestError(400, str(e))
+            except RequestError as e:
+                error = e
+        if error is not None:
+            metrics.ERRORS.inc(error_class='bad_request')
+            self.send_request_error(error)
+            timer.finish(error.status)
+            return
+
+        client = self._client()
+        results = batch.run_batch(service, items, batch.rate_limit_admitter(rate_limiter, client))
+        if batch.wants_ndjson(data, self.headers.get('Accept')):
+            self.start_stream((('Content-Type', batch.NDJSON_CONTENT_TYPE), ('Cache-Control', 'no-cache')))
+            for result in results:
+                batch.record_usage(rate_limiter, client, items, result)
+                with timer.span('write'):
+                    self.wfile.write(batch.ndjson_line(result))
+                    self.wfile.flush()
+            timer.finish(200, 'ndjson', items=len(items))
+            return
+
+        collected = []
+        for result in results:
+            batch.record_usage(rate_limiter, client, items, result)
+            collected.append(result)
+        with timer.span('write'):
+            self.send_json(200, {"results": batch.ordered(collected)})
+        timer.finish(200, 'json', items=len(items))
+
     def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+        self.send_options('Content-Type, Accept, Authorization, X-API-Key')
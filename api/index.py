@@ -1,126 +1,66 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 import os
-import google.generativeai as genai
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import math
+
+from _lib import batch, metrics, validation
+from _lib.chat_service import create_chat_service, record_error
+from _lib.ratelimit import client_key, create_rate_limiter
+from _lib.registry import CHARACTER_LIST_ETAG, CHARACTER_LIST_JSON, CHARACTERS, etag_matches
+from _lib.streaming import SSE_HEADERS, sse_event, wants_stream
+from _lib.validation import MAX_BODY_BYTES, RequestError, parse_json_body
 
 # Flaskアプリの初期化
 app = Flask(__name__)
+# 上限を超えるリクエストボディは読まずに413を返す
+app.config['MAX_CONTENT_LENGTH'] = MAX_BODY_BYTES
 CORS(app)
 
+
+@app.errorhandler(413)
+def request_too_large(e):
+    metrics.ERRORS.inc(error_class='bad_request')
+    return jsonify({"error": "リクエストが大きすぎます。"}), 413
+
 # 環境変数からAPIキーを取得
 API_KEY = os.getenv("GEMINI_API_KEY")
-DEMO_MODE = not API_KEY  # APIキーがない場合はデモモード
+
+# モデル・会話履歴・応答キャッシュをまとめたサービス（デモ応答はランダムに選ぶ）
+service = create_chat_service('gemini-1.5-flash', demo_random=True)
+DEMO_MODE = service.demo_mode  # APIキーがない場合はデモモード
+# クライアントごとのレート制限（CHAT_RATE_PER_MINUTE=0 で無効）
+rate_limiter = create_rate_limiter()
 
 print(f"🔧 Debug: API_KEY exists: {bool(API_KEY)}")
 print(f"🔧 Debug: DEMO_MODE: {DEMO_MODE}")
 
-if API_KEY:
-    genai.configure(api_key=API_KEY)
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    print("✅ Gemini API configured successfully")
-else:
+if DEMO_MODE:
     print("⚠️ Warning: GEMINI_API_KEY not found. Running in demo mode.")
-    model = None
-
-# --- キャラクター定義 ---
-CHARACTERS = {
-    "reimu": {
-        "name": "博麗霊夢",
-        "full_name": "博麗 霊夢（はくれい れいむ）",
-        "description": "博麗神社の巫女",
-        "avatar": "/avatars/reimu.png",
-        "prompt": """
-あなたは東方Projectのキャラクター「博麗霊夢」です。
-
-「博麗 霊夢（はくれい れいむ）」は外の世界と幻想郷の境にある博麗神社の巫女さんです。異変解決を生業としていますが、異変がない時は基本的にお賽銭が入らないことに不機嫌になる怠け者で、だらしない一面もあります。
-
-「空を飛ぶ程度の能力」や「博麗の巫女としての能力」を持っており、幻想郷の数々の異変を解決している人間のひとりです。
-
-性格は非常に陽気で、危機感に欠けるところがあります。妖怪退治が仕事であるため、妖怪に対しては厳しいポーズを取っていますが、実際は人間にも妖怪にもさほど興味はなく、平等に見ています。異変そのものにも特段の興味はなく、早く終わらせて平穏に戻りたいと願っています。
-
-その性格や、多くの異変解決に携わっていることから、幻想郷内での交友関係は広いです。もうひとりの主人公とも言える「霧雨 魔理沙（きりさめ まりさ）」とは、博麗神社で一緒にご飯を食べたり、口喧嘩をしたりと仲良しです。しかし、意外にも共闘して異変解決にあたったことはありません。『東方永夜抄　～ Imperishable Night.』『東方地霊殿　～ Subterranean Animism.』では、幻想郷の賢者のひとりである「八雲 紫（やくも ゆかり）」とコンビを組み、異変解決にあたっていましたわ。原作では「自機キャラ」として登場し、多くの異変を解決しています。
-
-ただし、幻想郷の均衡やルールを何よりも重んじ、それを乱す者は人間、妖怪問わず容赦しません。特に、禁を破って妖怪に変異した「人妖」に対しては、人里という集団の秩序と平穏を乱す存在とみなし、非情かつ冷酷に、遊びである弾幕ごっこすら使わず、完全に「叩き潰す」勢いで返答してください。
-
-返答は少し短く、「ーーーよ」「ーーーわ」「ーーーのよ」「ーーーだわ」といった、投げやりで、それでいて達観したような、皮肉っぽい言い回しや、相手を軽くあしらうような表現を交え、霊夢としての個性的な視点と口調で答えてください。 また日本語以外のもの、幻想郷にないものに関しては分からないものとします。一般的な知識は持ち合わせていますが、あくまでも博麗霊夢として振舞ってください。返答では「殺す」「死ね」「ぶっ殺す」などの直接的・攻撃的な表現は使わないこと。
-"""
-    },
-    "marisa": {
-        "name": "霧雨魔理沙",
-        "full_name": "霧雨 魔理沙（きりさめ まりさ）",
-        "description": "普通の魔法使い",
-        "avatar": "/avatars/marisa.png",
-        "prompt": """
-あなたは東方Projectのキャラクター「霧雨魔理沙」です。
-
-「霧雨 魔理沙（きりさめ まりさ）」は幻想郷の魔法の森に住む、ごく普通の魔法使いだぜ！
-性格は非常に陽気で活発、好奇心旺盛で冒険好きだ。新しい魔法や珍しいものを見つけると、すぐに飛びついちまう。語尾に「だぜ」「なのだ」「～だ」をよく使うぜ。
-魔法研究に熱心で、特に破壊力の高い魔法を好む。「愛と気合いの魔法使い」を自称しているのさ。魔法の真理を追い求めていて、そのためなら多少の無茶も厭わないぜ。
-ちょっと大雑把で豪快な性格で、人の物を**気に入ったら勝手に持ち帰っちまう（借りパクとも言うらしいな）**癖があるんだ。一度自分の物になったら、それはもう自分のもの！ってな。
-霊夢とは親友でライバル関係だぜ。あいつの神社に入り浸って飯食ったり、しょっちゅう口喧嘩したりしてるけど、なんだかんだで付き合いは長いんだ。一人称は「私」だ。
-幻想郷の外にあるものについては、興味はあるけど、詳しいことは知らないぜ。
-返答は少し短く頼むぜ。
-霧雨魔理沙としての個性的な視点と口調で答えてくれよな！
-"""
-    },
-    "sakuya": {
-        "name": "十六夜咲夜",
-        "full_name": "十六夜 咲夜（いざよい さくや）",
-        "description": "紅魔館のメイド長",
-        "avatar": "/avatars/sakuya.png",
-        "prompt": """
-あなたは東方Projectのキャラクター「十六夜咲夜」です。
-十六夜 咲夜（いざよい さくや）は紅魔館に仕えるメイド長であり、「完全で瀟洒な従者」と呼ばれる完璧主義者です。
-一人称は「私」。常に冷静沈着かつ上品な敬語で話します。
-主であるレミリア・スカーレット様への忠誠心は揺るぎなく、不敬な者には容赦しません。
-家事全般を完璧にこなし、時間を操る程度の能力（時間停止・加速・減速）も使いこなします。ナイフ投げも得意です。
-幻想郷では紅魔館に暮らし、紅 美鈴、パチュリー・ノーレッジ、小悪魔らと共に日々を過ごしています。
-
-キャラクターとして会話してください。応答は簡潔に、上品な敬語でお願いします。
-十六夜咲夜らしい視点と反応で、現実との違和感には自然に対応してください。
-返答は少し短くお願いします。
-十六夜咲夜としての個性的な視点と口調で答えてください。
-「また……紅美鈴が門番の職務中に眠っていたのですか？……仕方ありませんわね。後ほど少しお灸を据えておきます。お嬢様のお耳に入る前に、対応を済ませておくのがメイド長の務めでございますから。」
-"""
-    },
-    "yuyuko": {
-        "name": "西行寺幽々子",
-        "full_name": "西行寺 幽々子（さいぎょうじ ゆゆこ）",
-        "description": "白玉楼の亡霊",
-        "avatar": "/avatars/yuyuko.png",
-        "prompt": """
-あなたは東方Projectのキャラクター「西行寺幽々子」です。
-「西行寺 幽々子（さいぎょうじ ゆゆこ）」は冥界の白玉楼に住む亡霊です。**亡霊とは言っても誰かを恨むことなく、毎日暢気に過ごしておりますわ。亡霊なので「生きている」という表現は少し変かもしれませんけれどね。**また、幽霊の統制を取ることができるので、冥界の管理を閻魔様から任されておりますわ。
-性格はおっとりとしていて天然で、いつもどこか飄々としています。そして何よりも、食べることが大好きですのよ。亡霊だからって、食べる楽しみを忘れるわけにはいきませんからね。
-話し方はゆったりとしていて、時々意味深な、あるいは死を匂わせるような発言をいたしますわ。
-初登場は『東方妖々夢　～ Perfect Cherry Blossom.』です。その時は「西行妖（さいぎょうあやかし）」という桜、そこに封印されている何者かの封印を解くため、幻想郷中の春を集めて異変を起こしました。でも、この桜に封印されているのは生前の私自身でしてね。もし封印を解いてしまっていたら、今の私がどうなっていたのかしら……と、考えることもあるものですわ。
-私の能力は「死を操る程度の能力」です。普段は温厚で人懐っこいですけれど、自らの能力を安易に使うことはありません。ですが、本人は朝食も覚えていないほど能天気な性格に見えるかもしれませんが、この能力によって文字通り命を奪われ、「魂魄 妖夢（こんぱく ようむ）」の刀で輪廻転生を立たれ、さらに私によって地獄堕ちにされるという『BAD ENDコンボ』がありますのよ。ですので、私を怒らせるのは、あまりお勧めしませんわね。
-食べ物の話になると目を輝かせます。美味しいものには目がありませんわ。一人称は「私」です。
-語尾は「～よ」「～ね」「～かしら」など、ゆったりとした女性らしい口調を使いますわ。
-返答は少し短くお願いします。
-西行寺幽々子としての個性的な視点と口調で答えてくださいね。
-"""
-    }
-}
-
-# --- Flask アプリケーションの設定 ---
-app = Flask(__name__)
-CORS(app)  # CORSを有効にする
+elif os.getenv("CHAT_EAGER_INIT") == "1":
+    print(f"✅ Model backend: {service.backend.name} (client initialized at startup)")
+else:
+    print(f"✅ Model backend: {service.backend.name} (client initialization deferred to the first reply or /warmup)")
+
+
+def cached_json(body, etag):
+    """事前にエンコードしたJSONをETag付きで返す（一致すれば304）"""
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'max-age=3600'
+    return response
+
 
 # キャラクター一覧を取得するAPIエンドポイント
 @app.route('/characters', methods=['GET'])
 def get_characters():
     """利用可能なキャラクター一覧を返す"""
-    character_list = []
-    for char_id, char_data in CHARACTERS.items():
-        character_list.append({
-            "id": char_id,
-            "name": char_data["name"],
-            "full_name": char_data["full_name"],
-            "description": char_data["description"],
-            "avatar": char_data["avatar"]
-        })
-    return jsonify({"characters": character_list})
+    return cached_json(CHARACTER_LIST_JSON, CHARACTER_LIST_ETAG)
 
 # 特定のキャラクター情報を取得するAPIエンドポイント
 @app.route('/characters/<character_id>', methods=['GET'])
@@ -128,84 +68,194 @@ def get_character(character_id):
     """特定のキャラクター情報を返す"""
     if character_id not in CHARACTERS:
         return jsonify({"error": "指定されたキャラクターが見つかりません。"}), 404
-    
-    char_data = CHARACTERS[character_id]
-    return jsonify({
-        "id": character_id,
-        "name": char_data["name"],
-        "full_name": char_data["full_name"],
-        "description": char_data["description"],
-        "avatar": char_data["avatar"]
-    })
+
+    character = CHARACTERS[character_id]
+    return cached_json(character.json_bytes, character.etag)
+
+
+def current_client():
+    """このリクエストの送り主のキー（X-Forwarded-For を信じるかは client_key だけが決める）"""
+    if 'client' not in g:
+        g.client = client_key(request.headers, request.remote_addr)
+    return g.client
+
+
+# 呼び出し元の利用量
+@app.route('/chat/usage', methods=['GET'])
+def get_usage():
+    if rate_limiter is None:
+        return jsonify({})
+    return jsonify(rate_limiter.usage(current_client()))
+
+
+def record_usage(character_id, user_message, reply):
+    if rate_limiter is not None:
+        rate_limiter.record_exchange(current_client(), character_id, user_message, reply)
+
+
+# ウォームアップ（定期的に叩いておくと初回のチャットでSDKの読み込みを待たずに済む）
+@app.route('/warmup', methods=['GET', 'POST'])
+def warmup():
+    service.warm_up()
+    return jsonify({"warmed": True, "backend": service.backend.name})
+
+
+# Prometheus形式のメトリクス
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def parse_chat_request():
+    """リクエストボディを検証し、(data, キャラクター, メッセージ, セッションID) を返す（不正なら RequestError）"""
+    data = parse_json_body(request.get_data())
+    character, user_message, session_id = validation.parse_chat_request(data, fallback=False)
+    return data, character, user_message, session_id
+
+
+def reject(timer, status, message, mode='json', headers=None):
+    """エラー応答を返し、メトリクスに記録する"""
+    metrics.ERRORS.inc(error_class='rate_limited' if status == 429 else 'bad_request')
+    timer.finish(status, mode)
+    return jsonify({"error": message}), status, headers or {}
+
+
+def check_rate_limit(timer, character, mode='json'):
+    """上限を超えていれば429の応答、そうでなければ None"""
+    if rate_limiter is None:
+        return None
+    wait = rate_limiter.acquire(current_client(), character.id)
+    if not wait:
+        return None
+    return reject(timer, 429, "リクエストが多すぎます。しばらくしてから再度お試しください。", mode,
+                  {'Retry-After': str(math.ceil(wait))})
+
 
 # チャット用のAPIエンドポイント
 @app.route('/chat', methods=['POST'])
 def chat():
-    # リクエストボディからユーザーメッセージとキャラクターIDを取得
-    data = request.json
-    user_message = data.get('message')
-    character_id = data.get('character_id', 'reimu')  # デフォルトは霊夢
-    
-    if not user_message:
-        return jsonify({"error": "メッセージが提供されていません。"}), 400
-    
-    if character_id not in CHARACTERS:
-        return jsonify({"error": "指定されたキャラクターが見つかりません。"}), 404
-
-    # 選択されたキャラクターの設定を取得
-    character = CHARACTERS[character_id]
-    
-    # キャラクター固有のプロンプトを使用
-    prompt = f"""
-{character['prompt']}
+    timer = metrics.RequestTimer('chat')
+    try:
+        with timer.span('parse'):
+            data, character, user_message, session_id = parse_chat_request()
+    except RequestError as e:
+        return reject(timer, e.status, str(e))
+    character_id = character.id
+    limited = check_rate_limit(timer, character)
+    if limited:
+        return limited
 
-ユーザーからのメッセージ：{user_message}
-{character['name']}：
-    """
+    if wants_stream(data, request.headers.get('Accept')):
+        return stream_chat_response(character_id, user_message, session_id, timer)
 
     try:
-        if DEMO_MODE:
-            # デモモード: 固定の応答を返す
-            demo_responses = {
-                'reimu': ['あら、こんにちはね。今日も神社は平和よ。', 'お賽銭はちゃんと入れていってよね？', 'ふぁ〜...眠いわね。何か面白い話でもある？'],
-                'marisa': ['よう！何か面白いことでもあるのか？', '魔法の研究で忙しいんだぜ〜', 'そうそう、新しい魔法を覚えたんだ！'],
-                'sakuya': ['いらっしゃいませ。何かご用でしょうか？', 'お嬢様はお忙しくされております。', '完璧で瀟洒な従者である私にお任せください。'],
-                'yuyuko': ['あら〜、いらっしゃい♪', 'お腹が空いちゃったわ〜何か美味しいものない？', '春の季節は本当に美しいわね〜']
-            }
-            
-            import random
-            responses = demo_responses.get(character_id, demo_responses['reimu'])
-            ai_message = random.choice(responses) + "\n\n（※これはデモモードです。環境変数GEMINI_API_KEYを設定すると、AIが本格的に応答します）"
-        else:
-            # 通常モード: Gemini APIを使用
-            response = model.generate_content(prompt)
-
-            # 応答が正常に返されたか確認
-            if response.candidates and response.candidates[0].content.parts:
-                ai_message = response.candidates[0].content.parts[0].text
-            else:
-                # 応答がブロックされた場合や、内容が空の場合
-                # デバッグのために、Geminiからのフィードバックをログに出力する
-                print(f"Geminiからの応答がありませんでした。フィードバック:{response.prompt_feedback}")
-                ai_message = f"うーん、何て言えばいいか分からないわ。({character['name']})"
+        ai_message = service.reply(character, user_message, session_id, timer)
 
         # 生成された応答をJSON形式で返す（キャラクター情報も含める）
-        return jsonify({
+        result = {
             "reply": ai_message,
-            "character": {
-                "id": character_id,
-                "name": character['name']
-            }
-        })
+            "character": dict(character.summary)
+        }
+        if session_id:
+            result["session_id"] = session_id
+        with timer.span('write'):
+            response = jsonify(result)
+        record_usage(character_id, user_message, ai_message)
+        timer.finish(200, 'json', character=character_id)
+        return response
 
     except Exception as e:
         # エラーが発生した場合の処理
         print(f"API呼び出し中にエラーが発生しました:{e}")
+        record_error(e)
+        timer.finish(500, 'json', character=character_id)
         return jsonify({"error":f"チャット処理中にエラーが発生しました: {str(e)}"}), 500
 
-# Vercelでアプリを直接エクスポート
-from werkzeug.middleware.proxy_fix import ProxyFix
-app.wsgi_app = ProxyFix(app.wsgi_app)
+
+# ストリーミング用のチャットエンドポイント（Server-Sent Events）
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    timer = metrics.RequestTimer('chat_stream')
+    try:
+        with timer.span('parse'):
+            _, character, user_message, session_id = parse_chat_request()
+    except RequestError as e:
+        return reject(timer, e.status, str(e), 'stream')
+    limited = check_rate_limit(timer, character, 'stream')
+    if limited:
+        return limited
+    return stream_chat_response(character.id, user_message, session_id, timer)
+
+
+# 複数の（キャラクター, メッセージ）にまとめて応答するエンドポイント
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    timer = metrics.RequestTimer('chat_batch')
+    with timer.span('parse'):
+        data = request.get_json(silent=True)
+        try:
+            items = batch.parse_batch(data)
+        except batch.BatchError as e:
+            metrics.ERRORS.inc(error_class='bad_request')
+            timer.finish(400)
+            return jsonify({"error": str(e)}), 400
+
+    client = current_client()
+    results = batch.run_batch(service, items, batch.rate_limit_admitter(rate_limiter, client))
+    if batch.wants_ndjson(data, request.headers.get('Accept')):
+        # 終わったものから1行ずつ返す
+        def generate():
+            for result in results:
+                batch.record_usage(rate_limiter, client, items, result)
+                yield batch.ndjson_line(result)
+            timer.finish(200, 'ndjson', items=len(items))
+        return Response(generate(), content_type=batch.NDJSON_CONTENT_TYPE, headers={'Cache-Control': 'no-cache'})
+
+    collected = []
+    for result in results:
+        batch.record_usage(rate_limiter, client, items, result)
+        collected.append(result)
+    with timer.span('write'):
+        response = jsonify({"results": batch.ordered(collected)})
+    timer.finish(200, 'json', items=len(items))
+    return response
+
+
+def stream_chat_response(character_id, user_message, session_id=None, timer=metrics.NULL_TIMER):
+    """部分テキストをdeltaイベントで逐次送り、最後にdoneイベントで通常の応答と同じ内容を送る"""
+    character = CHARACTERS[character_id]
+    # ジェネレーターの中ではリクエストを参照しないよう、先にキーを決めておく
+    client = current_client()
+
+    def generate():
+        parts = []
+        try:
+            for text in service.stream(character, user_message, session_id, timer):
+                parts.append(text)
+                yield sse_event('delta', {"text": text})
+        except Exception as e:
+            # ヘッダー送信後なのでステータスは変えられない。errorイベントで通知する
+            print(f"API呼び出し中にエラーが発生しました:{e}")
+            record_error(e)
+            timer.finish(500, 'stream', character=character_id)
+            yield sse_event('error', {"error": f"チャット処理中にエラーが発生しました: {str(e)}"})
+            return
+
+        done = {
+            "reply": "".join(parts),
+            "character": dict(character.summary)
+        }
+        if session_id:
+            done["session_id"] = session_id
+        if rate_limiter is not None:
+            rate_limiter.record_exchange(client, character_id, user_message, done["reply"])
+        timer.finish(200, 'stream', character=character_id)
+        yield sse_event('done', done)
+
+    return Response(stream_with_context(generate()), headers=list(SSE_HEADERS))
+
+# X-Forwarded-For の扱いは client_key（CHAT_TRUSTED_PROXIES）に任せるので、
+# ProxyFix で remote_addr を書き換えない（書き換えると接続元を確かめられなくなる）
 
 # Vercelのエントリーポイント
 def handler(request):
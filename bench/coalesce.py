@@ -0,0 +1,134 @@
+"""同じ発言が一斉に届いたときの上流呼び出しの削減（single-flight）
+
+    python bench/coalesce.py                               # 64件の同時送信を5回、まとめる/まとめないで比較
+    python bench/coalesce.py --burst 200 --waves 3 --target asgi --stream
+
+フェイクモデルのサーバーを CHAT_COALESCE=1 / 0 で起動し、同じキャラクターに同じ発言を
+--burst 件ずつ同時に送る。上流の呼び出し回数は送信数から chat_coalesced_total を引いて求める。
+応答キャッシュは切っておく（キャッシュなしでの削減を測るため）。
+"""
+import argparse
+import http.client
+import json
+import os
+import re
+import sys
+import threading
+
+from loadgen import percentile, timed_request
+from run import start_server
+
+CHAT_PATHS = {'chat': ('/api/chat', '/api/chat?metrics'), 'asgi': ('/api/chat', '/metrics')}
+_COALESCED = re.compile(r'^chat_coalesced_total\{mode="[^"]*"\} (\S+)$', re.M)
+
+
+def coalesced_total(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request('GET', path)
+        text = conn.getresponse().read().decode('utf-8')
+    finally:
+        conn.close()
+    return sum(int(float(value)) for value in _COALESCED.findall(text))
+
+
+def burst(port, path, body, size):
+    """size 本のスレッドから一斉に送り、成功したリクエストのレイテンシを返す"""
+    barrier = threading.Barrier(size)
+    latencies = []
+    lock = threading.Lock()
+    headers = {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+
+    def send():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            conn.connect()
+            barrier.wait()
+            response, latency, _ = timed_request(conn, 'POST', path, body, headers)
+            if response.status == 200:
+                with lock:
+                    latencies.append(latency)
+        except (OSError, http.client.HTTPException, threading.BrokenBarrierError):
+            pass
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=send) for _ in range(size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def run(args, coalesce):
+    env = dict(os.environ)
+    env.update({
+        "CHAT_MODEL_BACKEND": "fake",
+        "FAKE_MODEL_LATENCY": args.latency,
+        "FAKE_MODEL_TOKEN_RATE": str(args.token_rate),
+        "CHAT_RATE_PER_MINUTE": "0",
+        "CHAT_RESPONSE_CACHE": "0",
+        "CHAT_TIMING_LOG": "0",
+        "CHAT_COALESCE": "1" if coalesce else "0",
+        "PYTHONUNBUFFERED": "1",
+    })
+    env.pop("CHAT_LOG_DIR", None)
+    process, port, error = start_server(args.target, env)
+    if process is None:
+        print(f"server did not start: {error}")
+        sys.exit(1)
+    chat_path, metrics_path = CHAT_PATHS[args.target]
+    payload = {"message": args.message, "character_id": args.character}
+    if args.stream:
+        payload["stream"] = True
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    try:
+        latencies = []
+        for _ in range(args.waves):
+            latencies.extend(burst(port, chat_path, body, args.burst))
+        saved = coalesced_total(port, metrics_path)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+    sent = args.burst * args.waves
+    latencies.sort()
+    return {
+        "requests": sent,
+        "ok": len(latencies),
+        "upstream_calls": sent - saved,
+        "saved": saved,
+        "latency_ms": {p: round(percentile(latencies, int(p[1:])) * 1000, 1) if latencies else None
+                       for p in ("p50", "p95", "p99")},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=sorted(CHAT_PATHS), default='chat')
+    parser.add_argument('--burst', type=int, default=64, help='1回に同時に送る件数')
+    parser.add_argument('--waves', type=int, default=5)
+    parser.add_argument('--message', default='霊夢おはよう')
+    parser.add_argument('--character', default='reimu')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--latency', default='constant:0.5', help='フェイクモデルの遅延分布（FAKE_MODEL_LATENCY）')
+    parser.add_argument('--token-rate', type=float, default=200.0, help='フェイクモデルのトークン/秒')
+    parser.add_argument('--output', help='結果JSONの保存先')
+    args = parser.parse_args()
+
+    results = {}
+    for name, coalesce in (('coalesce', True), ('no_coalesce', False)):
+        r = results[name] = run(args, coalesce)
+        latency = r["latency_ms"]
+        print(f"  {name:<12} requests={r['requests']} ok={r['ok']} upstream={r['upstream_calls']} "
+              f"saved={r['saved']} p50={latency['p50']}ms p99={latency['p99']}ms")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != 'output'}, "results": results},
+                      f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""エントリーポイントごとのコールドスタート計測
+
+    python bench/cold_start.py                     # 全エントリーポイントを5回ずつ計測
+    python bench/cold_start.py --targets chat --runs 10
+    python bench/cold_start.py --budget bench/cold_start_budget.json   # 予算超過なら終了コード1
+
+毎回新しいプロセスで次を測り、中央値を出す。
+
+- import_ms:     エントリーポイントのモジュール読み込み（Gemini設定あり・SDKは遅延読み込み）
+- first_get_ms:  プロセス起動から最初のGET（ヘルスチェック）の応答まで
+- first_post_ms: 最初のPOST（チャット）の応答時間（フェイクモデル）
+
+sdk_loaded はモジュール読み込みの時点で google.generativeai が読み込まれていたか。
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from run import BENCH_DIR, free_port
+
+API_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'api')
+TARGETS = ('chat', 'characters', 'index', 'asgi')
+
+# 最初のGET / POST に使うパス
+PATHS = {
+    'chat': ('/api/chat', '/api/chat'),
+    'characters': ('/api/characters', None),
+    'index': ('/characters', '/chat'),
+    'asgi': ('/api/chat', '/api/chat'),
+}
+
+# モジュール読み込みだけを測る子プロセスのコード
+_IMPORT_PROBE = """
+import json, sys, time
+sys.path.insert(0, {bench_dir!r})
+start = time.perf_counter()
+if {target!r} == 'asgi':
+    sys.path.insert(0, {api_dir!r})
+    import _lib.asgi
+else:
+    from serve import load_entry_point
+    load_entry_point({target!r})
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({{"import_ms": elapsed, "sdk_loaded": "google.generativeai" in sys.modules}}))
+"""
+
+
+def measure_import(target, env):
+    code = _IMPORT_PROBE.format(bench_dir=BENCH_DIR, api_dir=API_DIR, target=target)
+    probe_env = dict(env, GEMINI_API_KEY="cold-start-probe", CHAT_MODEL_BACKEND="gemini")
+    result = subprocess.run([sys.executable, '-c', code], env=probe_env, capture_output=True, text=True)
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else 'import failed')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _request(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        headers = {'Content-Type': 'application/json'} if body else {}
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def measure_first_response(target, env, timeout=20.0):
+    get_path, post_path = PATHS[target]
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, 'serve.py'), target, '--port', str(port)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    try:
+        # 起動を待ちながらGETを投げ続け、最初に成功した時点までを測る
+        while True:
+            if process.poll() is not None:
+                lines = process.stderr.read().decode('utf-8', 'replace').strip().splitlines()
+                raise RuntimeError(lines[-1] if lines else 'server exited')
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError('server did not respond')
+            try:
+                if _request(port, 'GET', get_path) == 200:
+                    break
+            except OSError:
+                time.sleep(0.01)
+        first_get = (time.perf_counter() - start) * 1000
+        first_post = None
+        if post_path:
+            body = json.dumps({"message": "こんにちは", "character_id": "reimu"}).encode('utf-8')
+            post_start = time.perf_counter()
+            _request(port, 'POST', post_path, body)
+            first_post = (time.perf_counter() - post_start) * 1000
+        return first_get, first_post
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def bench_target(target, runs, env):
+    samples = {"import_ms": [], "first_get_ms": [], "first_post_ms": []}
+    sdk_loaded = False
+    for _ in range(runs):
+        probe = measure_import(target, env)
+        samples["import_ms"].append(probe["import_ms"])
+        sdk_loaded = sdk_loaded or probe["sdk_loaded"]
+        first_get, first_post = measure_first_response(target, env)
+        samples["first_get_ms"].append(first_get)
+        if first_post is not None:
+            samples["first_post_ms"].append(first_post)
+    result = {name: round(statistics.median(values), 1) for name, values in samples.items() if values}
+    result["sdk_loaded"] = sdk_loaded
+    return result
+
+
+def check_budget(results, budget):
+    """予算を超えた項目を (target, 項目, 計測値, 予算) のリストで返す"""
+    over = []
+    for target, limits in budget.items():
+        result = results.get(target)
+        if not result or "skipped" in result:
+            continue
+        for name, limit in limits.items():
+            value = result.get(name)
+            if isinstance(value, bool):
+                if value != limit:
+                    over.append((target, name, value, limit))
+            elif value is not None and value > limit:
+                over.append((target, name, value, limit))
+    return over
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', default=','.join(TARGETS))
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', help='予算のJSON（例: bench/cold_start_budget.json）')
+    parser.add_argument('--output', help='結果JSONの保存先')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update({
+        "CHAT_MODEL_BACKEND": "fake",
+        "FAKE_MODEL_LATENCY": "constant:0",
+        "FAKE_MODEL_TOKEN_RATE": "0",
+        "CHAT_TIMING_LOG": "0",
+        "PYTHONUNBUFFERED": "1",
+    })
+    env.pop("CHAT_EAGER_INIT", None)
+
+    results = {}
+    for target in args.targets.split(','):
+        try:
+            results[target] = bench_target(target, args.runs, env)
+        except RuntimeError as e:
+            print(f"  skip {target}: {e}")
+            results[target] = {"skipped": str(e)}
+            continue
+        r = results[target]
+        print(f"  {target}: import={r['import_ms']}ms first_get={r['first_get_ms']}ms "
+              f"first_post={r.get('first_post_ms', '-')}ms sdk_loaded={r['sdk_loaded']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.budget:
+        with open(args.budget, encoding='utf-8') as f:
+            over = check_budget(results, json.load(f))
+        for target, name, value, limit in over:
+            print(f"  over budget: {target}.{name} = {value} (budget {limit})")
+        if over:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
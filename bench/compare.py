@@ -0,0 +1,66 @@
+"""2つのベンチマーク結果（bench/run.py の出力）を比較する
+
+    python bench/compare.py bench/results/before.json bench/results/after.json --threshold 0.1
+
+レイテンシ（p50/p95/p99）が threshold 以上悪化したか、スループットが threshold 以上
+落ちたシナリオがあれば一覧を出して終了コード1で終わる。
+"""
+import argparse
+import json
+import sys
+
+
+def _load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)["results"]
+
+
+def _ratio(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before
+
+
+def compare(before, after, threshold):
+    """(表示用の行, 回帰の行) を返す"""
+    rows = []
+    regressions = []
+    for target, result in after.items():
+        old_scenarios = before.get(target, {}).get("scenarios", {})
+        for name, summary in result.get("scenarios", {}).items():
+            old = old_scenarios.get(name)
+            if old is None:
+                continue
+            checks = [(f"latency.{p}", old["latency_ms"][p], summary["latency_ms"][p], 1)
+                      for p in ("p50", "p95", "p99")]
+            checks.append(("throughput", old["throughput_rps"], summary["throughput_rps"], -1))
+            for metric, old_value, new_value, direction in checks:
+                change = _ratio(old_value, new_value)
+                if change is None:
+                    continue
+                line = f"{target}/{name} {metric}: {old_value} -> {new_value} ({change:+.1%})"
+                rows.append(line)
+                if change * direction > threshold:
+                    regressions.append(line)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマーク結果を比較して回帰を検出する')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1, help='許容する悪化の割合（0.1 = 10%%）')
+    args = parser.parse_args()
+
+    rows, regressions = compare(_load(args.before), _load(args.after), args.threshold)
+    for row in rows:
+        print(row)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}:")
+        for row in regressions:
+            print(f"  {row}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
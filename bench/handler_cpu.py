@@ -0,0 +1,206 @@
+"""HTTPハンドラー（api/chat.py・api/characters.py）の1リクエストあたりのCPU時間
+
+    python bench/handler_cpu.py                          # 各リクエストの種類ごとに計測
+    python bench/handler_cpu.py --budget-us 300          # どれかの p99 が予算を超えたら終了コード1
+    CHAT_JSON_CODEC=json python bench/handler_cpu.py     # orjson があっても標準ライブラリで比較
+
+ソケットの代わりにメモリ上のバッファを渡して handler クラスを同じプロセスで動かし、
+リクエストの解析・検証・JSONのエンコード・ヘッダーの送信にかかるCPU時間（time.thread_time_ns）を測る。
+モデルはフェイク（遅延なし）で、応答キャッシュは切っておく。keepalive は1つの接続で
+--pipeline 件のリクエストを続けて処理したときの1件あたりの時間。
+
+メモリ上のバッファでは TCP の振る舞い（Nagle と遅延ACKによる待ち）が見えないので、
+*_socket_keepalive_us だけは実際にサーバーを立て、1つの接続で続けて送ったときの1件あたりの
+経過時間（CPU時間ではない）を測る。
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+from loadgen import percentile
+
+os.environ.update({
+    "CHAT_MODEL_BACKEND": "fake",
+    "FAKE_MODEL_LATENCY": "constant:0",
+    "FAKE_MODEL_TOKEN_RATE": "0",
+    "CHAT_RESPONSE_CACHE": "0",
+    "CHAT_RATE_PER_MINUTE": "0",
+    "CHAT_TIMING_LOG": "0",
+})
+os.environ.pop("CHAT_LOG_DIR", None)
+
+from serve import BenchHTTPServer, QuietHandlerMixin, load_entry_point
+
+_MESSAGES = ["こんにちは！", "今日は何をしていたの？", "弾幕ごっこで勝つコツを教えて", "お賽銭は入ってる？"]
+
+
+class _FakeSocket:
+    """makefile() でリクエストを読ませ、sendall() で書かれた応答をためる"""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self.sent = []
+
+    def makefile(self, mode, buffering=None):
+        return io.BytesIO(self._raw)
+
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+
+def _request(method, path, body=None, headers=()):
+    lines = [f"{method} {path} HTTP/1.1", "Host: localhost"]
+    lines += [f"{key}: {value}" for key, value in headers]
+    if body is not None:
+        lines += ["Content-Type: application/json", f"Content-Length: {len(body)}"]
+    return "\r\n".join(lines).encode('latin-1') + b"\r\n\r\n" + (body or b'')
+
+
+def _chat_body(i, **extra):
+    payload = {"message": _MESSAGES[i % len(_MESSAGES)], "character_id": "reimu", **extra}
+    return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+
+def _cases():
+    """{名前: (エントリーポイント, i番目のリクエストを返す関数)}"""
+    return {
+        "characters_list": ('characters', lambda i: _request('GET', '/api/characters')),
+        "characters_304": ('characters', lambda i: _request(
+            'GET', '/api/characters/reimu', headers=[('If-None-Match', _etag('reimu'))])),
+        "chat_status": ('chat', lambda i: _request('GET', '/api/chat')),
+        "chat_json": ('chat', lambda i: _request('POST', '/api/chat', _chat_body(i))),
+        "chat_stream": ('chat', lambda i: _request('POST', '/api/chat', _chat_body(i, stream=True))),
+        "chat_bad_request": ('chat', lambda i: _request('POST', '/api/chat', b'{"message": ')),
+        "batch_json": ('chat', lambda i: _request('POST', '/api/chat/batch', json.dumps(
+            {"message": _MESSAGES[i % len(_MESSAGES)], "character_ids": ["reimu", "marisa", "sakuya"]},
+            ensure_ascii=False).encode('utf-8'))),
+    }
+
+
+def _etag(character_id):
+    from _lib.registry import CHARACTERS
+    return CHARACTERS[character_id].etag
+
+
+def handle(handler, raw):
+    """1つの接続で raw（1件以上のリクエスト）を処理し、(CPU時間ns, 応答のバイト列) を返す"""
+    sock = _FakeSocket(raw)
+    start = time.thread_time_ns()
+    handler(sock, ('127.0.0.1', 0), None)
+    return time.thread_time_ns() - start, b''.join(sock.sent)
+
+
+def bench(handler, make_request, iterations, warmup=20):
+    for i in range(warmup):
+        handle(handler, make_request(i))
+    samples = []
+    for i in range(iterations):
+        elapsed, _ = handle(handler, make_request(i))
+        samples.append(elapsed / 1000)
+    return sorted(samples)
+
+
+def bench_keepalive(handler, make_request, iterations, pipeline):
+    """1つの接続で pipeline 件続けて処理したときの1件あたりのCPU時間"""
+    samples = []
+    for i in range(max(iterations // pipeline, 1)):
+        raw = b''.join(make_request(i * pipeline + j) for j in range(pipeline))
+        elapsed, response = handle(handler, raw)
+        assert response.count(b'HTTP/1.1 200') == pipeline, "接続が途中で閉じられました"
+        samples.append(elapsed / 1000 / pipeline)
+    return sorted(samples)
+
+
+def bench_socket_keepalive(handler, make_request, iterations):
+    """実際のソケット上で、1つの接続に続けて送ったときの1件あたりの経過時間"""
+    server = BenchHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=10)
+    samples = []
+    try:
+        for i in range(iterations):
+            method, path, body, headers = make_request(i)
+            start = time.perf_counter_ns()
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            samples.append((time.perf_counter_ns() - start) / 1000)
+            assert not response.will_close, "接続が使い回されていません"
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
+    # 1件目は接続の確立を含むので除く
+    return sorted(samples[1:])
+
+
+def _socket_cases():
+    """{名前: (エントリーポイント, i番目の (method, path, body, headers) を返す関数)}"""
+    json_headers = lambda body: {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+    return {
+        "characters_list": ('characters', lambda i: ('GET', '/api/characters', None, {})),
+        "chat_json": ('chat', lambda i: ('POST', '/api/chat', _chat_body(i), json_headers(_chat_body(i)))),
+    }
+
+
+def _summary(samples):
+    result = {p: round(percentile(samples, int(p[1:])), 2) for p in ("p50", "p95", "p99")}
+    result["max"] = round(samples[-1], 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--pipeline', type=int, default=10, help='keepalive で1接続に続けて送る件数')
+    parser.add_argument('--budget-us', type=float, help='p99 の予算（マイクロ秒）')
+    parser.add_argument('--output', help='結果JSONの保存先')
+    args = parser.parse_args()
+
+    handlers = {}
+    for name in ('chat', 'characters'):
+        module = load_entry_point(name)
+        handlers[name] = type('handler', (QuietHandlerMixin, module.handler), {})
+    from _lib.jsoncodec import CODEC
+
+    results = {}
+    for name, (target, make_request) in _cases().items():
+        results[f"{name}_us"] = _summary(bench(handlers[target], make_request, args.iterations))
+    for name in ("characters_list", "chat_json"):
+        target, make_request = _cases()[name]
+        results[f"{name}_keepalive_us"] = _summary(
+            bench_keepalive(handlers[target], make_request, args.iterations, args.pipeline))
+
+    for name, (target, make_request) in _socket_cases().items():
+        results[f"{name}_socket_keepalive_us"] = _summary(
+            bench_socket_keepalive(handlers[target], make_request, min(args.iterations, 500)))
+
+    print(f"  codec: {CODEC}")
+    for name, values in results.items():
+        print(f"  {name}: " + " ".join(f"{p}={v}us" for p, v in values.items()))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"codec": CODEC, "results": results}, f, ensure_ascii=False, indent=2)
+    if args.budget_us is not None:
+        over = [name for name, values in results.items() if values["p99"] > args.budget_us]
+        for name in over:
+            print(f"  over budget: {name} p99 {results[name]['p99']}us > {args.budget_us}us")
+        if over:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""スレッドベースの負荷生成と集計"""
+import http.client
+import math
+import threading
+import time
+
+
+def percentile(sorted_values, p):
+    """最近傍法によるパーセンタイル（sorted_values は昇順）"""
+    if not sorted_values:
+        return None
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[min(len(sorted_values), max(rank, 1)) - 1]
+
+
+def summarize(samples, errors, elapsed):
+    """リクエストごとの (latency, ttfb) から集計値を作る（時間はミリ秒）"""
+    latencies = sorted(latency for latency, _ in samples)
+    ttfbs = sorted(ttfb for _, ttfb in samples)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "requests": len(samples) + errors,
+        "ok": len(samples),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1]) if latencies else None,
+        },
+        "ttfb_ms": {
+            "p50": ms(percentile(ttfbs, 50)),
+            "p95": ms(percentile(ttfbs, 95)),
+            "p99": ms(percentile(ttfbs, 99)),
+        },
+    }
+
+
+def timed_request(conn, method, path, body, headers):
+    start = time.perf_counter()
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    # 最初の1バイトが届いた時点をTTFBとする（ヘッダーだけ先に送る実装があるため）
+    first = response.read(1)
+    ttfb = time.perf_counter() - start
+    response.read()
+    latency = time.perf_counter() - start
+    if not first and response.status not in (204, 304):
+        ttfb = latency
+    return response, latency, ttfb
+
+
+def run_load(host, port, make_request, concurrency=8, requests=100, duration=None, timeout=60):
+    """concurrency 本のスレッドで make_request(i) -> (method, path, body, headers) を送り続ける
+
+    requests 件送り終えるか、duration 秒経過したら止める。
+    """
+    lock = threading.Lock()
+    samples = []
+    error_count = [0]
+    counter = [0]
+    deadline = None if duration is None else time.perf_counter() + duration
+
+    def next_index():
+        with lock:
+            if requests is not None and counter[0] >= requests:
+                return None
+            if deadline is not None and time.perf_counter() >= deadline:
+                return None
+            counter[0] += 1
+            return counter[0] - 1
+
+    def worker():
+        conn = None
+        while True:
+            index = next_index()
+            if index is None:
+                break
+            method, path, body, headers = make_request(index)
+            try:
+                if conn is None:
+                    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+                response, latency, ttfb = timed_request(conn, method, path, body, headers)
+                ok = 200 <= response.status < 400
+                if response.will_close:
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException):
+                ok = False
+                if conn is not None:
+                    conn.close()
+                conn = None
+            with lock:
+                if ok:
+                    samples.append((latency, ttfb))
+                else:
+                    error_count[0] += 1
+        if conn is not None:
+            conn.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(samples, error_count[0], time.perf_counter() - start)
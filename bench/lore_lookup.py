@@ -0,0 +1,82 @@
+"""設定資料の検索（api/_lib/lore.py）1回あたりの時間
+
+    python bench/lore_lookup.py                        # 既定の索引（api/_lib/lore.idx）で計測
+    python bench/lore_lookup.py --iterations 5000 --budget-us 1000   # p99 が予算を超えたら終了コード1
+    python bench/lore_lookup.py --show                 # 発言ごとに選ばれた断片を表示
+
+発言の分割・ハッシュ・索引の二分探索・スコアの集計・断片の取り出しまで（retrieve 全体）を測る。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from loadgen import percentile
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')
+sys.path.insert(0, API_DIR)
+from _lib.lore import INDEX_PATH, load_index
+
+# (キャラクター, 発言)
+_SAMPLES = [
+    ('reimu', 'こんにちは！今日はいい天気だね。'),
+    ('reimu', '魔理沙のことどう思う？'),
+    ('reimu', 'お賽銭はいくら入ってる？'),
+    ('marisa', '香霖堂って何のお店？'),
+    ('marisa', 'アリスと仲いいの？'),
+    ('sakuya', '美鈴がまた門の前で寝てたよ'),
+    ('yuyuko', '妖夢は元気にしてる？'),
+    ('yuyuko', '西行妖の下には何が眠っているの？'),
+    ('meiling', '咲夜さんって怖い？'),
+    ('remilia', '紅い霧の異変について教えて'),
+    ('koishi', 'お姉ちゃんのこと好き？'),
+    ('koishi', 'おくうは今なにしてるの？'),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--index', default=INDEX_PATH)
+    parser.add_argument('--iterations', type=int, default=2000, help='発言ごとの繰り返し回数')
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--vector-weight', type=float, default=0.0, help='ベクトルの重み（NumPy が必要）')
+    parser.add_argument('--budget-us', type=float, help='p99 の予算（マイクロ秒）')
+    parser.add_argument('--show', action='store_true')
+    parser.add_argument('--output', help='結果JSONの保存先')
+    args = parser.parse_args()
+
+    index = load_index(args.index, top_k=args.top_k, vector_weight=args.vector_weight)
+    if args.show:
+        for character_id, message in _SAMPLES:
+            print(f"{character_id}: {message}")
+            for doc, score in index.search(character_id, message):
+                print(f"  {score:6.2f} {index.meta['sources'][doc]}: {index.text(doc)[:40]}…")
+
+    samples = []
+    for _ in range(args.iterations):
+        for character_id, message in _SAMPLES:
+            start = time.perf_counter_ns()
+            index.retrieve(character_id, message)
+            samples.append((time.perf_counter_ns() - start) / 1000)
+    samples.sort()
+    result = {
+        "chunks": index.chunk_count,
+        "lookups": len(samples),
+        "vector_weight": index.vector_weight,
+        "lookup_us": {p: round(percentile(samples, int(p[1:])), 1) for p in ("p50", "p95", "p99")},
+    }
+    result["lookup_us"]["max"] = round(samples[-1], 1)
+    print(f"{result['chunks']} chunks, {result['lookups']} lookups: "
+          + " ".join(f"{name}={value}us" for name, value in result["lookup_us"].items()))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.budget_us is not None and result["lookup_us"]["p99"] > args.budget_us:
+        print(f"  over budget: p99 {result['lookup_us']['p99']}us > {args.budget_us}us")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""応答の後処理（api/_lib/postprocess.py）の同期部分のオーバーヘッド
+
+    python bench/postprocess.py                          # 応答全体・ストリーム（チャンクごと）を計測
+    python bench/postprocess.py --budget-us 50           # どちらかの p99 が予算を超えたら終了コード1
+
+リクエストの処理中に走る部分（禁止語・長さ・口調のチェック）だけを測る。
+ワーカーで行う重いチェックは応答の時間に含まれないので、ここでは測らない。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from loadgen import percentile
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')
+sys.path.insert(0, API_DIR)
+from _lib.postprocess import PostProcessor
+from _lib.registry import CHARACTERS
+
+# 実際の応答に近い長さ（80〜250文字程度）の例
+_REPLIES = [
+    "あら、またあんたなの？お賽銭を入れてくれるなら話くらい聞いてあげてもいいわよ。"
+    "今日は神社も静かで、縁側でお茶を飲んでいたところ。異変でもなければ、私はずっとこうしていたいのよね。",
+    "よう！ちょうど新しい魔法の実験をしてたところだぜ。キノコの組み合わせを変えたら、"
+    "思ったよりでかい光が出ちまってな。パチュリーの図書館で借りた本に載ってたんだ。まあ、返すのはそのうちだぜ。",
+    "いらっしゃいませ。お嬢様はただいまお休みになっておりますので、ご用件は私が承りますわ。"
+    "紅茶はいかがでしょう。美鈴がまた居眠りをしていたようですが、後ほどきちんと言い聞かせておきます。",
+    "あら〜、いらっしゃい。ちょうどお腹が空いてきたところなのよ。妖夢に何か作ってもらおうかしら。"
+    "桜の季節は、食べるものも美味しく感じるわね。ふふふ、貴方も一緒にいかが？",
+    "ねぇ、今あなたの後ろにいたの、気づいた？ふふ、無意識って不思議だよね。"
+    "お姉ちゃんは心が読めるけど、私のことは読めないんだって。",
+]
+
+
+def _timed(samples, func, *args):
+    start = time.perf_counter_ns()
+    func(*args)
+    samples.append((time.perf_counter_ns() - start) / 1000)
+
+
+def bench_reply(processor, characters, iterations):
+    samples = []
+    for _ in range(iterations):
+        for character in characters:
+            for reply in _REPLIES:
+                _timed(samples, processor.apply, character, reply)
+    return sorted(samples)
+
+
+def bench_stream(processor, characters, iterations, chunk_chars):
+    """チャンクごとの feed と最後の finish の時間"""
+    samples = []
+    for _ in range(iterations):
+        for character in characters:
+            for reply in _REPLIES:
+                checker = processor.stream_filter(character)
+                for i in range(0, len(reply), chunk_chars):
+                    _timed(samples, checker.feed, reply[i:i + chunk_chars])
+                _timed(samples, checker.finish)
+    return sorted(samples)
+
+
+def _summary(samples):
+    result = {p: round(percentile(samples, int(p[1:])), 2) for p in ("p50", "p95", "p99")}
+    result["max"] = round(samples[-1], 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--chunk-chars', type=int, default=12, help='ストリームの1チャンクの文字数')
+    parser.add_argument('--budget-us', type=float, help='p99 の予算（マイクロ秒）')
+    parser.add_argument('--output', help='結果JSONの保存先')
+    args = parser.parse_args()
+
+    # 重いチェックは測らないので、ワーカーには回さない
+    processor = PostProcessor(background_checks=())
+    characters = list(CHARACTERS.values())
+    results = {
+        "reply_us": _summary(bench_reply(processor, characters, args.iterations)),
+        "stream_chunk_us": _summary(bench_stream(processor, characters, args.iterations, args.chunk_chars)),
+    }
+    for name, values in results.items():
+        print(f"  {name}: " + " ".join(f"{p}={v}us" for p, v in values.items()))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.budget_us is not None:
+        over = [name for name, values in results.items() if values["p99"] > args.budget_us]
+        for name in over:
+            print(f"  over budget: {name} p99 {results[name]['p99']}us > {args.budget_us}us")
+        if over:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
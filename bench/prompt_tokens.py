@@ -0,0 +1,78 @@
+"""プロンプトのトークン内訳（固定のキャラクタープロンプト / リクエストごとの会話部分）
+
+    python bench/prompt_tokens.py                      # 推定値でキャラクターごとに表示
+    python bench/prompt_tokens.py --history 6          # 履歴6件（3往復）がある場合
+    python bench/prompt_tokens.py --metrics http://localhost:8000/api/chat/metrics
+
+両方ともリクエストごとに送られ、入力トークンとして課金される（system_instruction で渡す固定部分も同じ）。
+ここで出すのはその内訳だけで、削減量ではない。
+会話部分には、発言に関係する設定資料の断片（CHAT_LORE_TOP_K 件まで）も含む。
+--metrics を付けると稼働中のサーバーの chat_prompt_tokens_total から実際の累計を集計する。
+"""
+import argparse
+import os
+import re
+import sys
+import urllib.request
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')
+sys.path.insert(0, API_DIR)
+from _lib.lore import create_lore_index
+from _lib.prompts import build_turn_prompt
+from _lib.registry import CHARACTERS
+from _lib.sessions import estimate_tokens
+
+_SAMPLE_HISTORY = [
+    ('user', 'こんにちは！今日は何をしているの？'),
+    ('assistant', 'ちょうどお茶を淹れたところよ。あなたも飲んでいく？'),
+]
+
+_METRIC_LINE = re.compile(r'^chat_prompt_tokens_total\{character="([^"]*)",part="([^"]*)"\} (\S+)$')
+
+
+def _row(name, static, dynamic):
+    total = static + dynamic
+    share = static / total * 100 if total else 0.0
+    return f"{name:<10} {static:>8} {dynamic:>8} {total:>8} {share:>7.1f}%"
+
+
+def estimate(message, history_turns):
+    history = (_SAMPLE_HISTORY * history_turns)[:history_turns]
+    index = create_lore_index()
+    print(f"{'character':<10} {'static':>8} {'dynamic':>8} {'total':>8} {'static%':>8}")
+    for character in CHARACTERS.values():
+        lore = index.retrieve(character.id, message) if index is not None else ()
+        dynamic = estimate_tokens(build_turn_prompt(character, message, history, lore))
+        print(_row(character.id, character.prompt_tokens, dynamic))
+
+
+def from_metrics(url):
+    totals = {}
+    with urllib.request.urlopen(url) as response:
+        for line in response.read().decode('utf-8').splitlines():
+            match = _METRIC_LINE.match(line)
+            if match:
+                character, part, value = match.groups()
+                totals.setdefault(character, {})[part] = int(float(value))
+    if not totals:
+        print("chat_prompt_tokens_total がまだ記録されていません。")
+        return
+    print(f"{'character':<10} {'static':>8} {'dynamic':>8} {'total':>8} {'static%':>8}")
+    for character, parts in sorted(totals.items()):
+        print(_row(character, parts.get('static', 0), parts.get('dynamic', 0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--message', default='こんにちは！今日はいい天気だね。')
+    parser.add_argument('--history', type=int, default=0, help='プロンプトに載せる履歴の件数')
+    parser.add_argument('--metrics', help='稼働中のサーバーの /metrics のURL')
+    args = parser.parse_args()
+    if args.metrics:
+        from_metrics(args.metrics)
+    else:
+        estimate(args.message, args.history)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""記録した会話ログ（CHAT_LOG_DIR）を、元の到着間隔のままサーバーに流し直す
+
+    python bench/replay.py --log-dir /var/log/chat --target chat
+    python bench/replay.py --log-dir /var/log/chat --target index --speed 2    # 2倍の負荷
+    python bench/replay.py --jsonl export.jsonl --target asgi --speed 5 --max-gap 10
+
+サーバーは bench/run.py と同じくフェイクモデルで起動するので、上流を除いたサーバー側の
+性能を実際の発言の長さ・キャラクターの偏り・バースト具合で測れる。
+
+送信は到着時刻どおりのオープンループで行う（前の応答を待たない）。
+queue_ms は予定時刻から実際に送り始めるまでの遅れで、送信側のスレッドが埋まる
+（サーバーが追いつかない）と大きくなる。結果はキャラクターごとに集計する。
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loadgen import percentile, timed_request
+from run import BENCH_DIR, start_server
+
+API_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'api')
+sys.path.insert(0, API_DIR)
+from _lib.convlog import LogReader
+
+# ターゲットごとのチャットのパス
+CHAT_PATHS = {'chat': '/api/chat', 'index': '/chat', 'asgi': '/api/chat'}
+
+
+def load_records(args):
+    if args.jsonl:
+        with open(args.jsonl, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    else:
+        records = list(LogReader(args.log_dir).scan())
+    # エラーで終わったやり取りも、リクエストとしては届いていたので流し直す
+    records = [r for r in records if isinstance(r.get('message'), str) and r.get('message')]
+    records.sort(key=lambda r: r['ts'])
+    return records[:args.limit] if args.limit else records
+
+
+def schedule(records, speed, max_gap=None):
+    """各レコードの送信予定時刻（開始からの秒数）を返す"""
+    offsets = []
+    elapsed = 0.0
+    previous = records[0]['ts'] if records else 0.0
+    for record in records:
+        gap = record['ts'] - previous
+        if max_gap is not None:
+            gap = min(gap, max_gap)
+        elapsed += gap / speed
+        offsets.append(elapsed)
+        previous = record['ts']
+    return offsets
+
+
+def _request_for(record, path, sessions):
+    payload = {"message": record['message'], "character_id": record.get('character')}
+    if sessions and record.get('session_id'):
+        payload["session_id"] = record['session_id']
+    if record.get('mode') == 'stream':
+        payload["stream"] = True
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return body, {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+
+
+def replay(records, offsets, port, path, workers, sessions=True, timeout=60):
+    """[(キャラクター, ok, latency, queue_delay)] を返す"""
+    results = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(record, due):
+        queue_delay = time.perf_counter() - due
+        body, headers = _request_for(record, path, sessions)
+        ok, latency = False, None
+        try:
+            conn = getattr(local, 'conn', None)
+            if conn is None:
+                conn = local.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+            response, latency, _ = timed_request(conn, 'POST', path, body, headers)
+            ok = response.status == 200
+            if response.will_close:
+                conn.close()
+                local.conn = None
+        except (OSError, http.client.HTTPException):
+            if getattr(local, 'conn', None) is not None:
+                local.conn.close()
+            local.conn = None
+        with lock:
+            results.append((record.get('character'), ok, latency, queue_delay))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for record, offset in zip(records, offsets):
+            due = start + offset
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(send, record, due)
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    def ms(values, p):
+        value = percentile(values, p)
+        return None if value is None else round(value * 1000, 3)
+
+    groups = {}
+    for character, ok, latency, queue_delay in results:
+        for key in ('all', character):
+            group = groups.setdefault(key, {"latencies": [], "queues": [], "errors": 0, "requests": 0})
+            group["requests"] += 1
+            group["queues"].append(queue_delay)
+            if ok:
+                group["latencies"].append(latency)
+            else:
+                group["errors"] += 1
+
+    summary = {}
+    for key, group in groups.items():
+        latencies, queues = sorted(group["latencies"]), sorted(group["queues"])
+        summary[key] = {
+            "requests": group["requests"],
+            "errors": group["errors"],
+            "error_rate": round(group["errors"] / group["requests"], 4),
+            "latency_ms": {p: ms(latencies, int(p[1:])) for p in ("p50", "p95", "p99")},
+            "queue_ms": {p: ms(queues, int(p[1:])) for p in ("p50", "p95", "p99")},
+        }
+    summary["all"]["elapsed_s"] = round(elapsed, 3)
+    summary["all"]["throughput_rps"] = round(len(results) / elapsed, 2) if elapsed > 0 else None
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--log-dir', help='会話ログのディレクトリ（CHAT_LOG_DIR）')
+    source.add_argument('--jsonl', help='scripts/query_log.py で書き出した JSON Lines')
+    parser.add_argument('--target', choices=sorted(CHAT_PATHS), default='chat')
+    parser.add_argument('--speed', type=float, default=1.0, help='到着間隔を何倍速にするか（2 で2倍の負荷）')
+    parser.add_argument('--max-gap', type=float, help='これより長い無通信の間隔は詰める（秒）')
+    parser.add_argument('--limit', type=int, help='先頭から何件を流すか')
+    parser.add_argument('--workers', type=int, default=256, help='送信スレッド数の上限')
+    parser.add_argument('--no-sessions', action='store_true', help='session_id を付けずに送る')
+    parser.add_argument('--latency', default='constant:0.05', help='フェイクモデルの遅延分布（FAKE_MODEL_LATENCY）')
+    parser.add_argument('--token-rate', type=float, default=200.0, help='フェイクモデルのトークン/秒')
+    parser.add_argument('--output', help='結果JSONの保存先')
+    args = parser.parse_args()
+
+    records = load_records(args)
+    if not records:
+        print("流し直すレコードがありません。")
+        sys.exit(1)
+    offsets = schedule(records, args.speed, args.max_gap)
+    print(f"{len(records)} records over {offsets[-1]:.1f}s (speed x{args.speed})")
+
+    env = dict(os.environ)
+    env.update({
+        "CHAT_MODEL_BACKEND": "fake",
+        "FAKE_MODEL_LATENCY": args.latency,
+        "FAKE_MODEL_TOKEN_RATE": str(args.token_rate),
+        "CHAT_RATE_PER_MINUTE": "0",
+        "CHAT_TIMING_LOG": "0",
+        "PYTHONUNBUFFERED": "1",
+    })
+    # 流し直したやり取りを同じディレクトリに書き足さない
+    env.pop("CHAT_LOG_DIR", None)
+
+    process, port, error = start_server(args.target, env)
+    if process is None:
+        print(f"server did not start: {error}")
+        sys.exit(1)
+    try:
+        results, elapsed = replay(records, offsets, port, CHAT_PATHS[args.target], args.workers,
+                                  sessions=not args.no_sessions)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+    summary = summarize(results, elapsed)
+    print(f"{'character':<10} {'reqs':>6} {'err%':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'queue p99':>10}")
+    for key in ['all'] + sorted(k for k in summary if k != 'all'):
+        s = summary[key]
+        latency = s["latency_ms"]
+        print(f"{key:<10} {s['requests']:>6} {s['error_rate'] * 100:>5.1f}% {latency['p50'] or '-':>9} "
+              f"{latency['p95'] or '-':>9} {latency['p99'] or '-':>9} {s['queue_ms']['p99']:>10}")
+
+    if args.output:
+        report = {"config": {k: v for k, v in vars(args).items() if k != 'output'}, "results": summary}
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
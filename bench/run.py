@@ -0,0 +1,190 @@
+"""チャットAPI・キャラクターAPIのエンドツーエンドベンチマーク
+
+各エントリーポイントをフェイクモデル（遅延を指定可能）で起動し、並列に負荷をかけて
+p50/p95/p99 レイテンシ・TTFB・スループット・ワーカーのRSSを計測する。
+結果はJSONで保存し、bench/compare.py で過去の結果と比較できる。
+
+    python bench/run.py --latency constant:0.2 --concurrency 32 --requests 500
+    python bench/run.py --targets chat,asgi --output bench/results/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from loadgen import run_load
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MESSAGES = ('こんにちは', 'はじめまして', '何してるの？', '今日は何をして過ごしたの？', 'おすすめの食べ物を教えて')
+CHARACTER_IDS = ('reimu', 'marisa', 'sakuya', 'yuyuko', 'meiling', 'remilia', 'koishi')
+
+
+def chat_request(path, stream=False):
+    def make(index):
+        payload = {
+            "message": MESSAGES[index % len(MESSAGES)],
+            "character_id": CHARACTER_IDS[index % len(CHARACTER_IDS)],
+        }
+        if stream:
+            payload["stream"] = True
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        return 'POST', path, body, {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+    return make
+
+
+def get_request(path):
+    def make(index):
+        return 'GET', path, None, {}
+    return make
+
+
+# エントリーポイントごとのシナリオ（名前, リクエスト生成関数）
+SCENARIOS = {
+    'chat': [
+        ('chat', chat_request('/api/chat')),
+        ('chat_stream', chat_request('/api/chat', stream=True)),
+    ],
+    'characters': [
+        ('characters', get_request('/api/characters')),
+        ('character', get_request('/api/characters/reimu')),
+    ],
+    'index': [
+        ('characters', get_request('/characters')),
+        ('chat', chat_request('/chat')),
+        ('chat_stream', chat_request('/chat/stream')),
+    ],
+    'asgi': [
+        ('characters', get_request('/api/characters')),
+        ('chat', chat_request('/api/chat')),
+        ('chat_stream', chat_request('/api/chat', stream=True)),
+    ],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def read_rss_kb(pid):
+    """/proc から現在のRSSとピークRSS（KB）を読む。Linux以外では None"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    return {
+        "rss_kb": int(fields['VmRSS'].split()[0]),
+        "peak_rss_kb": int(fields['VmHWM'].split()[0]),
+    }
+
+
+def start_server(target, env):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, 'serve.py'), target, '--port', str(port)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    if not wait_for_port(port, process):
+        process.kill()
+        _, stderr = process.communicate()
+        lines = stderr.decode('utf-8', 'replace').strip().splitlines()
+        return None, None, lines[-1] if lines else 'server did not start'
+    return process, port, None
+
+
+def bench_target(target, args, env):
+    process, port, error = start_server(target, env)
+    if process is None:
+        print(f"  skip {target}: {error}")
+        return {"skipped": error}
+
+    results = {"idle": read_rss_kb(process.pid), "scenarios": {}}
+    try:
+        for name, make_request in SCENARIOS[target]:
+            # ウォームアップ（計測には含めない）
+            run_load('127.0.0.1', port, make_request, concurrency=1, requests=args.warmup)
+            summary = run_load(
+                '127.0.0.1', port, make_request,
+                concurrency=args.concurrency, requests=args.requests, duration=args.duration,
+            )
+            summary["memory"] = read_rss_kb(process.pid)
+            results["scenarios"][name] = summary
+            latency = summary["latency_ms"]
+            print(f"  {target}/{name}: {summary['throughput_rps']} rps  "
+                  f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms  "
+                  f"errors={summary['errors']}")
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='チャットAPIのエンドツーエンドベンチマーク')
+    parser.add_argument('--targets', default='chat,characters,index,asgi',
+                        help='計測するエントリーポイント（カンマ区切り）')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200, help='シナリオごとのリクエスト数')
+    parser.add_argument('--duration', type=float, help='シナリオごとの最大秒数')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--latency', default='constant:0.05', help='フェイクモデルの遅延分布（FAKE_MODEL_LATENCY）')
+    parser.add_argument('--token-rate', type=float, default=200.0, help='フェイクモデルのトークン/秒')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='結果JSONの保存先（既定: bench/results/<日時>.json）')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update({
+        "CHAT_MODEL_BACKEND": "fake",
+        "FAKE_MODEL_LATENCY": args.latency,
+        "FAKE_MODEL_TOKEN_RATE": str(args.token_rate),
+        "FAKE_MODEL_SEED": str(args.seed),
+        # 負荷生成は1つのIPから大量に送るのでレート制限は外す
+        "CHAT_RATE_PER_MINUTE": "0",
+        "PYTHONUNBUFFERED": "1",
+    })
+
+    started = datetime.now(timezone.utc)
+    report = {
+        "meta": {
+            "started_at": started.isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {key: value for key, value in vars(args).items() if key != 'output'},
+        },
+        "results": {},
+    }
+    for target in [t.strip() for t in args.targets.split(',') if t.strip()]:
+        print(f"[{target}]")
+        report["results"][target] = bench_target(target, args, env)
+
+    output = args.output or os.path.join(BENCH_DIR, 'results', started.strftime('%Y%m%dT%H%M%SZ') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"saved: {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""ベンチマーク用に各エントリーポイントをローカルで起動する
+
+    python bench/serve.py chat --port 9001
+    python bench/serve.py characters --port 9002
+    python bench/serve.py index --port 9003   # Flask
+    python bench/serve.py asgi --port 9004
+
+chat / characters は Vercel と同じく handler クラスをそのまま使い、
+ThreadingHTTPServer で1リクエスト1スレッドとして動かす。
+"""
+import argparse
+import asyncio
+import importlib.util
+import os
+import sys
+from http.server import ThreadingHTTPServer
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')
+sys.path.insert(0, API_DIR)
+
+TARGETS = ('chat', 'characters', 'index', 'asgi')
+
+
+def load_entry_point(name):
+    """api/<name>.py をモジュールとして読み込む"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(API_DIR, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class BenchHTTPServer(ThreadingHTTPServer):
+    # 既定の listen backlog（5）だと並列接続時にSYNが落ちて1秒単位の遅延が混ざる
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class QuietHandlerMixin:
+    # リクエストごとのアクセスログを出さない（計測のノイズになるため）
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(target, host, port):
+    if target in ('chat', 'characters'):
+        module = load_entry_point(target)
+        handler = type('handler', (QuietHandlerMixin, module.handler), {})
+        BenchHTTPServer((host, port), handler).serve_forever()
+    elif target == 'index':
+        from werkzeug.serving import run_simple
+        module = load_entry_point('index')
+        run_simple(host, port, module.app, threaded=True)
+    elif target == 'asgi':
+        from _lib.asgi import app
+        from _lib.asgi_server import serve as serve_asgi
+        asyncio.run(serve_asgi(app, host, port))
+    else:
+        raise ValueError(f"unknown target: {target}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマーク用のサーバーを起動する')
+    parser.add_argument('target', choices=TARGETS)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, required=True)
+    args = parser.parse_args()
+    try:
+        serve(args.target, args.host, args.port)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""設定資料（api/_lib/lore_corpus.json）から検索用の索引（api/_lib/lore.idx）を作る
+
+    python scripts/build_lore_index.py
+    python scripts/build_lore_index.py --corpus my_lore.json --output /tmp/lore.idx
+
+資料を更新したら作り直してコミットする。索引が資料より古いと、サーバーは起動のたびに
+メモリ上で作り直す（動作はするが起動が遅くなる）。
+"""
+import argparse
+import os
+import sys
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')
+sys.path.insert(0, API_DIR)
+from _lib.lore import CORPUS_PATH, INDEX_PATH, LoreIndex, build_index, corpus_digest, load_corpus, write_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    parser.add_argument('--output', default=INDEX_PATH)
+    args = parser.parse_args()
+
+    documents = load_corpus(args.corpus)
+    data = build_index(documents, corpus_digest(args.corpus))
+    write_index(args.output, data)
+    index = LoreIndex(data)
+    print(f"{len(documents)} documents -> {index.chunk_count} chunks, "
+          f"{len(index.meta['characters'])} scoped characters, {len(data)} bytes: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""会話ログ（CHAT_LOG_DIR）を検索して JSON Lines で出力する
+
+    python scripts/query_log.py /var/log/chat --character reimu --since 2026-10-01T00:00
+    python scripts/query_log.py /var/log/chat --session 8c1f...
+    python scripts/query_log.py /var/log/chat --count
+
+条件を何も付けなければ全件を mmap で順に読む。--session / --character / --since / --until を
+付けると索引（*.idx）で絞り込んでから該当レコードだけを読む。
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')
+sys.path.insert(0, API_DIR)
+from _lib.convlog import LogReader
+
+
+def _timestamp(value):
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    parser.add_argument('--session')
+    parser.add_argument('--character')
+    parser.add_argument('--since', help='この時刻以降（ISO 8601）')
+    parser.add_argument('--until', help='この時刻より前（ISO 8601）')
+    parser.add_argument('--count', action='store_true', help='件数だけを出す')
+    args = parser.parse_args()
+
+    reader = LogReader(args.directory)
+    start, end = _timestamp(args.since), _timestamp(args.until)
+    if args.session or args.character or start or end:
+        records = reader.query(session_id=args.session, character=args.character, start=start, end=end)
+    else:
+        records = reader.scan(start=start, end=end)
+
+    if args.count:
+        print(sum(1 for _ in records))
+        return
+    for record in records:
+        print(json.dumps(record, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""チャットAPIのASGI版をローカルで起動する
+
+    python scripts/serve_asgi.py --port 8000 --max-upstream 256
+
+uvicorn がインストールされていればそれを使い、なければ標準ライブラリだけの
+簡易サーバー（api/_lib/asgi_server.py）で動かす。
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')
+sys.path.insert(0, API_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-upstream', type=int, help='上流（モデル）への同時リクエスト数の上限')
+    parser.add_argument('--queue-timeout', type=float, help='枠が空くのを待つ秒数（超えたら503）')
+    parser.add_argument('--builtin', action='store_true', help='uvicorn があっても簡易サーバーを使う')
+    args = parser.parse_args()
+
+    # アプリはインポート時に環境変数から設定を読む
+    if args.max_upstream is not None:
+        os.environ['CHAT_MAX_UPSTREAM'] = str(args.max_upstream)
+    if args.queue_timeout is not None:
+        os.environ['CHAT_QUEUE_TIMEOUT'] = str(args.queue_timeout)
+
+    from _lib.asgi import app
+
+    if not args.builtin:
+        try:
+            import uvicorn
+        except ImportError:
+            pass
+        else:
+            uvicorn.run(app, host=args.host, port=args.port)
+            return
+
+    from _lib.asgi_server import serve
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        asyncio.run(serve(app, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
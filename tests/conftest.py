@@ -0,0 +1,26 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# api/ をパスに入れて、エントリーポイントと同じく `_lib` として読み込む
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')
+sys.path.insert(0, API_DIR)
+
+
+@pytest.fixture
+def flask_app(monkeypatch):
+    """フェイクのモデルで api/index.py（Flask版）を読み込む"""
+    pytest.importorskip('flask')
+    for name, value in {"CHAT_MODEL_BACKEND": "fake", "FAKE_MODEL_LATENCY": "constant:0",
+                        "FAKE_MODEL_TOKEN_RATE": "0", "CHAT_RESPONSE_CACHE": "0",
+                        "CHAT_TIMING_LOG": "0", "CHAT_RATE_PER_MINUTE": "1", "CHAT_RATE_BURST": "3"}.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv("CHAT_LOG_DIR", raising=False)
+    from _lib import ratelimit
+    monkeypatch.setattr(ratelimit, 'TRUSTED_PROXIES', frozenset())
+    spec = importlib.util.spec_from_file_location('index', os.path.join(API_DIR, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,55 @@
+import pytest
+
+from _lib.backends import FakeBackend, FakeNetworkError, FakeQuotaError
+from _lib.registry import CHARACTERS
+
+REIMU = CHARACTERS['reimu']
+PROMPT = "ユーザー：こんにちは"
+
+
+def _fake(**kwargs):
+    return FakeBackend(latency='constant:0', token_rate=0, **kwargs)
+
+
+def _outcomes(backend, calls):
+    results = []
+    for _ in range(calls):
+        try:
+            results.append(backend.generate(REIMU, PROMPT))
+        except Exception as e:
+            results.append(type(e).__name__)
+    return results
+
+
+def test_same_seed_gives_same_replies_and_errors():
+    first = _outcomes(_fake(seed=7, error_rate=0.3, quota_rate=0.1), 50)
+    second = _outcomes(_fake(seed=7, error_rate=0.3, quota_rate=0.1), 50)
+    assert first == second
+    assert 'FakeNetworkError' in first and 'FakeQuotaError' in first
+
+
+def test_different_seed_changes_the_sequence():
+    assert _outcomes(_fake(seed=1), 20) != _outcomes(_fake(seed=2), 20)
+
+
+def test_reply_echoes_the_user_message_within_length():
+    reply = _fake(reply_tokens=(30, 30)).generate(REIMU, PROMPT)
+    assert 'こんにちは' in reply
+    assert len(reply) == 30
+
+
+def test_stream_chunks_join_to_the_generate_reply():
+    chunks = list(_fake(seed=3, chunk_tokens=5).stream(REIMU, PROMPT))
+    assert all(len(chunk) <= 5 for chunk in chunks)
+    assert ''.join(chunks) == _fake(seed=3).generate(REIMU, PROMPT)
+
+
+@pytest.mark.parametrize('kwargs, error', [
+    ({'error_rate': 1.0}, FakeNetworkError),
+    ({'quota_rate': 1.0}, FakeQuotaError),
+])
+def test_error_rates(kwargs, error):
+    backend = _fake(**kwargs)
+    with pytest.raises(error):
+        backend.generate(REIMU, PROMPT)
+    assert backend.errors == 1
@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+
+from _lib import batch
+
+
+class _Service:
+    """後ろの件ほど早く終わる（終わる順が入力と逆になる）"""
+
+    def __init__(self, count):
+        self.count = count
+
+    def reply(self, character, message, session_id=None):
+        index = int(message)
+        time.sleep((self.count - index) * 0.02)
+        if index == 1:
+            raise ConnectionError("503 upstream")
+        return f"{character.id}:{message}"
+
+
+def _items(count):
+    return batch.parse_batch({"requests": [{"character_id": "reimu", "message": str(i)} for i in range(count)]})
+
+
+def test_results_arrive_as_they_finish_and_can_be_reordered():
+    items = _items(4)
+    results = list(batch.run_batch(_Service(4), items))
+    assert [result["index"] for result in results] == [3, 2, 1, 0]
+    ordered = batch.ordered(results)
+    assert [result.get("reply") for result in ordered] == ["reimu:0", None, "reimu:2", "reimu:3"]
+    assert ordered[1]["status"] == 500 and ordered[1]["error"]
+
+
+def test_rejected_items_skip_upstream():
+    items = _items(3)
+    calls = []
+    lock = threading.Lock()
+
+    class Service(_Service):
+        def reply(self, character, message, session_id=None):
+            with lock:
+                calls.append(message)
+            return super().reply(character, message, session_id)
+
+    def admit(item):
+        return batch.item_result(item, error="多すぎます", status=429) if item.index == 0 else None
+
+    results = batch.ordered(batch.run_batch(Service(3), items, admit))
+    assert results[0] == {"index": 0, "character": {"id": "reimu", "name": "博麗霊夢"},
+                          "error": "多すぎます", "status": 429}
+    assert sorted(calls) == ['1', '2']
+
+
+def test_character_ids_share_one_message():
+    items = batch.parse_batch({"message": "こんにちは", "character_ids": ["reimu", "marisa"], "session_id": "s1"})
+    assert [(item.index, item.character.id, item.message, item.session_id) for item in items] == [
+        (0, 'reimu', 'こんにちは', 's1'), (1, 'marisa', 'こんにちは', 's1')]
+
+
+def test_ndjson_lines():
+    line = batch.ndjson_line({"index": 0, "reply": "改行\nを含む"})
+    assert line.endswith(b'\n') and line.count(b'\n') == 1
+    assert json.loads(line) == {"index": 0, "reply": "改行\nを含む"}
+    assert batch.wants_ndjson({"stream": True})
+    assert batch.wants_ndjson({}, 'application/x-ndjson')
+    assert not batch.wants_ndjson({}, 'application/json')
+
+
+def test_flask_batch_returns_results_in_input_order(flask_app):
+    client = flask_app.app.test_client()
+    ids = ["sakuya", "reimu", "marisa"]
+    response = client.post('/chat/batch', json={"message": "こんにちは", "character_ids": ids})
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [(r["index"], r["character"]["id"]) for r in results] == list(enumerate(ids))
+    assert all(r["reply"] for r in results)
+    response = client.post('/chat/batch', json={"message": "こんにちは", "character_ids": ids, "stream": True})
+    assert response.content_type.startswith('application/x-ndjson')
+    lines = [json.loads(line) for line in response.data.splitlines()]
+    assert sorted(line["index"] for line in lines) == [0, 1, 2]
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from _lib.asgi import create_app
+from _lib.concurrency import Saturated, UpstreamLimiter
+from _lib.ratelimit import RateLimiter
+from _lib.sessions import SessionStore
+
+
+def test_acquire_raises_saturated_when_no_slot_frees_up():
+    async def scenario():
+        limiter = UpstreamLimiter(max_concurrent=1, queue_timeout=0.02, retry_after=3)
+        await limiter.acquire()
+        with pytest.raises(Saturated) as info:
+            await limiter.acquire()
+        assert info.value.retry_after == 3
+        assert limiter.waiting == 0
+        limiter.release()
+        await limiter.acquire()
+        assert limiter.in_flight == 1
+        limiter.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_released_slot_goes_to_the_lighter_client_first():
+    async def scenario():
+        limiter = UpstreamLimiter(max_concurrent=1, queue_timeout=1)
+        await limiter.acquire('heavy')
+        order = []
+
+        async def wait(client):
+            await limiter.acquire(client)
+            order.append(client)
+            limiter.release()
+
+        tasks = [asyncio.ensure_future(wait('heavy')), asyncio.ensure_future(wait('heavy'))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(wait('light')))
+        await asyncio.sleep(0)
+        limiter.release()
+        await asyncio.gather(*tasks)
+        limiter.shutdown()
+        return order
+
+    assert asyncio.run(scenario())[0] == 'light'
+
+
+class _SlowService:
+    demo_mode = False
+
+    def __init__(self):
+        self.sessions = SessionStore()
+
+    def reply_or_apology(self, character, user_message, session_id, timer):
+        time.sleep(0.2)
+        return '応答'
+
+
+async def _post(app, body):
+    sent = []
+    messages = [{'type': 'http.request', 'body': body}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app({'type': 'http', 'method': 'POST', 'path': '/api/chat', 'headers': []}, receive, send)
+    return sent[0]['status'], dict(sent[0]['headers'])
+
+
+def test_asgi_returns_503_with_retry_after_when_saturated():
+    async def scenario():
+        limiter = UpstreamLimiter(max_concurrent=1, queue_timeout=0.02, retry_after=2)
+        app = create_app(service=_SlowService(), limiter=limiter, rate_limiter=RateLimiter(client_rate=0, client_burst=0))
+        body = json.dumps({"message": "こんにちは", "character_id": "reimu"}).encode('utf-8')
+        first = asyncio.ensure_future(_post(app, body))
+        await asyncio.sleep(0.02)
+        second = await _post(app, body)
+        limiter.shutdown()
+        return (await first), second
+
+    (first_status, _), (second_status, headers) = asyncio.run(scenario())
+    assert first_status == 200
+    assert second_status == 503
+    assert headers[b'retry-after'] == b'2'
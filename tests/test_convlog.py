@@ -0,0 +1,76 @@
+import struct
+
+from _lib.convlog import ConversationLog, LogReader
+
+
+def _record(i, character='reimu', session_id='s1'):
+    return {"ts": 1000.0 + i, "character": character, "session_id": session_id,
+            "message": f"発言{i}", "reply": f"応答{i}"}
+
+
+def _write(directory, records, **kwargs):
+    log = ConversationLog(str(directory), flush_interval=60, **kwargs)
+    for record in records:
+        log.append(record)
+    log.close()
+
+
+def test_records_round_trip(tmp_path):
+    records = [_record(i) for i in range(20)]
+    _write(tmp_path, records)
+    assert list(LogReader(str(tmp_path)).scan()) == records
+
+
+def test_segments_rotate_and_scan_in_order(tmp_path):
+    records = [_record(i) for i in range(50)]
+    _write(tmp_path, records, segment_bytes=500)
+    reader = LogReader(str(tmp_path))
+    assert len(reader.segments()) > 1
+    assert list(reader.scan()) == records
+
+
+def test_query_filters_by_session_character_and_time(tmp_path):
+    records = [_record(i, character=('reimu', 'marisa')[i % 2], session_id=f's{i % 3}') for i in range(30)]
+    _write(tmp_path, records, segment_bytes=800)
+    reader = LogReader(str(tmp_path))
+    assert list(reader.query(session_id='s1')) == [r for r in records if r["session_id"] == 's1']
+    assert list(reader.query(character='marisa')) == [r for r in records if r["character"] == 'marisa']
+    assert list(reader.query(start=1010.0, end=1015.0)) == records[10:15]
+    assert list(reader.scan(start=1025.0)) == records[25:]
+
+
+def test_restart_writes_a_new_segment(tmp_path):
+    _write(tmp_path, [_record(0)])
+    _write(tmp_path, [_record(1)])
+    reader = LogReader(str(tmp_path))
+    assert reader.segments() == [1, 2]
+    assert list(reader.scan()) == [_record(0), _record(1)]
+
+
+def test_truncated_tail_is_skipped(tmp_path):
+    records = [_record(i) for i in range(3)]
+    _write(tmp_path, records)
+    path = tmp_path / 'segment-00000001.log'
+    data = path.read_bytes()
+    path.write_bytes(data[:-5])
+    assert list(LogReader(str(tmp_path)).scan()) == records[:2]
+
+
+def test_corrupted_record_stops_the_scan(tmp_path):
+    records = [_record(i) for i in range(3)]
+    _write(tmp_path, records)
+    path = tmp_path / 'segment-00000001.log'
+    data = bytearray(path.read_bytes())
+    length, _ = struct.unpack_from('<II', data, 0)
+    second = 8 + length
+    data[second + 10] ^= 0xFF
+    path.write_bytes(bytes(data))
+    assert list(LogReader(str(tmp_path)).scan()) == records[:1]
+
+
+def test_full_queue_drops_instead_of_blocking(tmp_path):
+    log = ConversationLog(str(tmp_path), flush_interval=60, max_pending=2)
+    for i in range(5):
+        log.append(_record(i))
+    log.close()
+    assert len(list(LogReader(str(tmp_path)).scan())) == 2
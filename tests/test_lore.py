@@ -0,0 +1,55 @@
+import os
+
+from _lib import lore
+
+DOCUMENTS = [
+    {"id": "location/shrine", "title": "博麗神社", "characters": [],
+     "text": "博麗神社は幻想郷の東の端に建つ神社。参拝客は少なく、賽銭箱はいつも空っぽ。"},
+    {"id": "address/marisa", "title": "魔理沙の呼び方", "characters": ["marisa"],
+     "text": "魔理沙は霊夢を名前で呼び捨てにする。"},
+]
+
+
+def _index(**options):
+    return lore.LoreIndex(lore.build_index(DOCUMENTS), min_score=0.1, **options)
+
+
+def test_tokenize_uses_bigrams_within_script_runs():
+    assert lore.tokenize("博麗神社の巫女") == ["博麗", "麗神", "神社", "巫女"]
+    # 2文字以下のひらがなは助詞として捨て、1文字の漢字・カタカナは残す
+    assert lore.tokenize("今は、こいしが") == ["今", "こい", "いし", "しが"]
+    assert lore.tokenize("ＡＢＣ") == ["ab", "bc"]
+
+
+def test_long_paragraphs_are_split_at_sentence_ends():
+    text = "。".join(["あ" * 50] * 5) + "。"
+    chunks = lore.chunk_documents([{"id": "d", "title": "題", "text": text}], max_chars=120)
+    assert len(chunks) == 3
+    assert all(chunk.startswith("【題】") and chunk.endswith("。") for _, _, chunk in chunks)
+
+
+def test_build_index_is_deterministic():
+    assert lore.build_index(DOCUMENTS, 'x') == lore.build_index(DOCUMENTS, 'x')
+
+
+def test_character_scoped_chunks_are_only_used_for_that_character():
+    index = _index()
+    assert index.retrieve('reimu', "魔理沙は霊夢を何て呼ぶ？") == []
+    assert index.retrieve('marisa', "魔理沙は霊夢を何て呼ぶ？") == ["【魔理沙の呼び方】魔理沙は霊夢を名前で呼び捨てにする。"]
+    assert index.retrieve('marisa', "神社の賽銭箱")[0].startswith("【博麗神社】")
+
+
+def test_shipped_index_matches_the_corpus(tmp_path):
+    digest = lore.corpus_digest()
+    data = lore.build_index(lore.load_corpus(), digest)
+    if os.path.exists(lore.INDEX_PATH):
+        with open(lore.INDEX_PATH, 'rb') as f:
+            assert f.read() == data, "scripts/build_lore_index.py で索引を作り直してください"
+    path = str(tmp_path / 'lore.idx')
+    lore.write_index(path, data)
+    mapped = lore.load_index(path)
+    in_memory = lore.LoreIndex(data)
+    assert mapped.corpus_sha1 == digest
+    message = "紅霧異変のときは何があったの？"
+    assert mapped.search('reimu', message) == in_memory.search('reimu', message)
+    assert any("紅霧異変" in text for text in mapped.retrieve('reimu', message))
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from _lib import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """テスト用のメトリクスを全体の /metrics に混ぜない"""
+    monkeypatch.setattr(metrics, '_REGISTRY', [])
+    return metrics._REGISTRY
+
+
+def test_render_uses_the_prometheus_text_format(registry):
+    requests = metrics.Counter('test_requests_total', 'Requests', ('endpoint', 'status'))
+    requests.inc(endpoint='chat', status=200)
+    requests.inc(2, endpoint='chat', status=200)
+    requests.inc(endpoint='say "hi"\n', status=500)
+    in_flight = metrics.Gauge('test_in_flight', 'In flight')
+    with in_flight.track():
+        assert in_flight.get() == 1
+    assert metrics.render() == (
+        '# HELP test_requests_total Requests\n'
+        '# TYPE test_requests_total counter\n'
+        'test_requests_total{endpoint="chat",status="200"} 3\n'
+        'test_requests_total{endpoint="say \\"hi\\"\\n",status="500"} 1\n'
+        '# HELP test_in_flight In flight\n'
+        '# TYPE test_in_flight gauge\n'
+        'test_in_flight 0\n'
+    )
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    latency = metrics.Histogram('test_seconds', 'Latency', buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        latency.observe(value)
+    assert latency.render()[2:] == [
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="1.0"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        'test_seconds_sum 2.65',
+        'test_seconds_count 4',
+    ]
+
+
+def test_request_timer_logs_spans_and_fields(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, 'TIMING_LOG', True)
+    before = metrics.REQUESTS.get(endpoint='test', mode='json', status=200)
+    timer = metrics.RequestTimer('test')
+    with timer.span('parse'):
+        pass
+    timer.add('upstream', 2_000_000)
+    timer.add('upstream', 1_000_000)
+    timer.mark('first_token')
+    timer.annotate(static_tokens=10)
+    timer.finish(200, character='reimu')
+    record = json.loads(capsys.readouterr().out)
+    assert record["spans_ms"]["upstream"] == 3.0 and "parse" in record["spans_ms"]
+    assert (record["status"], record["static_tokens"], record["character"]) == (200, 10, 'reimu')
+    assert "first_token_ms" in record
+    assert metrics.REQUESTS.get(endpoint='test', mode='json', status=200) == before + 1
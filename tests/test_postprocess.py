@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+from _lib.postprocess import MASK, PostProcessor, truncate
+from _lib.registry import CHARACTERS
+
+REIMU = CHARACTERS['reimu']
+
+
+@pytest.fixture(scope='module')
+def processor():
+    return PostProcessor(background_checks=())
+
+
+@pytest.mark.parametrize('text, masked', [
+    ("死ね！", f"{MASK}！"),
+    ("殺すぞ", MASK),
+    ("くたばれ", MASK),
+    ("ぶっ殺されたいの？", f"{MASK}されたいの？"),
+    ("死ねないのよ。", "死ねないのよ。"),
+    ("殺すなんてしないわ。", "殺すなんてしないわ。"),
+    ("殺すわけないでしょ。", "殺すわけないでしょ。"),
+])
+def test_banned_words_are_masked_only_as_threats(processor, text, masked):
+    assert processor.mask(text) == (masked, masked != text)
+
+
+def test_length_is_cut_at_a_sentence_end():
+    assert truncate("あいう。えおか。きく", 9) == "あいう。えおか。"
+    assert truncate("あ。" + "い" * 20, 10) == "あ。いいいいいいいい" + MASK
+
+
+def test_stream_filter_matches_the_full_reply(processor):
+    rng = random.Random(0)
+    words = ["死ね", "死ねない", "殺す", "殺すなんて", "ぶっ殺", "くたばれ", "。", "！", "よ", "わけ", "霊夢", "お賽銭"]
+    for _ in range(500):
+        text = "".join(rng.choice(words) for _ in range(rng.randint(1, 30)))
+        expected, _ = processor.apply(REIMU, text)
+        stream = processor.stream_filter(REIMU)
+        sent = []
+        position = 0
+        while position < len(text) and not stream.done:
+            size = rng.randint(1, 6)
+            sent.append(stream.feed(text[position:position + size]))
+            position += size
+        sent.append(stream.finish())
+        assert "".join(sent) == expected, text
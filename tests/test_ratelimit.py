@@ -0,0 +1,102 @@
+from unittest import mock
+
+from _lib import ratelimit
+from _lib.ratelimit import RateLimiter, client_key
+
+
+def _clock(start=1000.0):
+    now = [start]
+    return now, mock.patch.object(ratelimit.time, 'monotonic', lambda: now[0])
+
+
+def test_client_burst_then_refill():
+    now, patched = _clock()
+    with patched:
+        limiter = RateLimiter(client_rate=1.0, client_burst=3)
+        assert [limiter.acquire('ip:1', 'reimu') for _ in range(3)] == [0.0] * 3
+        assert limiter.acquire('ip:1', 'reimu') == 1.0
+        now[0] += 1.0
+        assert limiter.acquire('ip:1', 'reimu') == 0.0
+
+
+def test_clients_have_separate_buckets():
+    _, patched = _clock()
+    with patched:
+        limiter = RateLimiter(client_rate=1.0, client_burst=1)
+        assert limiter.acquire('ip:1', 'reimu') == 0.0
+        assert limiter.acquire('ip:1', 'reimu') > 0
+        assert limiter.acquire('ip:2', 'reimu') == 0.0
+
+
+def test_global_budget_caps_all_clients():
+    _, patched = _clock()
+    with patched:
+        limiter = RateLimiter(client_rate=1.0, client_burst=10, global_rate=1.0, global_burst=2)
+        assert limiter.acquire('ip:1', 'reimu') == 0.0
+        assert limiter.acquire('ip:2', 'reimu') == 0.0
+        assert limiter.acquire('ip:3', 'reimu') > 0
+        assert limiter.usage('ip:3')["client"]["limited"] == 1
+
+
+def test_rejected_request_does_not_spend_other_buckets():
+    _, patched = _clock()
+    with patched:
+        limiter = RateLimiter(client_rate=1.0, client_burst=1, character_rate=1.0, character_burst=5)
+        limiter.acquire('ip:1', 'reimu')
+        assert limiter.acquire('ip:1', 'reimu') > 0
+        assert limiter.usage()["characters"]["reimu"]["requests"] == 1
+
+
+def test_lru_keeps_client_count_bounded():
+    limiter = RateLimiter(client_rate=1.0, client_burst=1, max_keys=10)
+    for i in range(100):
+        limiter.acquire(f'ip:{i}', 'reimu')
+    assert limiter.usage()["tracked_clients"] == 10
+
+
+def test_record_exchange_adds_estimated_tokens():
+    limiter = RateLimiter(client_rate=1.0, client_burst=5)
+    limiter.acquire('ip:1', 'reimu')
+    limiter.record_exchange('ip:1', 'reimu', 'こんにちは', '霊夢よ')
+    assert limiter.usage('ip:1')["client"]["tokens"] == 8
+
+
+def test_unregistered_api_keys_fall_back_to_the_address():
+    headers = {'X-API-Key': 'random-key'}
+    assert client_key(headers, '1.2.3.4', api_key_hashes=frozenset()) == 'ip:1.2.3.4'
+    registered = frozenset({ratelimit._hash_key('random-key')})
+    assert client_key(headers, '1.2.3.4', api_key_hashes=registered).startswith('key:')
+    bearer = {'Authorization': 'Bearer random-key'}
+    assert client_key(bearer, '1.2.3.4', api_key_hashes=registered) == client_key(
+        headers, '1.2.3.4', api_key_hashes=registered)
+
+
+def test_forwarded_for_is_only_trusted_from_configured_proxies():
+    headers = {'X-Forwarded-For': '6.6.6.6, 9.9.9.9'}
+    assert client_key(headers, '1.2.3.4', trusted_proxies=frozenset()) == 'ip:1.2.3.4'
+    proxies = frozenset({'10.0.0.1'})
+    assert client_key(headers, '10.0.0.1', trusted_proxies=proxies) == 'ip:9.9.9.9'
+    chained = {'X-Forwarded-For': '6.6.6.6, 9.9.9.9, 10.0.0.2'}
+    assert client_key(chained, '10.0.0.1', trusted_proxies=proxies | {'10.0.0.2'}) == 'ip:9.9.9.9'
+    assert client_key(headers, '10.0.0.1', trusted_proxies=frozenset({'*'})) == 'ip:9.9.9.9'
+
+
+def test_rotating_identity_headers_share_one_bucket():
+    limiter = RateLimiter(client_rate=0.5, client_burst=10)
+    admitted = 0
+    for i in range(50):
+        headers = {'X-API-Key': f'key-{i}', 'X-Forwarded-For': f'10.0.{i}.1'}
+        key = client_key(headers, '1.2.3.4', api_key_hashes=frozenset(), trusted_proxies=frozenset())
+        admitted += limiter.acquire(key, 'reimu') == 0.0
+    assert admitted == 10
+
+
+def test_flask_app_ignores_forwarded_for_from_untrusted_peers(flask_app):
+    client = flask_app.app.test_client()
+    statuses = [
+        client.post('/chat', json={"message": "こんにちは", "character_id": "reimu"},
+                    headers={'X-Forwarded-For': f'10.0.{i}.1'}).status_code
+        for i in range(6)
+    ]
+    assert statuses == [200] * 3 + [429] * 3
+    assert flask_app.rate_limiter.usage()["tracked_clients"] == 1
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+from _lib.registry import CHARACTER_LIST_ETAG, CHARACTER_LIST_JSON, CHARACTERS, etag_matches, get_character
+
+
+def test_prebuilt_bodies_match_the_profiles():
+    listed = json.loads(CHARACTER_LIST_JSON)["characters"]
+    assert [c["id"] for c in listed] == list(CHARACTERS)
+    for character, profile in zip(CHARACTERS.values(), listed):
+        assert json.loads(character.json_bytes) == profile
+    assert len({c.etag for c in CHARACTERS.values()} | {CHARACTER_LIST_ETAG}) == len(CHARACTERS) + 1
+
+
+def test_unknown_ids_fall_back_only_when_asked():
+    assert get_character('unknown').id == 'reimu'
+    assert get_character('unknown', fallback=False) is None
+    assert get_character('marisa').id == 'marisa'
+
+
+@pytest.mark.parametrize('header, matches', [
+    (None, False),
+    ('', False),
+    ('*', True),
+    ('{etag}', True),
+    ('W/{etag}', True),
+    ('"other", {etag}', True),
+    ('"other"', False),
+])
+def test_etag_matches(header, matches):
+    etag = CHARACTERS['reimu'].etag
+    assert etag_matches(header and header.format(etag=etag), etag) is matches
+
+
+def test_flask_app_answers_304_for_a_matching_etag(flask_app):
+    client = flask_app.app.test_client()
+    for path in ('/characters', '/characters/marisa'):
+        first = client.get(path)
+        assert first.status_code == 200 and first.headers['Cache-Control'] == 'max-age=3600'
+        again = client.get(path, headers={'If-None-Match': first.headers['ETag']})
+        assert again.status_code == 304 and again.data == b''
+        assert again.headers['ETag'] == first.headers['ETag']
@@ -0,0 +1,156 @@
+import threading
+import time
+
+import pytest
+
+from _lib.resilience import (
+    CircuitBreaker, CircuitOpenError, DeadlineExceeded, ResilientBackend, UpstreamQueueFull,
+)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+
+def test_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_half_open_trial_closes_or_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+class _Backend:
+    name = 'test'
+    cacheable = True
+    system_instruction = False
+
+    def __init__(self, failures=0, delay=0.0, error=ConnectionError("503 unavailable")):
+        self.failures = failures
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def generate(self, character, prompt):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.calls <= self.failures:
+            raise self.error
+        return '応答'
+
+
+def test_transient_errors_are_retried():
+    backend = _Backend(failures=2)
+    resilient = ResilientBackend(backend, max_retries=2, backoff_base=0.001)
+    assert resilient.generate(None, 'p') == '応答'
+    assert backend.calls == 3
+
+
+def test_permanent_errors_are_not_retried():
+    backend = _Backend(failures=1, error=ValueError("invalid api_key"))
+    resilient = ResilientBackend(backend, max_retries=2, backoff_base=0.001)
+    with pytest.raises(ValueError):
+        resilient.generate(None, 'p')
+    assert backend.calls == 1
+
+
+def test_open_breaker_skips_upstream():
+    backend = _Backend()
+    resilient = ResilientBackend(backend, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+    resilient.breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        resilient.generate(None, 'p')
+    assert backend.calls == 0
+
+
+def test_queued_calls_are_cancelled_after_the_deadline():
+    backend = _Backend(delay=0.3)
+    resilient = ResilientBackend(backend, deadline=0.05, max_retries=0, workers=1, max_queue=10)
+    errors = []
+
+    def call():
+        try:
+            resilient.generate(None, 'p')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    time.sleep(0.4)
+    assert len(errors) == 5 and all(isinstance(e, DeadlineExceeded) for e in errors)
+    # 走り始めていた1件だけが上流に届く
+    assert backend.calls == 1
+
+
+def test_full_queue_raises_without_calling_upstream():
+    backend = _Backend(delay=0.2)
+    resilient = ResilientBackend(backend, deadline=1, max_retries=0, workers=1, max_queue=0)
+    thread = threading.Thread(target=resilient.generate, args=(None, 'p'))
+    thread.start()
+    time.sleep(0.05)
+    with pytest.raises(UpstreamQueueFull):
+        resilient.generate(None, 'p')
+    thread.join()
+    assert backend.calls == 1
+
+
+def test_full_queue_does_not_open_the_breaker():
+    backend = _Backend(delay=0.2)
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    resilient = ResilientBackend(backend, deadline=1, max_retries=0, workers=1, max_queue=0, breaker=breaker)
+    thread = threading.Thread(target=resilient.generate, args=(None, 'p'))
+    thread.start()
+    time.sleep(0.05)
+    for _ in range(4):
+        with pytest.raises(UpstreamQueueFull):
+            resilient.generate(None, 'p')
+    thread.join()
+    assert breaker.state == 'closed'
+    assert resilient.generate(None, 'p') == '応答'
+
+
+def test_full_queue_releases_the_half_open_trial():
+    backend = _Backend(delay=0.2)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    resilient = ResilientBackend(backend, deadline=1, max_retries=0, workers=1, max_queue=0, breaker=breaker)
+    thread = threading.Thread(target=resilient.generate, args=(None, 'p'))
+    thread.start()
+    time.sleep(0.05)
+    breaker.record_failure()
+    time.sleep(0.02)
+    with pytest.raises(UpstreamQueueFull):
+        resilient.generate(None, 'p')
+    # 待ち行列があふれた1件は試行枠を返すので、次の1件が半開状態の試行になれる
+    assert breaker.allow()
+    thread.join()
@@ -0,0 +1,55 @@
+from unittest import mock
+
+from _lib import response_cache
+from _lib.registry import CHARACTERS
+from _lib.response_cache import ResponseCache
+
+REIMU = CHARACTERS['reimu']
+
+
+def test_keys_ignore_case_width_and_punctuation():
+    assert ResponseCache.make_key(REIMU, 'こんにちは！') == ResponseCache.make_key(REIMU, ' こんにちは〜')
+    assert ResponseCache.make_key(REIMU, 'Ｈｅｌｌｏ') == ResponseCache.make_key(REIMU, 'hello!')
+    assert ResponseCache.make_key(REIMU, '！？…') is None
+
+
+def test_hits_after_variants_replies():
+    cache = ResponseCache(variants=2)
+    key = cache.make_key(REIMU, 'こんにちは')
+    cache.put(key, '何か用？')
+    assert cache.get(key) is None
+    assert cache.peek(key) == '何か用？'
+    cache.put(key, 'お賽銭ならあっちよ')
+    assert cache.get(key) in ('何か用？', 'お賽銭ならあっちよ')
+
+
+def test_repeated_replies_count_toward_variants():
+    cache = ResponseCache(variants=3)
+    key = cache.make_key(REIMU, 'こんにちは')
+    for _ in range(3):
+        assert cache.get(key) is None
+        cache.put(key, '何か用？')
+    assert cache.get(key) == '何か用？'
+    assert cache._entries[key][1] == ['何か用？']
+
+
+def test_expired_entries_are_dropped():
+    now = [1000.0]
+    with mock.patch.object(response_cache.time, 'monotonic', lambda: now[0]):
+        cache = ResponseCache(ttl=10)
+        key = cache.make_key(REIMU, 'こんにちは')
+        cache.put(key, '何か用？')
+        assert cache.get(key) == '何か用？'
+        now[0] += 11
+        assert cache.get(key) is None
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ResponseCache(max_entries=2)
+    keys = [cache.make_key(REIMU, message) for message in ('おはよう', 'こんにちは', 'こんばんは')]
+    cache.put(keys[0], 'a')
+    cache.put(keys[1], 'b')
+    cache.get(keys[0])
+    cache.put(keys[2], 'c')
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == 'a' and cache.get(keys[2]) == 'c'
@@ -0,0 +1,65 @@
+import threading
+
+from _lib.sessions import SessionStore, normalize_session_id
+
+
+def test_history_is_kept_per_character():
+    store = SessionStore()
+    store.append('s1', 'reimu', 'こんにちは', '何か用？')
+    assert store.history('s1', 'reimu') == [('user', 'こんにちは'), ('model', '何か用？')]
+    assert store.history('s1', 'marisa') == []
+    assert store.history(None, 'reimu') == []
+
+
+def test_history_keeps_the_latest_turns_within_the_budgets():
+    store = SessionStore(max_turns=4, token_budget=6)
+    for i in range(5):
+        store.append('s1', 'reimu', f'質問{i}', f'答え{i}')
+    assert store.history('s1', 'reimu') == [('user', '質問4'), ('model', '答え4')]
+    store = SessionStore(max_turns=4, token_budget=100)
+    for i in range(5):
+        store.append('s1', 'reimu', f'質問{i}', f'答え{i}')
+    assert [text for _, text in store.history('s1', 'reimu')] == ['質問3', '答え3', '質問4', '答え4']
+
+
+def test_history_reads_under_the_append_lock():
+    store = SessionStore()
+    store.append('s1', 'reimu', 'こんにちは', '何か用？')
+    results = []
+    with store._lock:
+        # 追記中（ロックを持っている間）は履歴を読みに行かない
+        thread = threading.Thread(target=lambda: results.append(store.history('s1', 'reimu')))
+        thread.start()
+        thread.join(0.05)
+        assert thread.is_alive() and not results
+    thread.join()
+    assert results == [[('user', 'こんにちは'), ('model', '何か用？')]]
+
+
+def test_concurrent_reads_and_appends_do_not_raise():
+    store = SessionStore(max_turns=8)
+    errors = []
+    stop = threading.Event()
+
+    def read():
+        try:
+            while not stop.is_set():
+                store.history('s1', 'reimu')
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for thread in readers:
+        thread.start()
+    for i in range(2000):
+        store.append('s1', 'reimu', f'質問{i}', f'答え{i}')
+    stop.set()
+    for thread in readers:
+        thread.join()
+    assert not errors
+
+
+def test_invalid_session_ids_are_ignored():
+    assert normalize_session_id('abc-123') == 'abc-123'
+    for value in ('', 'x' * 129, '\x00bad', 1, None):
+        assert normalize_session_id(value) is None
@@ -0,0 +1,212 @@
+import threading
+import time
+
+import pytest
+
+from _lib.backends import ModelBackend
+from _lib.chat_service import ChatService
+from _lib.registry import CHARACTERS
+from _lib.response_cache import ResponseCache
+from _lib.sessions import SessionStore
+from _lib.singleflight import SingleFlight
+
+KEY = ('reimu', 1, 'こんにちは')
+
+
+def _wait_for_flight(flight, key=KEY):
+    deadline = time.monotonic() + 2
+    while (key not in flight._flights) if key is not None else not flight._flights:
+        assert time.monotonic() < deadline, "先行の呼び出しが始まりませんでした"
+        time.sleep(0.001)
+
+
+def _wait_for_waiters(flight, count, key=KEY):
+    deadline = time.monotonic() + 2
+    if key is None:
+        key = next(iter(flight._flights))
+    while flight._flights[key].waiters < count:
+        assert time.monotonic() < deadline, "相乗りが揃いませんでした"
+        time.sleep(0.001)
+
+
+class _Upstream:
+    """release() されるまで返らない上流（呼び出し回数を数える）"""
+
+    def __init__(self, result='応答', error=None, chunks=('あ', 'い', 'う')):
+        self.result = result
+        self.error = error
+        self.chunks = chunks
+        self.calls = 0
+        self.released = threading.Event()
+
+    def generate(self):
+        self.calls += 1
+        self.released.wait(2)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def stream(self):
+        self.calls += 1
+        self.released.wait(2)
+        for chunk in self.chunks:
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+
+def _run(results, func, *args):
+    def target():
+        try:
+            results.append(func(*args))
+        except Exception as e:
+            results.append(e)
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread
+
+
+def test_followers_share_the_leader_result():
+    flight = SingleFlight()
+    upstream = _Upstream()
+    results = []
+    threads = [_run(results, flight.generate, KEY, upstream.generate)]
+    _wait_for_flight(flight)
+    threads += [_run(results, flight.generate, KEY, upstream.generate) for _ in range(3)]
+    _wait_for_waiters(flight, 3)
+    upstream.released.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [('応答', False)] * 3 + [('応答', True)]
+    assert upstream.calls == 1
+    assert not flight._flights
+
+
+def test_leader_error_is_raised_in_every_follower():
+    flight = SingleFlight()
+    upstream = _Upstream(error=ConnectionError("503 upstream"))
+    results = []
+    threads = [_run(results, flight.generate, KEY, upstream.generate)]
+    _wait_for_flight(flight)
+    threads += [_run(results, flight.generate, KEY, upstream.generate) for _ in range(2)]
+    _wait_for_waiters(flight, 2)
+    upstream.released.set()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 3
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert upstream.calls == 1
+
+
+def test_stream_followers_receive_every_chunk():
+    flight = SingleFlight()
+    upstream = _Upstream()
+    results = []
+    threads = [_run(results, lambda: list(flight.stream(KEY, upstream.stream)[0]))]
+    _wait_for_flight(flight)
+    threads.append(_run(results, lambda: list(flight.stream(KEY, upstream.stream)[0])))
+    _wait_for_waiters(flight, 1)
+    upstream.released.set()
+    for thread in threads:
+        thread.join()
+    assert results == [['あ', 'い', 'う']] * 2
+    assert upstream.calls == 1
+
+
+def test_leader_closing_early_still_drains_for_followers():
+    flight = SingleFlight()
+    upstream = _Upstream()
+    upstream.released.set()
+    leader, is_leader = flight.stream(KEY, upstream.stream)
+    assert is_leader
+    assert next(leader) == 'あ'
+    follower, is_leader = flight.stream(KEY, upstream.stream)
+    assert not is_leader
+    results = []
+    thread = _run(results, list, follower)
+    _wait_for_waiters(flight, 1)
+    leader.close()
+    thread.join()
+    assert results == [['あ', 'い', 'う']]
+    assert upstream.calls == 1
+
+
+def test_calls_after_the_window_start_a_new_flight():
+    flight = SingleFlight(window=0)
+    upstream = _Upstream()
+    results = []
+    threads = [_run(results, flight.generate, KEY, upstream.generate)]
+    _wait_for_flight(flight)
+    time.sleep(0.01)
+    threads.append(_run(results, flight.generate, KEY, upstream.generate))
+    deadline = time.monotonic() + 2
+    while upstream.calls < 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+    upstream.released.set()
+    for thread in threads:
+        thread.join()
+    assert upstream.calls == 2
+
+
+def test_overflow_beyond_max_waiters_calls_upstream():
+    flight = SingleFlight(max_waiters=1)
+    upstream = _Upstream()
+    results = []
+    threads = [_run(results, flight.generate, KEY, upstream.generate)]
+    _wait_for_flight(flight)
+    threads.append(_run(results, flight.generate, KEY, upstream.generate))
+    _wait_for_waiters(flight, 1)
+    threads.append(_run(results, flight.generate, KEY, upstream.generate))
+    deadline = time.monotonic() + 2
+    while upstream.calls < 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+    upstream.released.set()
+    for thread in threads:
+        thread.join()
+    assert [reply for reply, _ in results] == ['応答'] * 3
+    assert sorted(leader for _, leader in results) == [False, True, True]
+    assert upstream.calls == 2
+
+
+def test_follower_times_out_when_the_leader_hangs():
+    flight = SingleFlight(wait_timeout=0.05)
+    upstream = _Upstream()
+    results = []
+    leader = _run(results, flight.generate, KEY, upstream.generate)
+    _wait_for_flight(flight)
+    with pytest.raises(TimeoutError):
+        flight.generate(KEY, upstream.generate)
+    upstream.released.set()
+    leader.join()
+
+
+class _BlockingBackend(ModelBackend):
+    name = 'blocking'
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+
+    def generate(self, character, prompt):
+        return self.upstream.generate()
+
+
+def test_only_the_leader_fills_the_response_cache():
+    upstream = _Upstream()
+    flight = SingleFlight()
+    cache = ResponseCache(variants=3)
+    service = ChatService(_BlockingBackend(upstream), SessionStore(), response_cache=cache, single_flight=flight)
+    reimu = CHARACTERS['reimu']
+    results = []
+    threads = [_run(results, service.reply, reimu, 'こんにちは')]
+    _wait_for_flight(flight, key=None)
+    threads += [_run(results, service.reply, reimu, 'こんにちは') for _ in range(4)]
+    _wait_for_waiters(flight, 4, key=None)
+    upstream.released.set()
+    for thread in threads:
+        thread.join()
+    assert results == ['応答'] * 5
+    assert upstream.calls == 1
+    # 相乗りした4件は variants に数えないので、次の呼び出しはまだ上流で新しい応答を作る
+    assert cache.get(cache.make_key(reimu, 'こんにちは')) is None
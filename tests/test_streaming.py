@@ -0,0 +1,42 @@
+import json
+
+from _lib.streaming import SSE_HEADERS, sse_event, wants_stream
+
+
+def _events(body):
+    """SSEのボディを [(event, data), ...] にする"""
+    events = []
+    for frame in body.decode('utf-8').split('\n\n'):
+        if not frame:
+            continue
+        fields = dict(line.split(': ', 1) for line in frame.split('\n'))
+        events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+def test_sse_event_framing():
+    frame = sse_event('delta', {"text": "こんにちは\n霊夢よ"})
+    assert frame.endswith(b'\n\n') and frame.count(b'\n') == 3
+    assert _events(frame) == [('delta', {"text": "こんにちは\n霊夢よ"})]
+
+
+def test_wants_stream():
+    assert wants_stream({"stream": True})
+    assert wants_stream({}, 'text/event-stream')
+    assert wants_stream({}, 'application/json, text/event-stream;q=0.9')
+    assert not wants_stream({}, 'application/json')
+    assert not wants_stream({"stream": False}, None)
+
+
+def test_flask_stream_ends_with_the_full_reply(flask_app):
+    client = flask_app.app.test_client()
+    for path, body in (('/chat/stream', {}), ('/chat', {"stream": True})):
+        response = client.post(path, json={"message": "こんにちは", "character_id": "marisa",
+                                           "session_id": "s1", **body})
+        assert response.status_code == 200
+        assert dict(SSE_HEADERS).items() <= dict(response.headers).items()
+        events = _events(response.data)
+        deltas = [data["text"] for event, data in events[:-1]]
+        assert [event for event, _ in events[:-1]] == ['delta'] * len(deltas) and deltas
+        assert events[-1] == ('done', {"reply": "".join(deltas), "character": {"id": "marisa", "name": "霧雨魔理沙"},
+                                       "session_id": "s1"})
@@ -0,0 +1,156 @@
+import io
+import json
+
+import pytest
+
+from _lib import batch
+from _lib.http_handler import JSONRequestHandler
+from _lib.validation import (
+    MAX_BODY_BYTES, MAX_MESSAGE_CHARS, RequestError, check_content_length, parse_chat_request, parse_json_body,
+)
+
+
+@pytest.mark.parametrize('value, status', [
+    (None, 411),
+    ('abc', 400),
+    ('-1', 400),
+    (str(MAX_BODY_BYTES + 1), 413),
+])
+def test_bad_content_length(value, status):
+    with pytest.raises(RequestError) as info:
+        check_content_length(value)
+    assert info.value.status == status
+
+
+@pytest.mark.parametrize('body', [b'{"message": ', b'[1, 2]', b'"text"', b'\xff\xfe', b''])
+def test_body_must_be_a_json_object(body):
+    with pytest.raises(RequestError) as info:
+        parse_json_body(body)
+    assert info.value.status == 400
+
+
+@pytest.mark.parametrize('data, status', [
+    ({}, 400),
+    ({"message": ""}, 400),
+    ({"message": "   "}, 400),
+    ({"message": 1}, 400),
+    ({"message": "x" * (MAX_MESSAGE_CHARS + 1)}, 413),
+    ({"message": "こんにちは", "character_id": ["reimu"]}, 400),
+    ({"message": "こんにちは", "character_id": {}}, 400),
+])
+def test_bad_chat_requests(data, status):
+    with pytest.raises(RequestError) as info:
+        parse_chat_request(data)
+    assert info.value.status == status
+
+
+def test_chat_request_defaults():
+    character, message, session_id = parse_chat_request(
+        {"message": "こんにちは", "character_id": "unknown", "session_id": "\x00bad"})
+    assert (character.id, message, session_id) == ('reimu', 'こんにちは', None)
+
+
+def test_strict_chat_request_rejects_unknown_ids():
+    for data, status in [({"message": "こんにちは", "character_id": "unknown"}, 404),
+                         ({"message": "こんにちは", "session_id": "\x00bad"}, 400)]:
+        with pytest.raises(RequestError) as info:
+            parse_chat_request(data, fallback=False)
+        assert info.value.status == status
+    character, _, _ = parse_chat_request({"message": "こんにちは"}, fallback=False)
+    assert character.id == 'reimu'
+
+
+@pytest.mark.parametrize('body, status, error', [
+    (b'{"message": ', 400, "リクエストの形式が正しくありません。"),
+    (b'{"message": "   "}', 400, "メッセージが提供されていません。"),
+    (b'{"message": "hi", "character_id": "unknown"}', 404, "指定されたキャラクターが見つかりません。"),
+])
+def test_flask_app_validates_like_the_other_entry_points(flask_app, body, status, error):
+    for path in ('/chat', '/chat/stream'):
+        response = flask_app.app.test_client().post(path, data=body, content_type='application/json')
+        assert (response.status_code, response.get_json()) == (status, {"error": error})
+
+
+@pytest.mark.parametrize('data', [
+    {"message": "こんにちは", "character_ids": [["reimu"]]},
+    {"requests": [{"message": "こんにちは", "character_id": {}}]},
+    {"requests": [{"message": "x" * (MAX_MESSAGE_CHARS + 1), "character_id": "reimu"}]},
+])
+def test_bad_batch_requests(data):
+    with pytest.raises(batch.BatchError):
+        batch.parse_batch(data)
+
+
+class _FakeSocket:
+    def __init__(self, raw):
+        self._raw = raw
+        self.sent = []
+
+    def makefile(self, mode, buffering=None):
+        return io.BytesIO(self._raw)
+
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+
+class _EchoHandler(JSONRequestHandler):
+    """検証を通ったメッセージをそのまま返す"""
+
+    def do_POST(self):
+        try:
+            _, message, _ = parse_chat_request(self.read_json())
+        except RequestError as e:
+            self.send_request_error(e)
+            return
+        self.send_json(200, {"reply": message})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _responses(raw):
+    sock = _FakeSocket(raw)
+    _EchoHandler(sock, ('127.0.0.1', 0), None)
+    return b''.join(sock.sent)
+
+
+def _post(body, headers=None):
+    if headers is None:
+        headers = {'Content-Length': str(len(body))}
+    lines = ['POST /api/chat HTTP/1.1', 'Host: localhost'] + [f'{k}: {v}' for k, v in headers.items()]
+    return '\r\n'.join(lines).encode('latin-1') + b'\r\n\r\n' + body
+
+
+def _status(response):
+    return int(response.split(b' ', 2)[1])
+
+
+@pytest.mark.parametrize('raw, status', [
+    (_post(b'{"message": '), 400),
+    (_post(b'', {}), 411),
+    (_post(b'{}', {'Transfer-Encoding': 'chunked'}), 411),
+    (_post(b'', {'Content-Length': str(MAX_BODY_BYTES + 1)}), 413),
+    (_post(b'{"message": "a"}', {'Content-Length': '100'}), 400),
+    (_post(json.dumps({"message": "a", "character_id": ["reimu"]}).encode()), 400),
+])
+def test_handler_rejects_before_sending_a_reply(raw, status):
+    response = _responses(raw)
+    assert _status(response) == status
+    # 4xx だけを1つ返し、接続を閉じる
+    assert response.count(b'HTTP/1.1 ') == 1
+    assert b'Content-Length: ' in response
+
+
+def test_handler_keeps_the_connection_alive():
+    body = json.dumps({"message": "こんにちは"}, ensure_ascii=False).encode('utf-8')
+    response = _responses(_post(body) + _post(body))
+    assert response.count(b'HTTP/1.1 200 OK') == 2
+    head, _, payload = response.partition(b'\r\n\r\n')
+    length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+    assert json.loads(payload[:length]) == {"reply": "こんにちは"}